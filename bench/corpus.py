@@ -0,0 +1,233 @@
+# Corpus of Klei forum pages for the benchmarks.
+#
+# The pages saved from the forums by save_pages.py into bench/pages are used by default,
+# so the numbers reflect the real markup (spoilers, embeds, ld+json, the page chrome).
+# The pages missing there are generated from a fixed seed, following the markup of the real
+# forum pages (the classes Patchook looks for and the usual page chrome around them), see load_corpus().
+
+import json
+
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from random import Random
+
+import requests
+
+from requests.adapters import BaseAdapter
+
+
+SEED = 1196151
+SAVED_PAGES_DIR = Path(__file__).parent.absolute().joinpath("pages")
+FORUMS_URL = "https://forums.kleientertainment.com"
+SOURCE_URL = FORUMS_URL + "/game-updates/dst"
+ANNOUNCEMENTS_URL = FORUMS_URL + "/forums/forum/2-news-and-announcements"
+DROP_ANIM_URL = "https://kleiforums.s3.amazonaws.com/drops/post/{}.html"
+
+NEWEST_VERSION = 700020
+NEWEST_RELEASE_DATE = datetime(2026, 9, 20, 10, tzinfo=timezone.utc)
+LISTING_ROWS = 25 # Records on one listing page
+
+# Page name -> URL the page is served from.
+PAGES = {
+    "listing": SOURCE_URL + "/page/1",
+    "forum_listing": ANNOUNCEMENTS_URL + "/page/1",
+    "release_small": SOURCE_URL + f"/{NEWEST_VERSION}-r3010/",
+    "release_large": SOURCE_URL + f"/{NEWEST_VERSION - 1}-r3009/",
+    "forum_post": FORUMS_URL + "/forums/topic/160001-roadmap-2026/",
+    "twitch_drop": FORUMS_URL + "/forums/topic/160002-twitch-drops-are-live/",
+    "drop_anim": DROP_ANIM_URL.format("winter_2026"),
+}
+
+WORDS = (
+    "fixed crash when the wilson beefalo pigs spiders ocean boat cannon moon caves ruins "
+    "atrium shadow pieces world generation server client desync mod api performance "
+    "improved changed added removed the a of to with for while when in on at"
+).split()
+
+
+def _sentence(rng: Random, length: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(length)).capitalize() + "."
+
+
+def _chrome(rng: Random, items: int) -> str:
+    # The navigation, sidebars and the footer make up most of a real page.
+    return "".join(
+        f'<div class="ipsNav"><ul><li><a href="{FORUMS_URL}/nav/{i}">Nav {i}</a></li>'
+        f'<li><a href="{FORUMS_URL}/nav/{i}/more">{_sentence(rng, 3)}</a></li></ul>'
+        f'<p class="ipsType_light">{_sentence(rng, 12)} <b>markup</b></p></div>'
+        for i in range(items)
+    )
+
+
+def _page(rng: Random, title: str, body: str, author: str="JoeW", date: str="2026-09-20T10:00:00+0000") -> str:
+    ld_json = json.dumps({
+        "author": {"name": author, "image": "//cdn.forums.klei.com/avatars/1.png", "url": "//forums.kleientertainment.com/profile/1"},
+        "datePublished": date,
+    })
+    return (
+        '<!DOCTYPE html><html><head>'
+        f'<meta property="og:title" content="{title}">'
+        f'<script type="application/ld+json">{ld_json}</script>'
+        '<script>var ipsDebug = false;</script></head><body>'
+        + _chrome(rng, 150)
+        + f'<h1 class="ipsType_pageTitle ipsType_largeTitle ipsType_break">{title}</h1>'
+        + body
+        + _chrome(rng, 150)
+        + '</body></html>'
+    )
+
+
+def _release_notes(rng: Random, sections: int) -> str:
+    html = '<h2>Changes</h2>'
+    for index in range(sections):
+        items = "".join(
+            f'<li>{_sentence(rng, rng.randint(6, 20))}'
+            + (f'<ul><li>{_sentence(rng, 8)}</li><li>{_sentence(rng, 5)}</li></ul>' if rng.random() < 0.3 else '')
+            + '</li>'
+            for _ in range(rng.randint(4, 12))
+        )
+        html += (
+            f'<p><span style="font-size:18px;"><strong>Section {index}</strong></span></p>'
+            f'<ul>{items}</ul>'
+            f'<p style="margin-left:40px;">{_sentence(rng, 15)} '
+            f'<a href="{FORUMS_URL}/klei-bug-tracker/dont-starve-together/bug-{index}/">Bug {index}</a></p>'
+            f'<div class="ipsSpoiler" data-ipsspoiler=""><div class="ipsSpoiler_header"><span>Spoiler</span></div>'
+            f'<div class="ipsSpoiler_contents"><p>{_sentence(rng, 25)}</p>'
+            f'<pre class="ipsCode">local x = {index}\nprint(x)</pre></div></div>'
+            f'<p>{_sentence(rng, 10)} <img alt=":)" class="ipsEmoji" src="{FORUMS_URL}/emoticons/smile.png"> '
+            f'<em>{_sentence(rng, 4)}</em><br>{_sentence(rng, 6)}</p>'
+        )
+    return html
+
+
+def _release(rng: Random, index: int, sections: int) -> str:
+    version = NEWEST_VERSION - index
+    date = NEWEST_RELEASE_DATE - timedelta(hours=index) # The posts are sorted by their publish date.
+    body = (
+        '<article>'
+        f'<section class="ipsType_richText ipsType_normal">{_release_notes(rng, sections)}</section>'
+        f'<a href="{FORUMS_URL}/forums/topic/15{version % 1000}-game-update-{version}/">Discussion Topic</a>'
+        '</article>'
+    )
+    return _page(rng, f"{version}", body, date=date.strftime("%Y-%m-%dT%H:%M:%S%z"))
+
+
+def _forum_post(rng: Random, title: str, content: str) -> str:
+    body = (
+        '<article><div data-role="commentContent">'
+        f'<p>{_sentence(rng, 30)}</p>'
+        f'<p><img class="ipsImage ipsImage_thumbnailed" src="https://cdn.forums.klei.com/monthly/{title[:4]}.png"></p>'
+        f'{content}'
+        + "".join(f'<p>{_sentence(rng, rng.randint(10, 40))}</p>' for _ in range(40)) +
+        '</div></article>'
+    )
+    return _page(rng, title, body, author="Jason")
+
+
+def get_release_url(index: int) -> str:
+    """Return the URL of the index-th newest release on the listing."""
+
+    return f"{SOURCE_URL}/{NEWEST_VERSION - index}-r{3010 - index}/"
+
+
+def _listing(rng: Random, rows_count: int=LISTING_ROWS) -> str:
+    rows = ""
+    for index in range(rows_count):
+        version = NEWEST_VERSION - index
+        pinned = '<span title="Pinned"><i class="fa fa-thumb-tack"></i></span>' if index == 0 else ''
+        hotfix = '<span title="Hotfix"></span>' if index % 3 == 1 else ''
+        beta = '<span class="ipsBadge ipsBadge_negative">Test</span>' if index % 4 == 2 else ''
+        rows += (
+            '<li class="cCmsRecord_row">'
+            f'<a href="{get_release_url(index)}" data-releaseid="{version}">'
+            f'{hotfix}<h3 class="ipsType_sectionHead ipsType_break">{version}</h3>{beta}{pinned}</a>'
+            f'<p>{_sentence(rng, 12)}</p></li>'
+        )
+    return _page(rng, "Game Updates", f'<ol>{rows}</ol>')
+
+
+def _forum_listing(rng: Random) -> str:
+    rows = ""
+    for index in range(LISTING_ROWS):
+        color = "color:red" if index % 2 == 0 else "color:goldenrod"
+        rows += (
+            '<div class="ipsDataItem_main">'
+            f'<span class="ipsType_break ipsContained"><a href="{FORUMS_URL}/forums/topic/{150000 + index}-post/">{_sentence(rng, 5)}</a></span>'
+            f'<div class="ipsDataItem_meta"><a href="{FORUMS_URL}/profile/{index}"><span style="{color}">Dev {index}</span></a>'
+            f'<time datetime="2026-09-{20 - index % 19:02d}T10:00:00Z"></time></div></div>'
+        )
+    return _page(rng, "News and Announcements", rows)
+
+
+def build_listing(rows_count: int, seed: int=SEED) -> str:
+    """Generate a listing page with the given number of releases."""
+
+    return _listing(Random(seed), rows_count)
+
+
+def build_release(index: int, sections: int, seed: int=SEED) -> str:
+    """Generate the page of the index-th newest release on the listing."""
+
+    return _release(Random(seed + index), index, sections)
+
+
+def build_corpus(seed: int=SEED) -> dict[str, str]:
+    """Generate the corpus, returns a dictionary of page name -> HTML."""
+
+    rng = Random(seed)
+    drop_anim_url = PAGES["drop_anim"]
+    return {
+        "listing": _listing(rng),
+        "forum_listing": _forum_listing(rng),
+        "release_small": _release(rng, 0, sections=4),
+        "release_large": _release(rng, 1, sections=60),
+        "forum_post": _forum_post(rng, "Roadmap 2026", f'<p>Watch us on <a href="https://www.twitch.tv/kleientertainment">Twitch</a>.</p>'),
+        "twitch_drop": _forum_post(rng, "Twitch Drops Are Live", f'<p><a href="{drop_anim_url}">See the drops</a></p>'),
+        "drop_anim": '<html><body><img src="https://cdn.forums.klei.com/drops/image/winter_2026_item.jpg"></body></html>',
+    }
+
+
+def get_saved_pages(directory: Path=SAVED_PAGES_DIR) -> list[str]:
+    """Return the names of the pages saved in the directory, see save_pages.py."""
+
+    return [name for name in PAGES if Path(directory).joinpath(name + ".html").is_file()]
+
+
+def load_corpus(directory: Path=SAVED_PAGES_DIR) -> dict[str, str]:
+    """
+    Return the corpus of the pages saved in the directory (<page name>.html), the missing ones are generated.
+
+    :param directory: Directory with pages saved from the forums, bench/pages by default.
+    """
+
+    corpus = build_corpus()
+    for name in get_saved_pages(directory):
+        corpus[name] = Path(directory).joinpath(name + ".html").read_text(encoding="utf-8")
+
+    return corpus
+
+
+class CorpusAdapter(BaseAdapter):
+    """
+    Transport adapter serving the corpus pages instead of the network, see http_client.mount().
+
+    Unknown URLs get an empty page, so the scraper stops paging instead of retrying.
+    """
+
+    def __init__(self, corpus: dict[str, str]):
+        super().__init__()
+        self.pages = {PAGES[name]: html for name, html in corpus.items()}
+
+    def send(self, request, **kwargs) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = "OK"
+        response.url = request.url
+        response.request = request
+        response.headers["Content-Type"] = "text/html; charset=utf-8"
+        response.encoding = "utf-8"
+        response._content = self.pages.get(request.url, "<html></html>").encode("utf-8")
+        return response
+
+    def close(self):
+        pass
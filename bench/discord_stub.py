@@ -0,0 +1,237 @@
+# Local stand-in for the parts of the Discord API used by Patchook, for load testing the delivery path.
+#
+#   POST  /api/webhooks/<id>/<token>?wait=true          Create a message
+#   PATCH /api/webhooks/<id>/<token>/messages/<id>      Edit a message
+#   GET   /api/webhooks/<id>/<token>                    Webhook info
+#   GET   /api/v10/channels/<id>                        Channel info
+#
+# The rate limits are reported in the same headers Discord uses, with 429 responses
+# when a bucket is exhausted. Latency and bursts of 502 responses can be injected.
+
+import json
+
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from random import Random
+from threading import Lock, Thread
+from time import monotonic, sleep
+from urllib.parse import urlparse, parse_qs
+
+
+class StubSettings:
+    """Behaviour of the stub, the defaults follow the limits of the real webhooks."""
+
+    bucket_limit: int = 5           # Requests per webhook within one bucket window
+    bucket_window: float = 2        # Seconds
+    global_per_second: int = 50     # 0 disables the global limit
+    latency: float = 0.05           # Seconds added to every response
+    jitter: float = 0.02            # Random extra latency, up to this many seconds
+    burst_every: int = 0            # Start a burst of 502 responses every this many requests, 0 disables them
+    burst_length: int = 0           # Number of 502 responses in one burst
+    forum: bool = False             # Report the webhook channels as forum channels
+    seed: int = 0
+
+    def __init__(self, **settings):
+        for name, value in settings.items():
+            if not hasattr(StubSettings, name):
+                raise ValueError(f"Unknown stub setting '{name}'!")
+            setattr(self, name, value)
+
+
+class _Window:
+    def __init__(self):
+        self.reset_at = 0
+        self.used = 0
+
+
+class DiscordStub(ThreadingHTTPServer):
+    """
+    The stub server, it keeps the rate limit state and the delivered messages.
+
+    Use start() and stop(), the base URL of the webhooks is in webhook_url().
+    """
+
+    daemon_threads = True
+
+    def __init__(self, settings: StubSettings=None, host: str="127.0.0.1", port: int=0):
+        super().__init__((host, port), _StubHandler)
+        self.settings = settings or StubSettings()
+        self.random = Random(self.settings.seed)
+        self.lock = Lock()
+        self.buckets: dict[str, _Window] = defaultdict(_Window)
+        self.global_window = _Window()
+        self.message_ids = count(1)
+        self.burst_remaining = 0
+
+        self.stats: dict[str, int] = defaultdict(int)
+        self.messages: dict[str, list[dict]] = defaultdict(list) # Webhook ID -> created messages in order
+        self.first_created_at: float = None # time.monotonic() of the first created message
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def webhook_url(self, webhook_id: int, token: str="token") -> str:
+        return f"{self.base_url}/api/webhooks/{webhook_id}/{token}"
+
+    def start(self) -> "DiscordStub":
+        self._thread = Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def check_limits(self, bucket_id: str) -> tuple[int, dict]:
+        """Return the status code and the headers for the next request to the bucket."""
+
+        settings = self.settings
+        with self.lock:
+            self.stats["requests"] += 1
+            if settings.burst_every and self.stats["requests"] % settings.burst_every == 0:
+                self.burst_remaining = settings.burst_length
+            if self.burst_remaining > 0:
+                self.burst_remaining -= 1
+                self.stats["502"] += 1
+                return 502, {}
+
+            now = monotonic()
+            if settings.global_per_second:
+                window = self.global_window
+                if window.reset_at <= now:
+                    window.reset_at, window.used = now + 1, 0
+                if window.used >= settings.global_per_second:
+                    self.stats["429_global"] += 1
+                    return 429, {"Retry-After": f"{window.reset_at - now:.3f}", "X-RateLimit-Global": "true", "X-RateLimit-Scope": "global"}
+                window.used += 1
+
+            bucket = self.buckets[bucket_id]
+            if bucket.reset_at <= now:
+                bucket.reset_at, bucket.used = now + settings.bucket_window, 0
+
+            headers = {
+                "X-RateLimit-Bucket": bucket_id,
+                "X-RateLimit-Limit": str(settings.bucket_limit),
+                "X-RateLimit-Reset-After": f"{bucket.reset_at - now:.3f}",
+            }
+            if bucket.used >= settings.bucket_limit:
+                self.stats["429"] += 1
+                headers["X-RateLimit-Remaining"] = "0"
+                headers["X-RateLimit-Scope"] = "user"
+                headers["Retry-After"] = f"{bucket.reset_at - now:.3f}"
+                return 429, headers
+
+            bucket.used += 1
+            headers["X-RateLimit-Remaining"] = str(settings.bucket_limit - bucket.used)
+            return 200, headers
+
+    def get_latency(self) -> float:
+        with self.lock:
+            return self.settings.latency + self.random.uniform(0, self.settings.jitter)
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    server: DiscordStub
+    protocol_version = "HTTP/1.1" # Keep-alive, like the real API
+
+    def log_message(self, format, *args):
+        pass # Thousands of requests would flood the output.
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length", 0))
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length))
+        except json.JSONDecodeError:
+            return {}
+
+    def _respond(self, status: int, body=None, headers: dict=None) -> None:
+        payload = b"" if body is None else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body is not None:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _route(self) -> tuple[list[str], dict]:
+        url = urlparse(self.path)
+        return [part for part in url.path.split("/") if part], parse_qs(url.query)
+
+    def _limited(self, bucket_id: str) -> bool:
+        sleep(self.server.get_latency())
+        status, headers = self.server.check_limits(bucket_id)
+        if status == 200:
+            self._rate_limit_headers = headers
+            return False
+
+        if status == 429:
+            retry_after = float(headers["Retry-After"])
+            self._respond(429, {"message": "You are being rate limited.", "retry_after": retry_after,
+                "global": "X-RateLimit-Global" in headers}, headers)
+        else:
+            self._respond(status, {"message": "Bad Gateway", "code": 0})
+        return True
+
+    def do_GET(self):
+        parts, _ = self._route()
+        self._read_json()
+        if parts[:2] == ["api", "webhooks"] and len(parts) == 4:
+            self.server.stats["webhook_info"] += 1
+            webhook_id = parts[2]
+            return self._respond(200, {
+                "id": webhook_id, "type": 1, "name": f"Stub {webhook_id}", "token": parts[3],
+                "guild_id": "1", "channel_id": str(1000 + int(webhook_id)), "application_id": None,
+            })
+
+        if parts[:3] == ["api", "v10", "channels"] and len(parts) == 4:
+            self.server.stats["channel_info"] += 1
+            return self._respond(200, {"id": parts[3], "type": 15 if self.server.settings.forum else 0})
+
+        self._respond(404, {"message": "Unknown route", "code": 0})
+
+    def do_POST(self):
+        parts, query = self._route()
+        message = self._read_json()
+        if parts[:2] != ["api", "webhooks"] or len(parts) != 4:
+            return self._respond(404, {"message": "Unknown route", "code": 0})
+
+        if self._limited(f"webhook-{parts[2]}"):
+            return
+
+        message_id = str(next(self.server.message_ids))
+        with self.server.lock:
+            self.server.stats["created"] += 1
+            if self.server.first_created_at is None:
+                self.server.first_created_at = monotonic()
+            self.server.messages[parts[2]].append({"id": message_id, **message})
+
+        # A message creating a thread is posted in the thread, which has the same ID as the message.
+        channel_id = message_id if "thread_name" in message else str(1000 + int(parts[2]))
+        if query.get("wait", ["false"])[0].lower() == "true":
+            self._respond(200, {"id": message_id, "channel_id": channel_id, **message}, self._rate_limit_headers)
+        else:
+            self._respond(204, None, self._rate_limit_headers)
+
+    def do_PATCH(self):
+        parts, _ = self._route()
+        message = self._read_json()
+        if parts[:2] != ["api", "webhooks"] or len(parts) != 6 or parts[4] != "messages":
+            return self._respond(404, {"message": "Unknown route", "code": 0})
+
+        if self._limited(f"webhook-{parts[2]}"):
+            return
+
+        with self.server.lock:
+            self.server.stats["edited"] += 1
+            for stored_message in self.server.messages[parts[2]]:
+                if stored_message["id"] == parts[5]:
+                    stored_message.update(message)
+        self._respond(200, {"id": parts[5], **message}, self._rate_limit_headers)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# Load test of the delivery path against the local Discord stub (see discord_stub.py).
+#
+#   python bench/load_test.py --webhooks 500 --posts 50
+#   python bench/load_test.py --webhooks 50 --posts 10 --burst-every 200 --burst-length 5
+#   python bench/load_test.py --engine async --parse-processes 4
+#
+# The posts are scraped from the offline corpus and announced with announce_new_versions,
+# exactly like a normal run, only the Discord API is served by the stub.
+
+import json
+import re
+import sys
+
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from os import devnull, environ
+from pathlib import Path
+from tempfile import mkdtemp
+from time import monotonic, perf_counter
+
+BENCH_DIR = Path(__file__).parent.absolute()
+sys.path.insert(0, str(BENCH_DIR.parent.joinpath("src")))
+sys.path.insert(0, str(BENCH_DIR))
+
+from corpus import CorpusAdapter, build_corpus, build_listing, build_release, get_release_url, PAGES, SOURCE_URL, NEWEST_VERSION
+from discord_stub import DiscordStub, StubSettings
+
+
+VERSION_PATTERN = re.compile(r"(\d+)")
+
+
+def write_config(data_dir: Path, stub: DiscordStub, args) -> None:
+    min_version = NEWEST_VERSION - args.posts
+    data_dir.joinpath("config.json").write_text(json.dumps({
+        "webhooks": [
+            {"url": stub.webhook_url(index), "last_announced_version": {SOURCE_URL: min_version}}
+            for index in range(args.webhooks)
+        ],
+        "bot_token": "stub", # So the channel info is fetched as well.
+        "max_announcements_per_webhook": args.posts,
+        "dispatch_workers": args.dispatch_workers,
+        "engine": args.engine,
+        "parse_processes": args.parse_processes,
+        "rss_fast_path": False,
+        "rate_limit": {"global_per_second": args.global_per_second},
+        "http": {"pool_size": args.dispatch_workers},
+        "http_cache": {"enabled": False},
+    }))
+
+
+def check_order(stub: DiscordStub, args) -> int:
+    """Return the number of webhooks which did not get all the posts in order."""
+
+    expected = list(range(NEWEST_VERSION - args.posts + 1, NEWEST_VERSION + 1))
+    failed = 0
+    for index in range(args.webhooks):
+        versions = []
+        for message in stub.messages.get(str(index), []):
+            match = VERSION_PATTERN.search(message["embeds"][0]["title"])
+            versions.append(int(match.group()) if match else None)
+        if versions != expected:
+            failed += 1
+
+    return failed
+
+
+def main():
+    arg_parser = ArgumentParser(description="Load test of the Patchook delivery path against a local Discord stub.")
+    arg_parser.add_argument("--webhooks", type=int, default=500)
+    arg_parser.add_argument("--posts", type=int, default=50)
+    arg_parser.add_argument("--dispatch-workers", type=int, default=8)
+    arg_parser.add_argument("--engine", choices=("sync", "async"), default="sync")
+    arg_parser.add_argument("--parse-processes", type=int, default=0, help="build the posts in a process pool")
+    arg_parser.add_argument("--global-per-second", type=int, default=StubSettings.global_per_second,
+        help="global limit used by both the stub and Patchook")
+    arg_parser.add_argument("--bucket-limit", type=int, default=StubSettings.bucket_limit)
+    arg_parser.add_argument("--bucket-window", type=float, default=StubSettings.bucket_window)
+    arg_parser.add_argument("--latency-ms", type=float, default=StubSettings.latency * 1000)
+    arg_parser.add_argument("--jitter-ms", type=float, default=StubSettings.jitter * 1000)
+    arg_parser.add_argument("--burst-every", type=int, default=0, help="start a burst of 502 responses every N requests")
+    arg_parser.add_argument("--burst-length", type=int, default=0)
+    arg_parser.add_argument("--verbose", action="store_true", help="show the output of Patchook")
+    args = arg_parser.parse_args()
+
+    stub = DiscordStub(StubSettings(
+        bucket_limit=args.bucket_limit,
+        bucket_window=args.bucket_window,
+        global_per_second=args.global_per_second,
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        burst_every=args.burst_every,
+        burst_length=args.burst_length,
+    )).start()
+
+    # A throwaway data directory, the load test must not touch the real config, caches or journal.
+    data_dir = Path(mkdtemp(prefix="patchook-load-"))
+    environ["APP_DIR"] = str(BENCH_DIR.parent)
+    environ["APP_DATA_DIR"] = str(data_dir)
+    write_config(data_dir, stub, args)
+
+    import http_client
+    import journal
+    import metrics
+    import web_scraper
+    import main as patchook_main
+
+    # main.py points APP_DATA_DIR to the data directory of the repository, the modules imported above
+    # already use the throwaway one and the parse processes must use it as well.
+    environ["APP_DATA_DIR"] = str(data_dir)
+
+    web_scraper.DISCORD_API_BASE = stub.base_url + "/api/v10"
+
+    corpus = build_corpus()
+    adapter = CorpusAdapter(corpus)
+    adapter.pages[PAGES["listing"]] = build_listing(args.posts + 2) # Ends with an already announced release.
+    for index in range(args.posts + 2):
+        adapter.pages[get_release_url(index)] = build_release(index, sections=60 if index % 10 == 0 else 4)
+    http_client.mount("https://", adapter)
+
+    with open(devnull, 'w') as output, redirect_stdout(sys.stdout if args.verbose else output):
+        start = perf_counter()
+        patchooks = patchook_main.create_patchooks()
+        setup_time = perf_counter() - start
+
+        start = perf_counter()
+        announce_started_at = monotonic()
+        posts = patchook_main.announce_new_versions(patchooks)
+        announce_time = perf_counter() - start
+
+    stub.stop()
+
+    deliveries = stub.stats["created"]
+    print(f"Webhooks: {args.webhooks}, posts: {len(posts)}, dispatch workers: {args.dispatch_workers}, engine: {args.engine}, parse processes: {args.parse_processes}")
+    print(f"Setup:    {setup_time:.2f} s ({stub.stats['webhook_info']} webhook and {stub.stats['channel_info']} channel lookups)")
+    print(f"Announce: {announce_time:.2f} s, {deliveries} messages delivered, {deliveries / announce_time:.1f} messages/s")
+    if stub.first_created_at is not None:
+        print(f"First:    {stub.first_created_at - announce_started_at:.2f} s to the first message")
+    print(f"Requests: {stub.stats['requests']}, 429: {stub.stats['429']} (global {stub.stats['429_global']}), 502: {stub.stats['502']}")
+
+    print(f"Stages:   {metrics.format_stages(metrics.get_run_summary())}")
+
+    failed = check_order(stub, args)
+    print(f"Order:    {'OK' if not failed else f'{failed} webhook(s) missed posts or got them out of order'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# Offline benchmarks of the HTML to Discord rendering pipeline.
+#
+#   python bench/run.py                         # Print the results
+#   python bench/run.py --save results.json     # Save them, for example before a change
+#   python bench/run.py --compare results.json  # Compare with the saved results
+#
+# Each stage is timed separately over the corpus (see corpus.py), the peak memory
+# is measured in a separate pass since tracemalloc slows everything down.
+
+import json
+import platform
+import subprocess
+import sys
+import tracemalloc
+
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from io import StringIO
+from os import environ
+from pathlib import Path
+from tempfile import mkdtemp
+from time import perf_counter
+
+BENCH_DIR = Path(__file__).parent.absolute()
+
+# Use a throwaway data directory, the benchmarks must not touch the real config or caches.
+environ["APP_DIR"] = str(BENCH_DIR.parent)
+environ["APP_DATA_DIR"] = mkdtemp(prefix="patchook-bench-")
+Path(environ["APP_DATA_DIR"]).joinpath("config.json").write_text(json.dumps({
+    "http_cache": {"enabled": False},
+}))
+
+sys.path.insert(0, str(BENCH_DIR.parent.joinpath("src")))
+sys.path.insert(0, str(BENCH_DIR))
+
+import http_client
+import parsing
+import web_scraper
+
+from models import PatchNotes
+from post import Post, PostTag
+from corpus import CorpusAdapter, get_saved_pages, load_corpus, PAGES, SAVED_PAGES_DIR, SOURCE_URL, ANNOUNCEMENTS_URL, NEWEST_VERSION, LISTING_ROWS
+
+
+DEFAULT_ITERATIONS = 20
+WARMUP_ITERATIONS = 2
+
+POST_PAGES = ("release_small", "release_large", "forum_post", "twitch_drop")
+
+
+def _quiet(function, *args, **kwargs):
+    # The scraper reports every request, which would only add noise to the timings.
+    with redirect_stdout(StringIO()):
+        return function(*args, **kwargs)
+
+
+def _new_post(corpus_soups: dict, name: str) -> Post:
+    soup = corpus_soups[name]
+    if name.startswith("release"):
+        return Post(PostTag.UPDATE, url=PAGES[name], soup=soup, source_url=SOURCE_URL)
+    return Post(PostTag.FORUM_POST, url=PAGES[name], soup=soup, source_url=ANNOUNCEMENTS_URL)
+
+
+def _get_section(post_soup):
+    return post_soup.find("section", {"class": "ipsType_richText ipsType_normal"}) or post_soup.find("div", {"data-role": "commentContent"})
+
+
+def get_stages(corpus: dict) -> dict:
+    """Return the benchmarked stages, stage name -> (function, items processed by one call)."""
+
+    # Stop right after the first page, the rest of the listing is empty.
+    min_version = NEWEST_VERSION - LISTING_ROWS + 2
+    soups = {name: parsing.make_soup(corpus[name]) for name in POST_PAGES}
+    posts = {name: _quiet(_new_post, soups, name) for name in POST_PAGES}
+    sections = {name: _get_section(soups[name]) for name in POST_PAGES}
+
+    def listing_parse():
+        _quiet(web_scraper._scan_listing, SOURCE_URL, min_version, None, LISTING_ROWS)
+        _quiet(web_scraper._scan_listing, ANNOUNCEMENTS_URL, 0, None, LISTING_ROWS)
+
+    def post_page_parse():
+        for name in POST_PAGES:
+            parsing.make_soup(corpus[name])
+
+    def post_init():
+        for name in POST_PAGES:
+            _quiet(_new_post, soups, name)
+
+    def patch_notes_build():
+        for section in sections.values():
+            PatchNotes(section.__copy__())
+
+    def to_embed():
+        for post in posts.values():
+            post._clear_render_cache() # Measure the rendering, not the cache.
+            post.to_embed()
+
+    return {
+        "listing_parse": (listing_parse, 2),
+        "post_page_parse": (post_page_parse, len(POST_PAGES)),
+        "post_init": (post_init, len(POST_PAGES)),
+        "patch_notes_build": (patch_notes_build, len(POST_PAGES)),
+        "to_embed": (to_embed, len(POST_PAGES)),
+    }
+
+
+def _percentile(samples: list[float], percentile: float) -> float:
+    samples = sorted(samples)
+    index = max(0, min(len(samples) - 1, round(percentile / 100 * len(samples) + 0.5) - 1))
+    return samples[index]
+
+
+def measure(function, items: int, iterations: int) -> dict:
+    for _ in range(WARMUP_ITERATIONS):
+        function()
+
+    samples = []
+    for _ in range(iterations):
+        start = perf_counter()
+        function()
+        samples.append(perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "iterations": iterations,
+        "throughput": items * len(samples) / sum(samples), # Items per second
+        "p50_ms": _percentile(samples, 50) * 1000,
+        "p99_ms": _percentile(samples, 99) * 1000,
+        "peak_memory_kb": peak / 1024,
+    }
+
+
+def get_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def print_results(results: dict, baseline: dict=None) -> None:
+    print(f"Revision {results['revision'] or 'unknown'}, Python {results['python']}, parser {results['parser']}")
+    print(f"{'stage':<20}{'items/s':>12}{'p50 ms':>12}{'p99 ms':>12}{'peak KiB':>12}" + (f"{'p50 change':>14}" if baseline else ""))
+    for stage, result in results["stages"].items():
+        line = f"{stage:<20}{result['throughput']:>12.1f}{result['p50_ms']:>12.2f}{result['p99_ms']:>12.2f}{result['peak_memory_kb']:>12.0f}"
+        base_result = baseline and baseline["stages"].get(stage)
+        if base_result:
+            line += f"{(result['p50_ms'] / base_result['p50_ms'] - 1) * 100:>+13.1f}%"
+        print(line)
+
+
+def main():
+    arg_parser = ArgumentParser(description="Offline benchmarks of the Patchook rendering pipeline.")
+    arg_parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS, help="timed runs of each stage")
+    arg_parser.add_argument("--corpus", type=Path, default=SAVED_PAGES_DIR,
+        help="directory with the forum pages saved by save_pages.py, bench/pages by default")
+    arg_parser.add_argument("--stage", action="append", help="run only the given stage, can be repeated")
+    arg_parser.add_argument("--save", type=Path, help="save the results as JSON to the given file")
+    arg_parser.add_argument("--compare", type=Path, help="compare the results with the ones saved by --save")
+    args = arg_parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    http_client.mount("https://", CorpusAdapter(corpus))
+
+    saved_pages = get_saved_pages(args.corpus)
+    generated_pages = [name for name in PAGES if name not in saved_pages]
+    if generated_pages:
+        print(f"[Warn] Using the generated {', '.join(generated_pages)} page(s), save the real ones with bench/save_pages.py.")
+
+    results = {
+        "revision": get_revision(),
+        "python": platform.python_version(),
+        "parser": parsing.get_parser(),
+        "saved_pages": saved_pages,
+        "stages": {},
+    }
+    for stage, (function, items) in get_stages(corpus).items():
+        if args.stage and stage not in args.stage:
+            continue
+        results["stages"][stage] = measure(function, items, args.iterations)
+
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+    print_results(results, baseline)
+
+    if args.save:
+        args.save.write_text(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
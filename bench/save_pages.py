@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# Save the forum pages of the benchmark corpus from the Klei forums into bench/pages (see corpus.py).
+#
+#   python bench/save_pages.py
+#   python bench/save_pages.py --twitch-drop https://forums.kleientertainment.com/forums/topic/<id>-<name>/
+#
+# The newest release on the listing is saved as release_small and the longest of the next ones as release_large,
+# the newest post of a developer in the news and announcements as forum_post. There is no listing of the Twitch drops,
+# so the twitch_drop page is saved only when its URL is given, together with its drop animation page.
+
+import re
+import sys
+
+from argparse import ArgumentParser
+from pathlib import Path
+
+import requests
+
+from bs4 import BeautifulSoup
+
+BENCH_DIR = Path(__file__).parent.absolute()
+sys.path.insert(0, str(BENCH_DIR))
+
+from corpus import SAVED_PAGES_DIR, SOURCE_URL, ANNOUNCEMENTS_URL
+
+
+USER_AGENT = "Patchook benchmarks (https://github.com/Servacek/dst-patchook)"
+RELEASES_TO_COMPARE = 10 # The longest of these is the large release
+DROP_ANIM_PATTERN = re.compile(r'https?://kleiforums\.s3\.amazonaws\.com/drops/post/[^"\']+\.html')
+
+
+def fetch(session: requests.Session, url: str) -> str:
+    response = session.get(url, timeout=30)
+    response.raise_for_status()
+    print(f"[{response.status_code}] {url}")
+    return response.text
+
+
+def save(directory: Path, name: str, html: str) -> None:
+    directory.mkdir(parents=True, exist_ok=True)
+    directory.joinpath(name + ".html").write_text(html, encoding="utf-8")
+
+
+def get_release_urls(listing: str) -> list[str]:
+    # The pinned rows are out of order, so they are left out.
+    urls = []
+    for row in BeautifulSoup(listing, "html.parser").find_all("li", class_="cCmsRecord_row"):
+        pinned = row.find("i", class_="fa-thumb-tack") or row.find("span", title=lambda title: title and title.strip().lower() == "pinned")
+        link = row.find("a", href=True)
+        if link and not pinned:
+            urls.append(link["href"])
+    return urls
+
+
+def get_dev_post_url(forum_listing: str) -> str | None:
+    # The posts of the developers and admins have their author in red, see web_scraper._scan_listing.
+    for item in BeautifulSoup(forum_listing, "html.parser").find_all("div", class_="ipsDataItem_main"):
+        link = item.select_one("span.ipsType_break.ipsContained a[href]")
+        if link and any("color:red" in span.get("style", "").lower().replace(" ", "") for span in item.find_all("span")):
+            return link["href"]
+    return None
+
+
+def main():
+    arg_parser = ArgumentParser(description="Save the forum pages of the benchmark corpus.")
+    arg_parser.add_argument("--output", type=Path, default=SAVED_PAGES_DIR, help="directory to save the pages to")
+    arg_parser.add_argument("--twitch-drop", help="URL of a forum post announcing Twitch drops")
+    args = arg_parser.parse_args()
+
+    session = requests.Session()
+    session.headers["User-Agent"] = USER_AGENT
+
+    listing = fetch(session, SOURCE_URL + "/")
+    save(args.output, "listing", listing)
+
+    release_urls = get_release_urls(listing)[:RELEASES_TO_COMPARE]
+    if not release_urls:
+        sys.exit("No releases were found on the listing!")
+    releases = [fetch(session, url) for url in release_urls]
+    save(args.output, "release_small", releases[0])
+    save(args.output, "release_large", max(releases[1:] or releases, key=len))
+
+    forum_listing = fetch(session, ANNOUNCEMENTS_URL + "/")
+    save(args.output, "forum_listing", forum_listing)
+    dev_post_url = get_dev_post_url(forum_listing)
+    if dev_post_url:
+        save(args.output, "forum_post", fetch(session, dev_post_url))
+    else:
+        print("[Warn] No post of a developer was found in the news and announcements!")
+
+    if args.twitch_drop:
+        twitch_drop = fetch(session, args.twitch_drop)
+        save(args.output, "twitch_drop", twitch_drop)
+        match = DROP_ANIM_PATTERN.search(twitch_drop)
+        if match:
+            save(args.output, "drop_anim", fetch(session, match.group()))
+
+
+if __name__ == "__main__":
+    main()
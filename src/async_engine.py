@@ -0,0 +1,219 @@
+# Asyncio engine, an alternative to the sequential announce_new_versions (set "engine": "async").
+#
+# The stages are connected with bounded queues and run at the same time:
+#   scrape   The listings of all the sources are scanned at once.
+#   build    The post pages are fetched and parsed by fetch_workers workers, the oldest posts first.
+#   deliver  The posts are merged by their publish date and every webhook gets them in order,
+#            the oldest post is delivered as soon as it is ready while the newer ones are still being built.
+#
+# The HTTP client is blocking, so the requests run in threads and the parsing runs in its own executor
+# (the process pool when "parse_processes" is set), the scraping and posting code is the same as in the sync engine.
+
+import asyncio
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import web_scraper
+
+from config import config
+from models.patch_notes import embed_link_cache
+from patchook import Patchook, get_announced_versions
+from post import PostRecord, video_info_cache
+
+
+QUEUE_SIZE_PER_WORKER = 2 # Candidates waiting for each build worker
+DEFAULT_MAX_ANNOUNCEMENTS = 50 # See max_announcements_per_webhook
+
+
+def _get_candidate_order(candidate: dict) -> int:
+    # The release IDs are the versions, the forum posts only have the time from the listing.
+    return candidate.get("release_id") or candidate.get("timestamp") or 0
+
+
+def _get_post_order(post: PostRecord) -> int:
+    return post.publish_timestamp or post.version
+
+
+class Pipeline:
+    """
+    One run of the engine, see announce().
+
+    :param patchooks: The webhooks to announce the posts to.
+    :param deliver: Function posting one post to one webhook, raising an exception if it fails.
+    :param dispatch_workers: Webhooks being posted to at once.
+    """
+
+    def __init__(self, patchooks: list[Patchook], deliver, dispatch_workers: int):
+        self.patchooks = patchooks
+        self.deliver = deliver
+        self.fetch_workers = max(1, config.get("fetch_workers", web_scraper.DEFAULT_FETCH_WORKERS))
+        # Keep all the parse processes busy, every build worker waits for one post at a time.
+        self.build_workers = max(self.fetch_workers, web_scraper.get_parse_processes())
+        self.dispatch_workers = max(1, dispatch_workers)
+
+        # Posts ready to be delivered, in the order of delivery. Each webhook keeps its own position in it.
+        self.ready: list[PostRecord] = []
+        self.finished = False
+        self._ready_condition: asyncio.Condition = None
+        self._build_queue: asyncio.Queue = None
+        self._feeders: list[asyncio.Task] = []
+
+    async def run(self, oldest_announced_versions: dict, fingerprint: str) -> list[PostRecord]:
+        loop = asyncio.get_running_loop()
+        self._ready_condition = asyncio.Condition()
+        self._build_queue = asyncio.Queue(maxsize=self.build_workers * QUEUE_SIZE_PER_WORKER)
+
+        with ThreadPoolExecutor(self.fetch_workers, thread_name_prefix="parse") as parse_executor, \
+                ThreadPoolExecutor(self.dispatch_workers, thread_name_prefix="dispatch") as dispatch_executor:
+            builders = [asyncio.create_task(self._build(loop, parse_executor)) for _ in range(self.build_workers)]
+            deliverers = [asyncio.create_task(self._deliver_to(patchook, loop, dispatch_executor)) for patchook in self.patchooks]
+            try:
+                source_urls = list(oldest_announced_versions)
+                results = await asyncio.gather(
+                    *(self._scrape(source_url, oldest_announced_versions[source_url], fingerprint) for source_url in source_urls),
+                    return_exceptions=True
+                )
+
+                sources = []
+                remaining = config.get("max_announcements_per_webhook", DEFAULT_MAX_ANNOUNCEMENTS)
+                for source_url, result in zip(source_urls, results):
+                    if isinstance(result, Exception):
+                        print(f"[Error] Failed to scrape the source {source_url}!", result)
+                    elif result:
+                        # Like the sync engine, just the newest posts are announced, from the first sources first.
+                        if len(result) > remaining:
+                            print(f"[Warn] Will announce just the newest {remaining} post(s) from source {source_url}.")
+                            result = result[len(result) - remaining:]
+                        if result:
+                            remaining -= len(result)
+                            sources.append(deque(self._queue(source_url, result)))
+
+                await self._merge(sources)
+            finally:
+                async with self._ready_condition:
+                    self.finished = True
+                    self._ready_condition.notify_all()
+
+                await asyncio.gather(*self._feeders)
+                for _ in builders:
+                    await self._build_queue.put(None)
+                await asyncio.gather(*builders, *deliverers)
+
+        video_info_cache.save()
+        embed_link_cache.save()
+        web_scraper.post_cache.save()
+
+        if not self.ready:
+            print("No newer posts were found.")
+        return self.ready
+
+    async def _scrape(self, source_url: str, version: int, fingerprint: str) -> list[dict]:
+        """
+        Scan the listing of the source for the candidates of the new posts.
+
+        :return: The candidates, from the oldest.
+        """
+
+        print("[Info] Looks like the oldest announced version we have for source ", source_url, " is", version)
+        if await asyncio.to_thread(web_scraper.is_source_up_to_date, source_url, version):
+            print("[Info] The RSS feed has no newer versions for source", source_url)
+            return []
+
+        known_ids = web_scraper.get_known_releases(source_url, fingerprint, get_announced_versions(self.patchooks, source_url))
+        candidates = await asyncio.to_thread(web_scraper.get_new_candidates, source_url, version, None, known_ids)
+        candidates.sort(key=_get_candidate_order) # The oldest first, so it is delivered first.
+        return candidates
+
+    def _queue(self, source_url: str, candidates: list[dict]) -> list[asyncio.Future]:
+        """Queue the candidates for the build workers and return the futures of their posts."""
+
+        loop = asyncio.get_running_loop()
+        slots = [(candidate, loop.create_future()) for candidate in candidates]
+        print(f"[Info] Fetching {len(slots)} post(s) from source {source_url}...")
+        self._feeders.append(asyncio.create_task(self._feed(slots)))
+        return [future for _, future in slots]
+
+    async def _feed(self, slots: list[tuple[dict, asyncio.Future]]):
+        for slot in slots:
+            await self._build_queue.put(slot) # Waits while the build workers are busy.
+
+    async def _build(self, loop: asyncio.AbstractEventLoop, parse_executor: ThreadPoolExecutor):
+        parse_pool = web_scraper.get_parse_pool()
+        while True:
+            slot = await self._build_queue.get()
+            if slot is None:
+                return
+
+            candidate, future = slot
+            try:
+                html = await asyncio.to_thread(web_scraper.get_post_html, candidate["url"])
+                if parse_pool is None:
+                    post = await loop.run_in_executor(parse_executor, web_scraper.build_post_from_html, candidate, html)
+                else:
+                    # The cached posts are not worth sending to the processes.
+                    hit, post = web_scraper.get_cached_post(candidate, html) if html is not None else (False, None)
+                    if not hit:
+                        result = await loop.run_in_executor(parse_pool, web_scraper.build_post_in_process, candidate, html)
+                        post = web_scraper.receive_post(result)
+            except Exception as err:
+                print(f"[Error] Failed to build the post {candidate['url']}!", err)
+                post = None
+            future.set_result(post)
+
+    async def _merge(self, sources: list[deque]):
+        """Pass the posts of all the sources to the delivery, sorted by their publish date."""
+
+        while True:
+            # The next post is the oldest of the oldest posts of each source.
+            for source in sources:
+                while source and await source[0] is None:
+                    source.popleft() # Skipped or failed
+
+            sources = [source for source in sources if source]
+            if not sources:
+                return
+
+            source = min(sources, key=lambda source: _get_post_order(source[0].result()))
+            post = source.popleft().result()
+            metrics.increment("posts_found")
+            async with self._ready_condition:
+                self.ready.append(post)
+                self._ready_condition.notify_all()
+
+    async def _deliver_to(self, patchook: Patchook, loop: asyncio.AbstractEventLoop, dispatch_executor: ThreadPoolExecutor):
+        """Deliver the ready posts to one webhook in order, an error stops announcing to this webhook."""
+
+        index = 0
+        while True:
+            async with self._ready_condition:
+                await self._ready_condition.wait_for(lambda: index < len(self.ready) or self.finished)
+                if index >= len(self.ready):
+                    return
+                post = self.ready[index]
+
+            index += 1
+            if not patchook.can_post(post):
+                continue
+
+            try:
+                await loop.run_in_executor(dispatch_executor, self.deliver, patchook, post)
+            except Exception as err:
+                print(f"[Error] Failed to announce the updates to webhook \"{patchook.name or patchook.url}\"!", err)
+                return
+
+
+def announce(patchooks: list[Patchook], oldest_announced_versions: dict, fingerprint: str, deliver, dispatch_workers: int) -> list[PostRecord]:
+    """
+    Announce the new posts from the sources with the asyncio engine.
+
+    :param oldest_announced_versions: Source URL -> the oldest version announced by any of the webhooks.
+    :param fingerprint: Fingerprint of the webhooks, see main.get_webhooks_fingerprint.
+    :param deliver: Function posting one post to one webhook, see main.announce_post.
+    :param dispatch_workers: Webhooks being posted to at once.
+    :return: The new posts, sorted from the oldest.
+    """
+
+    pipeline = Pipeline(patchooks, deliver, dispatch_workers)
+    return asyncio.run(pipeline.run(oldest_announced_versions, fingerprint))
@@ -10,16 +10,51 @@ CONFIG_PATH = "config.json"
 CONFIG_FILE = Path(environ["APP_DATA_DIR"]).joinpath(CONFIG_PATH).resolve()
 CONFIG_FILE.touch(exist_ok=True)
 
-try:
+def _read_config() -> dict:
     with open(CONFIG_FILE, 'r') as config_file:
         config_str = config_file.read()
         config_str = "\n".join([line for line in config_str.splitlines() if not line.strip().startswith("//")])
-        config = json.loads(config_str)
+        return json.loads(config_str)
+
+try:
+    config = _read_config()
+    config_mtime = CONFIG_FILE.stat().st_mtime
 except json.JSONDecodeError:
     print("[Error] Failed to load configuration file! Configuration file is empty or contains invalid JSON.")
     exit(-1)
 
 def save_config():
+    global config_mtime
+
     with open(CONFIG_FILE, 'w') as config_file:
         config_file.write(json.dumps(config, indent=4))
         print("[Info] Configuration file saved.")
+
+    config_mtime = CONFIG_FILE.stat().st_mtime # Our own changes do not need to be reloaded.
+
+def reload_config() -> bool:
+    """
+    Reload the configuration file if it was modified since it was loaded.
+
+    The config dictionary is updated in place, so all the modules importing it see the changes.
+    When the file contains invalid JSON, the current configuration is kept.
+
+    :return: True if the configuration was reloaded.
+    """
+    global config_mtime
+
+    mtime = CONFIG_FILE.stat().st_mtime
+    if mtime == config_mtime:
+        return False
+
+    config_mtime = mtime
+    try:
+        new_config = _read_config()
+    except json.JSONDecodeError:
+        print("[Error] Failed to reload configuration file! Keeping the current configuration.")
+        return False
+
+    config.clear()
+    config.update(new_config)
+    print("[Info] Configuration file reloaded.")
+    return True
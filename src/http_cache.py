@@ -0,0 +1,161 @@
+# Disk-backed HTTP response cache used for conditional GET requests to the forums.
+
+
+import json
+import os
+
+from hashlib import sha1
+from os import environ
+from pathlib import Path
+from threading import Lock
+
+import requests
+
+from config import config
+
+
+CACHE_DIR = Path(environ["APP_DATA_DIR"]).joinpath("cache", "http")
+DEFAULT_MAX_SIZE_MB = 64
+
+_lock = Lock()
+
+
+def _cache_config() -> dict:
+    return config.get("http_cache", {}) or {}
+
+
+def is_enabled() -> bool:
+    return _cache_config().get("enabled", True) is True
+
+
+def _entry_path(url: str) -> Path:
+    return CACHE_DIR.joinpath(sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+
+def lookup(url: str) -> dict | None:
+    """
+    Return the cached entry for the given URL.
+
+    Reading an entry marks it as recently used, which is what the LRU eviction is based on.
+
+    :param url: The URL of the cached response.
+    :return: A dictionary with the stored validators and body, or None if there is no entry.
+    """
+
+    path = _entry_path(url)
+    try:
+        with open(path, 'r', encoding="utf-8") as entry_file:
+            entry = json.load(entry_file)
+        os.utime(path)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+    return entry if entry.get("url") == url else None
+
+
+def conditional_headers(entry: dict) -> dict:
+    """
+    Return the If-None-Match/If-Modified-Since headers for revalidating the given entry.
+
+    :param entry: The cached entry returned by lookup.
+    :return: A dictionary with the request headers.
+    """
+
+    headers = {}
+    if not entry:
+        return headers
+
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+
+    return headers
+
+
+def store(url: str, response: requests.Response) -> None:
+    """
+    Store the response for the given URL if it carries any validators.
+
+    :param url: The requested URL.
+    :param response: The successful response to store.
+    """
+
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if not etag and not last_modified:
+        return # We would not be able to revalidate it anyway.
+
+    entry = {
+        "url": url,
+        "etag": etag,
+        "last_modified": last_modified,
+        "encoding": response.encoding,
+        "body": response.text,
+    }
+
+    path = _entry_path(url)
+    with _lock:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_suffix(".tmp")
+        with open(temp_path, 'w', encoding="utf-8") as entry_file:
+            json.dump(entry, entry_file)
+        os.replace(temp_path, path)
+
+        _evict()
+
+
+def revive(entry: dict, response: requests.Response) -> requests.Response:
+    """
+    Turn a 304 Not Modified response into a full response using the cached body.
+
+    :param entry: The cached entry the request was revalidating.
+    :param response: The 304 response.
+    :return: The same response object, now with status 200 and the cached body.
+    """
+
+    response.status_code = 200
+    response.reason = "OK (cached)"
+    response.encoding = entry.get("encoding") or "utf-8"
+    response._content = entry.get("body", "").encode(response.encoding)
+    response.from_cache = True
+    return response
+
+
+def _evict() -> None:
+    """Remove the least recently used entries until the cache fits into its size limit."""
+
+    max_size = _cache_config().get("max_size_mb", DEFAULT_MAX_SIZE_MB) * 1024 * 1024
+
+    entries = []
+    total_size = 0
+    for entry in os.scandir(CACHE_DIR):
+        if entry.is_file() and entry.name.endswith(".json"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+
+    if total_size <= max_size:
+        return
+
+    for _, size, path in sorted(entries):
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+
+        total_size -= size
+        if total_size <= max_size:
+            break
+
+
+def clear() -> None:
+    """Remove all the cached responses."""
+
+    with _lock:
+        if not CACHE_DIR.exists():
+            return
+
+        for entry in os.scandir(CACHE_DIR):
+            if entry.is_file():
+                os.remove(entry.path)
@@ -0,0 +1,121 @@
+# Shared HTTP client layer, so every outbound request reuses pooled keep-alive connections.
+
+import requests
+
+from threading import Lock
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+
+from config import config
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 30 # seconds
+
+# Hosts that are expected to respond quickly, so a stalled connection does not block the whole run.
+DEFAULT_HOST_TIMEOUTS = {
+    "discord.com": 15,
+    "noembed.com": 10,
+}
+
+_sessions: dict[str, requests.Session] = {}
+_sessions_lock = Lock()
+_mounts: dict[str, requests.adapters.BaseAdapter] = {} # Custom transports, see mount()
+
+
+def _http_config() -> dict:
+    return config.get("http", {}) or {}
+
+
+def get_timeout(url: str) -> float:
+    """
+    Return the timeout configured for the host of the given URL.
+
+    :param url: The URL the request is going to be sent to.
+    :return: Timeout in seconds.
+    """
+
+    http_config = _http_config()
+    host_timeouts = {**DEFAULT_HOST_TIMEOUTS, **http_config.get("host_timeouts", {})}
+    return host_timeouts.get(urlparse(url).hostname, http_config.get("timeout", DEFAULT_TIMEOUT))
+
+
+def get_session(url: str) -> requests.Session:
+    """
+    Return the shared session for the host of the given URL.
+
+    Each host gets its own session with a keep-alive connection pool,
+    so repeated requests to the same host skip the TCP and TLS handshake.
+
+    :param url: The URL the request is going to be sent to.
+    :return: requests.Session object.
+    """
+
+    host = urlparse(url).hostname or ""
+    session = _sessions.get(host)
+    if session is not None:
+        return session
+
+    with _sessions_lock:
+        if host not in _sessions:
+            pool_size = _http_config().get("pool_size", DEFAULT_POOL_SIZE)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            for prefix, custom_adapter in _mounts.items():
+                session.mount(prefix, custom_adapter)
+            _sessions[host] = session
+
+        return _sessions[host]
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Send a request through the pooled session of the target host.
+
+    :param method: HTTP method of the request.
+    :param url: The URL to send the request to.
+    :param kwargs: Additional arguments passed to requests.Session.request.
+    :return: requests.Response object.
+    """
+
+    kwargs.setdefault("timeout", get_timeout(url))
+    return get_session(url).request(method, url, **kwargs)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
+
+
+def patch(url: str, **kwargs) -> requests.Response:
+    return request("PATCH", url, **kwargs)
+
+
+def mount(prefix: str, adapter: requests.adapters.BaseAdapter) -> None:
+    """
+    Send all the requests to URLs starting with the prefix through the given adapter.
+
+    This is used to run Patchook against a local corpus, for example in the benchmarks.
+
+    :param prefix: URL prefix, for example "https://".
+    :param adapter: The transport adapter handling the requests.
+    """
+
+    with _sessions_lock:
+        _mounts[prefix] = adapter
+        for session in _sessions.values():
+            session.mount(prefix, adapter)
+
+
+def close():
+    """Close all the pooled sessions and their connections."""
+
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
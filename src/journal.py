@@ -0,0 +1,197 @@
+# Append-only journal of the delivered posts, so the progress survives a crash mid-announcing.
+# It also keeps the messages of the recent posts, so they can be edited when the notes are revised.
+
+
+import json
+import sqlite3
+
+from hashlib import sha1
+from os import environ
+from pathlib import Path
+from threading import Lock
+from time import time
+
+from config import config
+
+
+JOURNAL_FILE = Path(environ["APP_DATA_DIR"]).joinpath("journal.db")
+DEFAULT_COMPACT_AFTER = 100 # Superseded deliveries kept before folding them into config.json
+WATERMARK_CONFIG_KEY = "journal_watermark" # Last delivery folded into config.json, see Journal.get_last_id
+
+
+def get_webhook_key(webhook_url: str) -> str:
+    """Return the key identifying the webhook, the URL itself contains the webhook token."""
+
+    return sha1(webhook_url.encode("utf-8")).hexdigest()
+
+
+class Journal:
+    """
+    SQLite database (in WAL mode) with a row for each delivered post.
+
+    Every delivery is a single small insert, and the last announced versions
+    are folded back into config.json only once in a while, see compact().
+    """
+
+    def __init__(self, path: Path=JOURNAL_FILE):
+        self._lock = Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS deliveries (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    webhook_key TEXT NOT NULL,
+                    source_url TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    message_id TEXT,
+                    delivered_at REAL NOT NULL
+                )
+            """)
+            self._connection.execute("CREATE INDEX IF NOT EXISTS deliveries_webhook ON deliveries (webhook_key, source_url)")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    webhook_key TEXT NOT NULL,
+                    source_url TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    candidate TEXT NOT NULL,
+                    message_id TEXT NOT NULL,
+                    thread_id TEXT,
+                    record_digest TEXT NOT NULL,
+                    section_digests TEXT NOT NULL,
+                    delivered_at REAL NOT NULL,
+                    PRIMARY KEY (webhook_key, source_url, version)
+                )
+            """)
+
+    def record(self, webhook_url: str, source_url: str, version: int, message_id: str=None) -> None:
+        """Record a successful delivery of the post to the webhook."""
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO deliveries (webhook_key, source_url, version, message_id, delivered_at) VALUES (?, ?, ?, ?, ?)",
+                (get_webhook_key(webhook_url), source_url, version, message_id, time())
+            )
+
+    def record_message(self, webhook_url: str, source_url: str, version: int, candidate: dict, message_id: str,
+            thread_id: str, record_digest: str, section_digests: dict) -> None:
+        """
+        Remember the message the post was delivered as, so it can be edited later, see get_recent_messages.
+
+        :param candidate: The candidate the post is built from, see web_scraper.get_post_candidate.
+        :param thread_id: The thread of the message for the forum webhooks.
+        :param record_digest: See PostRecord.get_digest.
+        :param section_digests: Digest of each section of the message, see patchook.get_section_digests.
+        """
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (get_webhook_key(webhook_url), source_url, version, json.dumps(candidate), message_id, thread_id,
+                    record_digest, json.dumps(section_digests), time())
+            )
+
+    def update_message(self, message: dict, record_digest: str, section_digests: dict) -> None:
+        """Store the digests of the message returned by get_recent_messages after it was checked or edited."""
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE messages SET record_digest = ?, section_digests = ? WHERE webhook_key = ? AND source_url = ? AND version = ?",
+                (record_digest, json.dumps(section_digests), message["webhook_key"], message["source_url"], message["version"])
+            )
+
+    def get_recent_messages(self, since: float, source_urls: set[str]=None) -> list[dict]:
+        """
+        Return the messages delivered after the given time, from the oldest.
+
+        :param since: Time of the oldest delivery to return.
+        :param source_urls: Only return the messages of the posts from these sources, all if not set.
+        """
+
+        with self._lock:
+            rows = self._connection.execute("""
+                SELECT webhook_key, source_url, version, candidate, message_id, thread_id, record_digest, section_digests
+                FROM messages WHERE delivered_at > ? ORDER BY delivered_at
+            """, (since,)).fetchall()
+
+        messages = []
+        for webhook_key, source_url, version, candidate, message_id, thread_id, record_digest, section_digests in rows:
+            if source_urls is not None and source_url not in source_urls:
+                continue
+
+            messages.append({
+                "webhook_key": webhook_key,
+                "source_url": source_url,
+                "version": version,
+                "candidate": json.loads(candidate),
+                "message_id": message_id,
+                "thread_id": thread_id,
+                "record_digest": record_digest,
+                "section_digests": json.loads(section_digests),
+            })
+
+        return messages
+
+    def forget_messages(self, before: float) -> None:
+        """Drop the messages delivered before the given time, they are not going to be edited anymore."""
+
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM messages WHERE delivered_at <= ?", (before,))
+
+    def get_last_id(self) -> int:
+        """
+        Return the ID of the last recorded delivery, 0 if there is none.
+
+        It is saved to config.json together with the last announced versions (see WATERMARK_CONFIG_KEY),
+        so only the deliveries recorded after it are replayed on top of config.json.
+        """
+
+        with self._lock:
+            last_id, = self._connection.execute("SELECT COALESCE(MAX(id), 0) FROM deliveries").fetchone()
+
+        return last_id
+
+    def get_last_versions(self, webhook_url: str, after_id: int=0) -> dict[str, int]:
+        """
+        Return the highest delivered version for each source URL of the webhook.
+
+        :param webhook_url: The URL of the webhook.
+        :param after_id: Ignore the deliveries up to this ID, the ones already saved to config.json, see get_last_id.
+        """
+
+        with self._lock:
+            rows = self._connection.execute("""
+                SELECT source_url, MAX(version) FROM deliveries WHERE webhook_key = ? AND id > ? GROUP BY source_url
+            """, (get_webhook_key(webhook_url), after_id)).fetchall()
+
+        return {source_url: version for source_url, version in rows}
+
+    def needs_compaction(self) -> bool:
+        """Return whether enough deliveries were superseded to fold them into config.json."""
+
+        with self._lock:
+            superseded, = self._connection.execute(
+                "SELECT COUNT(*) - COUNT(DISTINCT webhook_key || ' ' || source_url) FROM deliveries"
+            ).fetchone()
+
+        return superseded >= config.get("journal_compact_after", DEFAULT_COMPACT_AFTER)
+
+    def compact(self) -> None:
+        """
+        Drop the superseded deliveries, keeping just the last one for each webhook and source.
+
+        Call this only after the last announced versions were saved to config.json.
+        """
+
+        with self._lock:
+            with self._connection:
+                self._connection.execute("""
+                    DELETE FROM deliveries WHERE id NOT IN (
+                        SELECT MAX(id) FROM deliveries GROUP BY webhook_key, source_url
+                    )
+                """)
+            self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)") # Outside of the transaction, or the table is locked
+
+
+journal = Journal()
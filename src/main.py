@@ -1,6 +1,11 @@
 #!/usr/bin/env python3
 
+import json
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from copy import deepcopy
+from hashlib import sha1
 from os import environ
 from pathlib import Path
 from time import sleep
@@ -8,11 +13,16 @@ from time import sleep
 environ["APP_DIR"] = str(Path(__file__).parent.parent.absolute())
 environ["APP_DATA_DIR"] = str(Path(environ["APP_DIR"]).joinpath("data"))
 
-from patchook import Patchook
-from post import Post
+from patchook import Patchook, get_announced_versions
+from post import PostRecord
+from scheduler import Scheduler
+from journal import journal, get_webhook_key, WATERMARK_CONFIG_KEY
+import async_engine
+import metrics
+import revisions
 import web_scraper
 
-from config import config, save_config
+from config import config, save_config, reload_config
 
 __version__ = "3.1"
 __author__  = "Fi7iP"
@@ -21,93 +31,209 @@ __author__  = "Fi7iP"
 # NOTE: Sometimes the updates are not properly posted in the Game Updates section,
 # this is where the RSS Feed could come in play, which is usually more accurate.
 # But using the RSS feed would mean we wouldn't be able to get the patch
-# tags like "beta" or "release".
+# tags like "beta" or "release", so it is only used for detecting new versions
+# and the listing is fetched only when the feed has something new.
 # The text could be taken from the RSS Feed as well, since it is formatted well enough if
 # if it doesn't seem like that.
 
 
-# The discord REST API rate limit is 16 requests/second.
-# So at most one request every 3 seconds.
-# Cooldown for sending the patches
-POST_COOLDOWN = config.get("post_cooldown", 5)
-COOLDOWN_FREQUENCY = 3 # Every X posts for "POST_COOLDOWN" seconds
-RETRY_AFTER_RESERVE = 60 # To compensate any clock drift
-RETRY_AFTER_DEFAULT = 60 - RETRY_AFTER_RESERVE
-GATEWAY_UNVAILABLE_SLEEP = 60
-RSS_FEED_URL = "https://forums.kleientertainment.com/rss/6-dont-starve-together-updates.xml/?member_id=1196151&key=bfcc886612d9c6a9b1e4eac9a5162e11"
-MAX_VERSIONS_TO_ANNOUNCE = config.get("max_announcements_per_webhook", 50)
+# The Discord API rate limits are handled by the rate_limiter based on the response headers,
+# so the posts are sent as soon as there is capacity for them.
+GATEWAY_UNVAILABLE_SLEEP = 60 # Maximal backoff when the gateway is unavailable
+GATEWAY_UNVAILABLE_MIN_SLEEP = 5
+DEFAULT_DISPATCH_WORKERS = 8 # Webhooks being posted to at once
+DEFAULT_ENGINE = "sync" # Or "async", see async_engine.py
+DEFAULT_MAX_ANNOUNCEMENTS = 50 # Per webhook and run, see max_announcements_per_webhook
 LIMIT_VERSION = 0 # Version where we should break at.
 
 #############################################
 
-def announce_new_versions(patchooks: list[Patchook]):
+def get_webhooks_fingerprint(patchooks: list[Patchook]) -> str:
+    """
+    Return a fingerprint of the webhooks, their tag rules and the messages to edit.
+
+    Whether a post is still needed depends on these, so the known releases
+    are forgotten whenever the fingerprint changes.
+    """
+
+    webhooks = sorted((
+        get_webhook_key(patchook.url),
+        str(patchook.config.get("ignore_tag_rule")),
+        json.dumps(patchook.config.get("version_to_message_id_map", {}), sort_keys=True),
+    ) for patchook in patchooks)
+    return sha1(json.dumps(webhooks).encode("utf-8")).hexdigest()
+
+
+def remember_known_releases(patchooks: list[Patchook], posts: list[PostRecord], fingerprint: str):
+    """
+    Remember the releases which were announced to or ignored by all the webhooks,
+    so the next runs skip them without fetching them again.
+
+    :param posts: The posts of this run, sorted from the oldest.
+    """
+
+    known_release_ids = {}
+    unsettled_sources = set()
+    for post in posts:
+        if not post.release_id or post.source_url in unsettled_sources:
+            continue
+
+        if any(patchook.can_post(post) for patchook in patchooks):
+            # Stop at the first release still needed by some webhook, so the newer ones are fetched again
+            # as well and a page made entirely of known releases always means the older ones are known too.
+            unsettled_sources.add(post.source_url)
+            continue
+
+        known_release_ids.setdefault(post.source_url, []).append(post.release_id)
+
+    for source_url, release_ids in known_release_ids.items():
+        web_scraper.add_known_releases(source_url, fingerprint, get_announced_versions(patchooks, source_url), release_ids)
+
+
+def announce_new_versions(patchooks: list[Patchook], sources: set[str]=None) -> list[PostRecord]:
+    """
+    Announce the new posts from all the sources to the given webhooks.
+
+    :param patchooks: The webhooks to announce the posts to.
+    :param sources: Only check these source URLs, all the sources if not set.
+    :return: The list of the new posts found.
+    """
+
     if len(patchooks) <= 0: # There is nothing for us to do.
-        return print("[Info] No enabled webhooks found.")
+        print("[Info] No enabled webhooks found.")
+        return []
 
     # We have to calculate all the patches we need to post and then sort them by their publishDate.
     # Skip disabled webhooks here since they are not going to post the updates anyway.
     oldest_announced_versions = {} # Oldest versions for each source_url
     for patchook in patchooks:
         for source_url, version in patchook.last_announced_version.items():
+            if sources is not None and source_url not in sources:
+                continue
+
             if version is not None and version < oldest_announced_versions.get(source_url, version + 1):
                 oldest_announced_versions[source_url] = version
 
     # We take all versions since some may be useful for one webhook and some for the others.
+    fingerprint = get_webhooks_fingerprint(patchooks)
+    workers = max(1, min(config.get("dispatch_workers", DEFAULT_DISPATCH_WORKERS), len(patchooks)))
+    engine = config.get("engine", DEFAULT_ENGINE)
+    if engine == "async":
+        patches_sorted = async_engine.announce(patchooks, oldest_announced_versions, fingerprint, announce_post, workers)
+    else:
+        if engine != "sync":
+            print(f"[Warn] Unknown engine \"{engine}\", using the sync engine instead.")
+        patches_sorted = _announce_sync(patchooks, oldest_announced_versions, fingerprint, workers)
+
+    remember_known_releases(patchooks, patches_sorted, fingerprint)
+    return patches_sorted
+
+
+def _announce_sync(patchooks: list[Patchook], oldest_announced_versions: dict, fingerprint: str, workers: int) -> list[PostRecord]:
+    # All the sources are scraped first, then the posts are announced.
     patches_to_post = []
     for source_url, version in oldest_announced_versions.items():
         print("[Info] Looks like the oldest announced version we have for source ", source_url, " is", version)
-        patches_to_post.extend(web_scraper.get_new_posts(source_url, version))
+        if web_scraper.is_source_up_to_date(source_url, version):
+            print("[Info] The RSS feed has no newer versions for source", source_url)
+            continue
+
+        known_ids = web_scraper.get_known_releases(source_url, fingerprint, get_announced_versions(patchooks, source_url))
+        patches_to_post.extend(web_scraper.get_new_posts(source_url, version, known_ids=known_ids))
 
     if len(patches_to_post) <= 0:
-        return print("No newer posts were found.")
+        print("No newer posts were found.")
+        return []
 
     print(f"[Info] Announcing {len(patches_to_post)} new post(s) to {len(patchooks)} webhooks...")
+    metrics.increment("posts_found", len(patches_to_post))
 
-    if len(patches_to_post) > MAX_VERSIONS_TO_ANNOUNCE:
-        print(f"[Warn] Will announce just the newest {MAX_VERSIONS_TO_ANNOUNCE} post(s) from the list.")
+    max_announcements = config.get("max_announcements_per_webhook", DEFAULT_MAX_ANNOUNCEMENTS)
+    if len(patches_to_post) > max_announcements:
+        print(f"[Warn] Will announce just the newest {max_announcements} post(s) from the list.")
 
     # Sort depending on post publish timestamp because we have patches from various sources.
-    patches_sorted: list[Post] = sorted(patches_to_post[:MAX_VERSIONS_TO_ANNOUNCE],
+    patches_sorted: list[PostRecord] = sorted(patches_to_post[:max_announcements],
         key=lambda post: post.publish_timestamp or post.version
     )
-    for patchook in patchooks:
-        for index, post in enumerate(patches_sorted):
-            if not patchook.can_post(post):
-                continue
+    # Each webhook gets its posts in order, but the webhooks are served concurrently
+    # so the last webhook in the config does not wait for all the others.
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(announce_to_webhook, patchook, patches_sorted): patchook for patchook in patchooks}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as err:
+                patchook = futures[future]
+                print(f"[Error] Failed to announce the updates to webhook \"{patchook.name or patchook.url}\"!", err)
 
-            # Continue even when some updates fail to be announced.
-            # try:
-            while True:
-                response = patchook.post(post)
-                if response is None or not response.ok:
-                    if response and response.status_code == 429:
-                        retry_after = int(response.headers.get("Retry-After", RETRY_AFTER_DEFAULT)) + RETRY_AFTER_RESERVE
-                        print(f"[Error] Discord API rate limit reached! Retrying in {retry_after} seconds...")
-                        sleep(retry_after)
-                    elif response and response.status_code == 502:
-                        print(f"[Error] Discord gateway unavailable! Retrying in {GATEWAY_UNVAILABLE_SLEEP} seconds...")
-                        sleep(GATEWAY_UNVAILABLE_SLEEP)
-                    else:
-                        raise Exception("[Error] Posting request returned an no-retry error status code! " + str(post))
-                else:
-                    break
-            # except Exception as err:
-            #     print("[Error] Failed to post the update on discord!", err)
-
-            # Rate limiting is handled per IP not per endpoint or webhook.
-            # Do not cooldown when this is the last post
-            if index < (len(patches_sorted) - 1) and (index + 1) % COOLDOWN_FREQUENCY == 0:
-                print(f"Cooling down for {POST_COOLDOWN} seconds!")
-                sleep(POST_COOLDOWN)
+    return patches_sorted
 
 
-def main():
+def announce_to_webhook(patchook: Patchook, posts: list[PostRecord]):
+    """
+    Post the given posts to one webhook, in the order they are given.
+
+    The last announced version of the webhook is updated after each successful post,
+    and an error stops announcing to this webhook so the order is never broken.
+    """
+
+    for post in posts:
+        if not patchook.can_post(post):
+            continue
+
+        # Continue even when some updates fail to be announced.
+        # try:
+        announce_post(patchook, post)
+        # except Exception as err:
+        #     print("[Error] Failed to post the update on discord!", err)
+
+
+def announce_post(patchook: Patchook, post: PostRecord):
+    """
+    Post one post to the webhook, retrying while Discord is rate limiting us or unavailable.
+    Raises an exception when the post is refused.
+    """
+
+    _send_with_retries(lambda: patchook.post(post), post)
+
+
+def edit_post(patchook: Patchook, post: PostRecord, message: dict):
+    """
+    Edit the message the post was delivered as, see revisions.recheck_recent_posts.
+    Raises an exception when the edit is refused.
+    """
+
+    _send_with_retries(lambda: patchook.edit(post, message["message_id"], message["thread_id"]), post)
+
+
+def _send_with_retries(send, post: PostRecord):
+    gateway_sleep = GATEWAY_UNVAILABLE_MIN_SLEEP
+    while True:
+        response = send()
+        if response is None or not response.ok:
+            if response is not None and response.status_code == 429:
+                # The rate limiter already knows when the bucket resets and waits for it.
+                print("[Error] Discord API rate limit reached! Retrying once the limit resets...")
+                metrics.increment("discord_retries", reason="rate_limit")
+            elif response is not None and response.status_code == 502:
+                print(f"[Error] Discord gateway unavailable! Retrying in {gateway_sleep} seconds...")
+                metrics.increment("discord_retries", reason="gateway")
+                sleep(gateway_sleep)
+                gateway_sleep = min(gateway_sleep * 2, GATEWAY_UNVAILABLE_SLEEP)
+            else:
+                raise Exception("[Error] Posting request returned an no-retry error status code! " + str(post))
+        else:
+            break
+
+
+def create_patchooks() -> list[Patchook]:
     webhook_configs: list = config.get('webhooks', [])
     if not webhook_configs: # There is nothing for us to do.
-        return print("[Warn] No webhooks found. Add some in your config.json file!\nCheck the example_config.json for reference.")
+        print("[Warn] No webhooks found. Add some in your config.json file!\nCheck the example_config.json for reference.")
+        return []
 
-    original_webhook_configs = deepcopy(webhook_configs)
-    patchooks: list[Patchook] = []
+    enabled_webhook_configs = []
     for webhook_config in webhook_configs:
         if webhook_config.get("enabled", True) is False: # All webhooks are enabled by default
             name = webhook_config.get("name", webhook_config.get("url"))
@@ -115,23 +241,127 @@ def main():
             print(f"[Info] Webhook \"{name}\" from guild \"{guild}\" is disabled. Skipping...")
             continue
 
-        patchooks.append(Patchook(webhook_config))
+        enabled_webhook_configs.append(webhook_config)
 
-    announce_new_versions(patchooks)
+    if not enabled_webhook_configs:
+        return []
+
+    # The webhook metadata missing in the cache is fetched for all the webhooks at once.
+    workers = max(1, min(config.get("dispatch_workers", DEFAULT_DISPATCH_WORKERS), len(enabled_webhook_configs)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        patchooks: list[Patchook] = list(executor.map(Patchook, enabled_webhook_configs))
+    web_scraper.metadata_cache.save()
 
+    return patchooks
+
+
+def _without_versions(webhook_configs: list) -> list:
+    return [{key: value for key, value in webhook_config.items() if key != "last_announced_version"}
+        for webhook_config in webhook_configs]
+
+
+def _save_config():
+    # The saved versions include every delivery recorded so far, so only the newer ones are replayed from the journal.
+    config[WATERMARK_CONFIG_KEY] = journal.get_last_id()
+    save_config()
+
+
+def save_webhook_configs(original_webhook_configs: list):
     if config.get('debug_mode', False):
         # In debug mode we do not override the configurations so we can test one update
         # multiple times without manually modifying the files back each time.
         print("[Warning]: Debug mode enabled! Configuration updates won't be saved.")
-    else:
-        if original_webhook_configs != webhook_configs:
-            print("[Info] Webhook configurations have changed during announcing process! Saving the updates...")
-            config["webhooks"] = webhook_configs
-            save_config()
+    elif journal.needs_compaction():
+        # The announced versions are recorded in the journal as they are posted,
+        # they are written to the config file just once in a while.
+        print("[Info] Compacting the announcement journal into the configuration file...")
+        _save_config()
+        journal.compact()
+    elif _without_versions(original_webhook_configs) != _without_versions(config.get('webhooks', [])):
+        print("[Info] Webhook configurations have changed during announcing process! Saving the updates...")
+        _save_config()
+
+
+def _end_run():
+    summary = metrics.end_run()
+    if summary["stages"]:
+        print(f"[Info] Time spent: {metrics.format_stages(summary)}")
+
+
+def run_once():
+    metrics.begin_run()
+    original_webhook_configs = deepcopy(config.get('webhooks', []))
+    patchooks = create_patchooks()
+    if not patchooks and not original_webhook_configs:
+        return
+
+    announce_new_versions(patchooks)
+    revisions.recheck_recent_posts(patchooks, edit_post)
+    save_webhook_configs(original_webhook_configs)
+    _end_run()
 
     print("[Info] Done!")
 
 
+def run_daemon():
+    """
+    Keep running and poll each source on its own adaptive interval.
+
+    The webhooks and all the in-memory caches stay warm between the polls,
+    the webhooks are recreated only when the config file changes.
+    """
+
+    print("[Info] Running in daemon mode. Press Ctrl+C to stop.")
+    metrics.start_http_server()
+    original_webhook_configs = deepcopy(config.get('webhooks', []))
+    patchooks = create_patchooks()
+    save_webhook_configs(original_webhook_configs)
+    polling_scheduler = Scheduler()
+
+    source_urls = set()
+    while True:
+        due_source_urls = set()
+        try:
+            if reload_config():
+                web_scraper.cached_newest_version.clear() # Do not start new webhooks from an outdated version.
+                web_scraper.reset_parse_pool() # Started again with the new config when needed.
+                original_webhook_configs = deepcopy(config.get('webhooks', []))
+                patchooks = create_patchooks()
+                save_webhook_configs(original_webhook_configs)
+                metrics.start_http_server() # In case it was just configured.
+
+            source_urls = {source_url for patchook in patchooks for source_url in patchook.last_announced_version}
+            due_source_urls = polling_scheduler.get_due(source_urls)
+            if due_source_urls:
+                metrics.begin_run()
+                original_webhook_configs = deepcopy(config.get('webhooks', []))
+                new_posts = announce_new_versions(patchooks, sources=due_source_urls)
+                polling_scheduler.on_polled(due_source_urls, {post.source_url for post in new_posts})
+                revisions.recheck_recent_posts(patchooks, edit_post, sources=due_source_urls)
+                save_webhook_configs(original_webhook_configs)
+                _end_run()
+        except Exception as err: # Keep the daemon alive, the next poll may succeed.
+            print("[Error] Polling failed!", err)
+            polling_scheduler.on_polled(due_source_urls, set())
+
+        sleep(polling_scheduler.get_sleep_time(source_urls))
+
+
+def main():
+    arg_parser = ArgumentParser(description="Discord webhook for posting updates from Klei forums.")
+    arg_parser.add_argument("--daemon", action="store_true",
+        help="keep running and poll the sources on adaptive intervals instead of checking once")
+    args = arg_parser.parse_args()
+
+    if args.daemon:
+        try:
+            run_daemon()
+        except KeyboardInterrupt:
+            print("[Info] Stopping the daemon...")
+    else:
+        run_once()
+
+
 
 if __name__ == "__main__":
     main()
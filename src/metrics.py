@@ -0,0 +1,261 @@
+# Timers and counters of the hot paths, exported in the Prometheus text format and as a JSON summary of each run.
+
+
+import json
+import os
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import environ
+from pathlib import Path
+from threading import Lock, Thread
+from time import perf_counter, time
+
+from config import config
+
+
+METRIC_PREFIX = "patchook_"
+DEFAULT_HTTP_HOST = "127.0.0.1"
+
+# Stages of the pipeline, so they are always exported in the same order.
+STAGES = (
+    "listing_fetch", "listing_parse", "post_fetch", "post_parse", "embed_resolve", "patch_notes_build",
+    "embed_render", "rate_limit_wait", "discord_send",
+)
+
+
+def _metrics_config() -> dict:
+    return config.get("metrics", {}) or {}
+
+
+def _get_path(name: str) -> Path:
+    # Relative paths are relative to the data directory.
+    return Path(environ["APP_DATA_DIR"]).joinpath(name)
+
+
+class _Stage:
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def to_dict(self) -> dict:
+        return {"count": self.count, "total_seconds": round(self.total, 6), "max_seconds": round(self.max, 6)}
+
+
+class _Registry:
+    def __init__(self):
+        self.stages: dict[str, _Stage] = {}
+        self.counters: dict[tuple, float] = {} # (name, sorted labels) -> value
+
+    def observe(self, stage: str, seconds: float) -> None:
+        self._get_stage(stage).add(seconds)
+
+    def merge(self, stage: str, entry: dict) -> None:
+        own_entry = self._get_stage(stage)
+        own_entry.count += entry["count"]
+        own_entry.total += entry["total_seconds"]
+        own_entry.max = max(own_entry.max, entry["max_seconds"])
+
+    def _get_stage(self, stage: str) -> _Stage:
+        entry = self.stages.get(stage)
+        if entry is None:
+            entry = self.stages[stage] = _Stage()
+        return entry
+
+    def increment(self, key: tuple, value: float) -> None:
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def to_dict(self) -> dict:
+        counters = {}
+        for (name, labels), value in self.counters.items():
+            label_str = ",".join(f"{label}={label_value}" for label, label_value in labels)
+            counters[f"{name}{{{label_str}}}" if label_str else name] = value
+
+        stages = sorted(self.stages, key=lambda stage: (STAGES.index(stage) if stage in STAGES else len(STAGES), stage))
+        return {
+            "stages": {stage: self.stages[stage].to_dict() for stage in stages},
+            "counters": counters,
+        }
+
+
+_lock = Lock()
+_total = _Registry()    # Since the start of the process, exported for Prometheus
+_run = _Registry()      # Since begin_run(), written to the run summary
+_run_started_at = time()
+_http_server = None
+
+
+def observe(stage: str, seconds: float) -> None:
+    """Record the time spent in the stage."""
+
+    with _lock:
+        _total.observe(stage, seconds)
+        _run.observe(stage, seconds)
+
+
+def merge_stages(stages: dict) -> None:
+    """Add the stages of a run summary from another process, see get_run_summary."""
+
+    with _lock:
+        for stage, entry in stages.items():
+            _total.merge(stage, entry)
+            _run.merge(stage, entry)
+
+
+@contextmanager
+def timed(stage: str):
+    """Measure the time spent in the with block as the given stage."""
+
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, perf_counter() - start)
+
+
+def increment(name: str, value: float=1, **labels) -> None:
+    """Increase the counter, labels can be used to split it, for example by the status code."""
+
+    key = (name, tuple(sorted((label, str(label_value)) for label, label_value in labels.items())))
+    with _lock:
+        _total.increment(key, value)
+        _run.increment(key, value)
+
+
+def begin_run() -> None:
+    """Start a new run, the run summary covers only what happens after this."""
+
+    global _run, _run_started_at
+
+    with _lock:
+        _run = _Registry()
+        _run_started_at = time()
+
+
+def get_run_summary() -> dict:
+    with _lock:
+        summary = _run.to_dict()
+    summary["started_at"] = _run_started_at
+    summary["duration_seconds"] = round(time() - _run_started_at, 3)
+    return summary
+
+
+def format_stages(summary: dict) -> str:
+    """Return a short human readable line with the time spent in each stage of the summary."""
+
+    return ", ".join(f"{stage} {entry['total_seconds']:.2f}s" for stage, entry in summary["stages"].items())
+
+
+def to_prometheus() -> str:
+    """Return all the metrics since the start of the process in the Prometheus text format."""
+
+    lines = [
+        f"# HELP {METRIC_PREFIX}stage_seconds Time spent in each stage of the pipeline.",
+        f"# TYPE {METRIC_PREFIX}stage_seconds summary",
+    ]
+    with _lock:
+        data = _total.to_dict()
+        counters = sorted(_total.counters.items())
+
+    for stage, entry in data["stages"].items():
+        lines.append(f'{METRIC_PREFIX}stage_seconds_sum{{stage="{stage}"}} {entry["total_seconds"]}')
+        lines.append(f'{METRIC_PREFIX}stage_seconds_count{{stage="{stage}"}} {entry["count"]}')
+
+    lines.append(f"# HELP {METRIC_PREFIX}stage_seconds_max Longest time spent in each stage of the pipeline.")
+    lines.append(f"# TYPE {METRIC_PREFIX}stage_seconds_max gauge")
+    for stage, entry in data["stages"].items():
+        lines.append(f'{METRIC_PREFIX}stage_seconds_max{{stage="{stage}"}} {entry["max_seconds"]}')
+
+    declared = set()
+    for (name, labels), value in counters:
+        metric = f"{METRIC_PREFIX}{name}_total"
+        if metric not in declared:
+            declared.add(metric)
+            lines.append(f"# TYPE {metric} counter")
+        label_str = ",".join(f'{label}="{label_value}"' for label, label_value in labels)
+        lines.append(f"{metric}{{{label_str}}} {value}" if label_str else f"{metric} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+def _write_atomic(path: Path, text: str) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_suffix(path.suffix + ".tmp")
+    with open(temp_path, 'w', encoding="utf-8") as output_file:
+        output_file.write(text)
+    os.replace(temp_path, path) # The collectors must never read a half written file.
+
+
+def end_run() -> dict:
+    """
+    Finish the run and write the configured outputs.
+
+    :return: The summary of the run.
+    """
+
+    summary = get_run_summary()
+    metrics_config = _metrics_config()
+    if not metrics_config.get("enabled", True):
+        return summary
+
+    try:
+        if metrics_config.get("summary_file"):
+            _write_atomic(_get_path(metrics_config["summary_file"]), json.dumps(summary, indent=4))
+        if metrics_config.get("prometheus_file"):
+            _write_atomic(_get_path(metrics_config["prometheus_file"]), to_prometheus())
+    except OSError as err:
+        print("[Warn] Failed to write the metrics!", err)
+
+    return summary
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = to_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scraped every few seconds, not worth printing.
+
+
+def start_http_server() -> bool:
+    """
+    Serve the metrics on http://<http_host>:<http_port>/metrics if the port is configured.
+
+    :return: True if the server is running.
+    """
+
+    global _http_server
+
+    metrics_config = _metrics_config()
+    port = metrics_config.get("http_port")
+    if _http_server is not None or not port or not metrics_config.get("enabled", True):
+        return _http_server is not None
+
+    host = metrics_config.get("http_host", DEFAULT_HTTP_HOST)
+    try:
+        _http_server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as err:
+        print(f"[Error] Failed to serve the metrics on {host}:{port}!", err)
+        return False
+
+    _http_server.daemon_threads = True
+    Thread(target=_http_server.serve_forever, daemon=True).start()
+    print(f"[Info] Serving the metrics on http://{host}:{port}/metrics")
+    return True
@@ -1 +1 @@
-from .patch_notes import PatchNotes
+from .patch_notes import PatchNotes, VisitContext
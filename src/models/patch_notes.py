@@ -1,15 +1,30 @@
-import requests
 import re
+import requests
 
 
 from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 from bs4 import BeautifulSoup, Tag, NavigableString
 
+import http_client
+import metrics
+from config import config
+from parsing import make_soup
+from persistent_cache import PersistentCache
+
 # Constants
 SPOILER_CLASS_NAME = "ipsSpoiler"
 SPOILER_HEADER_CLASS_NAME = "ipsSpoiler_header"
 TITLE_CLASS_NAME = "ipsType_pageTitle"
 EMBED_CLASS_NAME = "ipsEmbed_finishedLoading"
+EMBED_HEADER_CLASS_NAME = "ipsRichEmbed_header ipsAreaBackground_light ipsClearfix"
+EMBED_OPEN_ITEM_CLASS_NAME = "ipsRichEmbed_openItem"
+
+EMBED_TIMEOUT = 10                  # An embed is not worth stalling the whole post for
+EMBED_LINK_TTL = 30 * 24 * 3600     # The embedded topics do not move
+EMBED_LINK_NEGATIVE_TTL = 3600
+DEFAULT_EMBED_LINK_CACHE_SIZE = 1000
+EMBED_WORKERS = 4
 
 FORMAT_CHARS = [
     "*",
@@ -46,6 +61,76 @@ IDENT_LEVEL_SPACES = "  "
 DEFAULT_FONT_SIZE = 13
 DEFAULT_MARGIN_LEFT = 0
 
+# Embed iframe src -> link to the embedded item (or None if it could not be found), kept between the runs.
+embed_link_cache = PersistentCache("embed_links", ttl=EMBED_LINK_TTL, negative_ttl=EMBED_LINK_NEGATIVE_TTL,
+    max_entries=lambda: config.get("embed_link_cache_size", DEFAULT_EMBED_LINK_CACHE_SIZE))
+_embed_executor = ThreadPoolExecutor(max_workers=EMBED_WORKERS, thread_name_prefix="embeds")
+
+
+def _get_fallback_embed_link(src: str) -> str:
+    # The embed is the item itself rendered with "?do=embed", so link the item when nothing better was found.
+    url = urlparse(src)
+    query = "&".join(param for param in url.query.split("&") if param and param != "do=embed")
+    return url._replace(query=query).geturl()
+
+
+def _find_embed_link(embed_soup: BeautifulSoup) -> str:
+    header = embed_soup.find('div', {'class': EMBED_HEADER_CLASS_NAME})
+    open_item = (header or embed_soup).find('a', {'class': EMBED_OPEN_ITEM_CLASS_NAME})
+    if open_item and open_item.get("href"):
+        return open_item.get("href")
+
+    og_url = embed_soup.find("meta", {"property": "og:url"})
+    return og_url.get("content") if og_url else None
+
+
+def resolve_embed_link(src: str) -> str:
+    """
+    Return the link to the item shown by the embed iframe.
+
+    The links are cached by the iframe src, and when the embed page cannot be fetched
+    or does not contain the link, the item is linked directly.
+
+    :param src: The src of the embed iframe.
+    :return: The URL of the embedded item.
+    """
+
+    hit, link = embed_link_cache.lookup(src)
+    if not hit:
+        link = None
+        try:
+            response = http_client.get(src, timeout=EMBED_TIMEOUT)
+            response.raise_for_status()
+        except requests.RequestException as err:
+            print(f"[Warn] Failed to fetch the embed '{src}'!", err)
+        else:
+            link = _find_embed_link(make_soup(response.text))
+
+        embed_link_cache.set(src, link)
+
+    return link or _get_fallback_embed_link(src)
+
+
+def resolve_embed_links(srcs) -> dict[str, str]:
+    """Resolve the links of all the embeds at once, returns a dictionary of src -> link."""
+
+    srcs = list(dict.fromkeys(srcs))
+    if len(srcs) <= 1:
+        return {src: resolve_embed_link(src) for src in srcs}
+
+    return dict(zip(srcs, _embed_executor.map(resolve_embed_link, srcs)))
+
+
+class VisitContext:
+    """State passed down from a node to its children during the PatchNotes traversal."""
+
+    __slots__ = ("depth", "indent")
+
+    def __init__(self, depth: int = 0, indent: bool = True):
+        self.depth = depth      # Nesting level of the unordered lists
+        self.indent = indent    # Whether the strings are still escaped and list items indented
+
+
 class PatchNotes:
     """
         Factory class for building nice formatted patchnotes from a string
@@ -53,8 +138,18 @@ class PatchNotes:
 
     notes: list[str]
 
+    # Handlers called while traversing, by tag name (None matches all tags), see register_handler.
+    enter_handlers: dict[str, list] = {}
+    # Handlers called after the traversal as (tag names or None, handler), in the order they are applied.
+    format_handlers: list[tuple] = []
+
     def __init__(self, obj: Tag):
-        self.notes = self._build(obj)
+        self._root = obj
+        self._title_removed = False
+        self._embeds: list[Tag] = []
+        self._embed_links = None
+        with metrics.timed("patch_notes_build"):
+            self.notes = self._build(obj)
 
     #######################
     ## Private
@@ -89,141 +184,255 @@ class PatchNotes:
         # Also replace non-break spaces with normal ones.
         return self._ddf(line.replace("\xa0", " ").replace("`", "ˋ"))
 
-    def _apply_identation(self, tag: Tag):
-        stack = [(tag, 0)]
+    def _visit(self, obj: Tag) -> list[Tag]:
+        """
+        Traverse the object once, depth-first, calling the enter handlers of each node before its children.
 
+        Returns:
+            list[Tag]: The tags left in the object, in the document order.
+        """
+
+        tags = []
+        stack = [(child, VisitContext()) for child in reversed(list(obj.children))]
         while stack:
-            tag, depth = stack.pop()
-            for child in tag.children:
-                if isinstance(child, NavigableString):
-                    child.replace_with(self._normalize_line(child))
-                    continue
+            node, context = stack.pop()
+            if isinstance(node, NavigableString):
+                if context.indent:
+                    node.replace_with(self._normalize_line(node))
+                continue
 
-                if not isinstance(child, Tag):
-                    continue
+            if not isinstance(node, Tag):
+                continue
 
-                if child.name == 'ul':
-                    stack.append((child, depth + 1))
-                    continue
+            context = VisitContext(context.depth, context.indent)
+            if self._dispatch(node, context):
+                continue # The node was removed, so skip its children.
 
-                # Replace just the first Navigable string here because we want to leave the tags untouched.
-                # TODO: Potencial support for "li" strings that start with a tag (e. g. <strong>)
-                if child.name == 'li' and isinstance(child.contents[0], NavigableString):
-                    child.contents[0].replace_with(
-                        ("\t\t" * depth) + child.contents[0].lstrip())
-                    continue
+            tags.append(node)
+            for child in reversed(list(node.children)):
+                stack.append((child, context))
 
-                stack.append((child, depth))
+        return tags
 
-    def _normalize_obj(self, obj: Tag):  # -> Tag:
-        # Remove the "Update Information" thing, it's always there so it's redundant.
-        title = obj.find('h2', {'class': TITLE_CLASS_NAME})
-        if title:
-            title.decompose()
+    def _dispatch(self, node: Tag, context: "VisitContext") -> bool:
+        for handler in self.enter_handlers.get(node.name, []) + self.enter_handlers.get(None, []):
+            if handler(self, node, context) or node.parent is None:
+                return True # Stop when the node gets removed or replaced.
 
-        self._apply_identation(obj)
+        return False
 
-        for block in obj.find_all("pre"):
-            if block.string:
-                block.string = BLOCK_START_CHAR + \
-                    block.string.replace(
-                        "\t", " " * TAB_SIZE) + BLOCK_START_CHAR
+    def _is_attached(self, node: Tag) -> bool:
+        # The tags replaced by the text of their parent are not part of the notes anymore.
+        # A decomposed tag has no parent either (Tag.decomposed would search the tag for it).
+        while node is not None:
+            if node is self._root:
+                return True
+            node = node.parent
 
-        # Remove all spoiler headers (the "Spoiler" text at the begining) from obj even nested
-        for spoiler_header in obj.find_all('div', {'class': SPOILER_HEADER_CLASS_NAME}):
-            spoiler_header.decompose()
+        return False
+
+    def _format(self, tags: list[Tag]) -> None:
+        """
+        Apply the format handlers one after another, each to all of its tags in the document order.
 
-        # for spoiler in obj.find_all("div", {"class": "ipsSpoiler"}):
-            # spoiler_content = spoiler.find("div", {"class": "ipsSpoiler_contents ipsClearfix"})
-            # if spoiler_content:
-            #     spoiler.replace_with(spoiler_content)
+        A handler sees the text already formatted by the handlers before it, like a separate pass over
+        the whole object would, the tags removed by them are skipped.
+        """
+
+        tags_by_name = {}
+        for index, tag in enumerate(tags):
+            tags_by_name.setdefault(tag.name, []).append((index, tag))
+
+        for tag_names, handler in self.format_handlers:
+            if tag_names is None:
+                handled_tags = tags
+            else:
+                handled_tags = [tag for _, tag in sorted(
+                    (entry for tag_name in tag_names for entry in tags_by_name.get(tag_name, ())), key=lambda entry: entry[0]
+                )]
+
+            for tag in handled_tags:
+                if self._is_attached(tag):
+                    handler(self, tag)
+
+    @classmethod
+    def register_handler(cls, tag_names, handler, on_enter: bool = False) -> None:
+        """
+        Register a handler that formats the nodes with the given tag names.
+
+        Args:
+            tag_names: The tag name or a tuple of them to handle, None for all tags.
+            handler: Callable taking the PatchNotes object and the node, and the VisitContext for the enter handlers.
+                Enter handlers return True when the node was removed and its children should be skipped.
+            on_enter (bool, optional): Call the handler while traversing, before the children are visited.
+                Otherwise it is called after the traversal, once all the handlers registered before it are done.
+        """
 
+        if isinstance(tag_names, str):
+            tag_names = (tag_names,)
 
-        for script in obj.find_all('script'): # Remove the scripts since we cannot display them.
-            script.decompose()
+        if not on_enter:
+            cls.format_handlers.append((None if tag_names is None else frozenset(tag_names), handler))
+            return
+
+        for tag_name in tag_names or (None,):
+            cls.enter_handlers.setdefault(tag_name, []).append(handler)
+
+    #######################
+    ## Handlers
+    #######################
+
+    def _remove_title(self, title: Tag, context: "VisitContext") -> bool:
+        # Remove the "Update Information" thing, it's always there so it's redundant.
+        if self._title_removed or TITLE_CLASS_NAME not in title.get("class", []):
+            return False
+
+        self._title_removed = True
+        title.decompose()
+        return True
+
+    def _remove(self, tag: Tag, context: "VisitContext") -> bool:
+        tag.decompose()
+        return True
+
+    def _remove_spoiler_header(self, div: Tag, context: "VisitContext") -> bool:
+        # Remove all spoiler headers (the "Spoiler" text at the begining) from obj even nested
+        if SPOILER_HEADER_CLASS_NAME in div.get("class", []):
+            return self._remove(div, context)
 
         # Those are the places where the scripts should be displayed.
         # Since we removed the scripts, we should remove those as well.
-        for included_content in obj.find_all('div', {'id': 'includedContent'}):
-            included_content.decompose()
+        if div.get("id") == "includedContent":
+            return self._remove(div, context)
 
         # unpack the spoiler (do not add any additional formatting here since it's unecessary confusing)
-        # for spoiler in obj.find_all("div", {"class": SPOILER_CLASS_NAME}):
-        #     for line in spoiler.find_all(text=True):
-        #         if line.strip():
-        #             line.replace_with(f"{line.lstrip()}")
-
-        # The images take too much space.
-        # for img in obj.find_all("img"):
-        #     image_url_raw = img.get("href") or img.get("src")
-        #     if img and image_url_raw:
-        #         img.replace_with(f"[[{img.get('alt', 'Image')}]](" + urlparse(image_url_raw, scheme='https').geturl() + ")")
-
+        # spoiler_content = div.find("div", {"class": "ipsSpoiler_contents ipsClearfix"})
+        # if spoiler_content:
+        #     div.replace_with(spoiler_content)
+
+        return False
+
+    def _indent_list(self, tag: Tag, context: "VisitContext") -> None:
+        if not context.indent:
+            return
+
+        if tag.name == 'ul':
+            context.depth += 1
+            return
+
+        # Replace just the first Navigable string here because we want to leave the tags untouched.
+        # TODO: Potencial support for "li" strings that start with a tag (e. g. <strong>)
+        if tag.contents and isinstance(tag.contents[0], NavigableString):
+            tag.contents[0].replace_with(
+                ("\t\t" * context.depth) + tag.contents[0].lstrip())
+            context.indent = False # The rest of the list item is left untouched.
+
+    def _format_code_block(self, block: Tag) -> None:
+        if block.string:
+            block.string = BLOCK_START_CHAR + \
+                block.string.replace(
+                    "\t", " " * TAB_SIZE) + BLOCK_START_CHAR
+
+    def _format_font_size(self, span: Tag) -> None:
         # Find all spans where they sent custom font size
-        for span in obj.find_all("span", style=lambda value: value and 'font-size' in value):
-            if not span.string or not span.string.strip():
-                continue
-
-            # Find the font-size value using regex
-            font_size_match = re.search(r'font-size:\s*(\d+)px', span["style"])
-            if font_size_match:
-                # Convert the matched value to an integer
-                font_size = int(font_size_match.group(1))
-                if font_size > DEFAULT_FONT_SIZE:
-                    span.string = "## " + span.string + "\n"
-                else:
-                    span.string = "-# " + span.string + "\n"
+        style = span.get("style")
+        if not style or 'font-size' not in style or not span.string or not span.string.strip():
+            return
+
+        # Find the font-size value using regex
+        font_size_match = re.search(r'font-size:\s*(\d+)px', style)
+        if font_size_match:
+            # Convert the matched value to an integer
+            font_size = int(font_size_match.group(1))
+            if font_size > DEFAULT_FONT_SIZE:
+                span.string = "## " + span.string + "\n"
+            else:
+                span.string = "-# " + span.string + "\n"
 
+    def _format_margin(self, p: Tag) -> None:
         # Handle margin overrides
-        for p in obj.find_all("p", style=lambda value: value and 'margin-left' in value):
-            margin_left_march = re.search(r'margin-left:\s*(\d+)px', p["style"])
-            if margin_left_march:
-                margin_left = int(margin_left_march.group(1))
-                if margin_left > DEFAULT_MARGIN_LEFT:
-                    p.string = '\n'.join([
-                        ("> " + line if line.strip() and not line.strip().startswith("> ") else line) for line in p.text.splitlines()
-                    ])
-
+        style = p.get("style")
+        if not style or 'margin-left' not in style:
+            return
+
+        margin_left_march = re.search(r'margin-left:\s*(\d+)px', style)
+        if margin_left_march:
+            margin_left = int(margin_left_march.group(1))
+            if margin_left > DEFAULT_MARGIN_LEFT:
+                p.string = '\n'.join([
+                    ("> " + line if line.strip() and not line.strip().startswith("> ") else line) for line in p.text.splitlines()
+                ])
+
+    def _is_embed(self, embed: Tag) -> bool:
+        # How can an embed exist without a link?
+        return EMBED_CLASS_NAME in embed.get("class", []) and bool(embed.get("src"))
+
+    def _collect_embed(self, embed: Tag, context: "VisitContext") -> None:
         # Handling embeds
-        for embed in obj.find_all('iframe', {'class': EMBED_CLASS_NAME}):
-            embed_link = embed.get("src")
-            if not embed_link: # How can an embed exist without a link?
-                continue
+        if self._is_embed(embed):
+            self._embeds.append(embed)
 
-            embed_soup = BeautifulSoup(requests.get(
-                embed_link).text, features='html.parser')
-            hyperlink = embed_soup.find('div', {'class': 'ipsRichEmbed_header ipsAreaBackground_light ipsClearfix'}).find(
-                'a', {'class': 'ipsRichEmbed_openItem'}).get("href")
-            embed.string = f" {hyperlink}"
+    def _format_embed(self, embed: Tag) -> None:
+        if not self._is_embed(embed):
+            return
 
-        # Replace emojis with their text representations.
-        for emoji in obj.find_all("img"):
-            text_emoji = emoji.get("title", emoji.get("alt"))
-            is_emoticon = emoji.get("data-emoticon", None)
-            if isinstance(text_emoji, str) and text_emoji.strip() and is_emoticon:
-                emoji.replace_with(text_emoji)
-
-        for hyperlink in obj.find_all('a'):
-            url = hyperlink.get('href')
-            if url and url.startswith("#"): # These are relative links within the page,
-                hyperlink.decompose()       # so remove them to save some space.
-                continue
+        if self._embed_links is None:
+            # The embeds still in the notes are resolved all at once, instead of one by one.
+            with metrics.timed("embed_resolve"):
+                self._embed_links = resolve_embed_links(embed.get("src") for embed in self._embeds if self._is_attached(embed))
 
-            if hyperlink.find("img"):
-                continue # Skip hyperlinks containing images.
+        embed_link = embed.get("src")
+        hyperlink = self._embed_links.get(embed_link) or resolve_embed_link(embed_link)
+        embed.string = f" {hyperlink}"
 
-            if hyperlink.string is None:
-                if url and url.startswith("http"):
-                    hyperlink.string = url.strip()
-                continue
+    def _format_emoji(self, emoji: Tag) -> None:
+        # Replace emojis with their text representations.
+        text_emoji = emoji.get("title", emoji.get("alt"))
+        is_emoticon = emoji.get("data-emoticon", None)
+        if isinstance(text_emoji, str) and text_emoji.strip() and is_emoticon:
+            emoji.replace_with(text_emoji)
 
-            if url and not hyperlink.string.strip().startswith("http"):
-                hyperlink.string.replace_with(f"{' ' if hyperlink.string.startswith(' ') else ''}[{self._iddf(hyperlink.string)}]({url})")
+        # The images take too much space.
+        # image_url_raw = emoji.get("href") or emoji.get("src")
+        # if image_url_raw:
+        #     emoji.replace_with(f"[[{emoji.get('alt', 'Image')}]](" + urlparse(image_url_raw, scheme='https').geturl() + ")")
+
+    def _format_hyperlink(self, hyperlink: Tag) -> None:
+        url = hyperlink.get('href')
+        if url and url.startswith("#"): # These are relative links within the page,
+            hyperlink.decompose()       # so remove them to save some space.
+            return
+
+        if hyperlink.find("img"):
+            return # Skip hyperlinks containing images.
+
+        if hyperlink.string is None:
+            if url and url.startswith("http"):
+                hyperlink.string = url.strip()
+            return
+
+        if url and not hyperlink.string.strip().startswith("http"):
+            hyperlink.string.replace_with(f"{' ' if hyperlink.string.startswith(' ') else ''}[{self._iddf(hyperlink.string)}]({url})")
+        else:
+            hyperlink.string.replace_with(hyperlink.string.strip())
+
+    def _format_line_break(self, line_breaker: Tag) -> None:
+        line_breaker.replace_with("\n")
+
+    def _apply_markdown(self, tag: Tag) -> None:
+        template = DISCORD_MARKDOWN_HTML.get(tag.name)
+        if tag.text is None or template is None:
+            return
+
+        string = ""
+        for line in tag.text.splitlines(True):
+            # No markdown for links, let discord handle that.
+            if line.strip() and not line.startswith("http"):
+                string += template.format(line.strip("\n"))
             else:
-                hyperlink.string.replace_with(hyperlink.string.strip())
+                string += line
 
-        for line_breaker in obj.find_all('br'):
-            line_breaker.replace_with("\n")
+        tag.string = string
 
     def _ddf(self, string: str) -> str:
         result = string
@@ -239,22 +448,6 @@ class PatchNotes:
 
         return result
 
-    def _apply_markdown(self, obj: Tag):  # -> Tag:
-        for tag in obj.find_all(DISCORD_MARKDOWN_HTML.keys()):
-            template = DISCORD_MARKDOWN_HTML.get(tag.name)
-            if tag.text is None or template is None:
-                continue
-
-            string = ""
-            for line in tag.text.splitlines(True):
-                # No markdown for links, let discord handle that.
-                if line.strip() and not line.startswith("http"):
-                    string += template.format(line.strip("\n"))
-                else:
-                    string += line
-
-            tag.string = string
-
     def _build(self, obj: Tag) -> list[str]:
         newline: bool = False
         last_ident: int = 0
@@ -262,8 +455,7 @@ class PatchNotes:
         block: bool = False
         last_text_index: int = 0
 
-        self._normalize_obj(obj)
-        self._apply_markdown(obj)
+        self._format(self._visit(obj))
 
         lines = obj.get_text().splitlines(True)
         for line in lines:
@@ -339,3 +531,23 @@ class PatchNotes:
             last_text_index = len(result) - 1
 
         return result
+
+
+# Entering the nodes, these remove what is not displayed and escape and indent the text before anything else.
+PatchNotes.register_handler("h2", PatchNotes._remove_title, on_enter=True)
+PatchNotes.register_handler("div", PatchNotes._remove_spoiler_header, on_enter=True)
+PatchNotes.register_handler("script", PatchNotes._remove, on_enter=True) # Remove the scripts since we cannot display them.
+PatchNotes.register_handler(("ul", "li"), PatchNotes._indent_list, on_enter=True)
+PatchNotes.register_handler("iframe", PatchNotes._collect_embed, on_enter=True)
+
+# After the traversal, in the order the formatting steps were always applied. The font sizes and margins
+# replace the content with its text, so the links and the markdown inside them are not formatted.
+# The markdown is a single handler for all its tags, so only the outermost one of the nested tags applies.
+PatchNotes.register_handler("pre", PatchNotes._format_code_block)
+PatchNotes.register_handler("span", PatchNotes._format_font_size)
+PatchNotes.register_handler("p", PatchNotes._format_margin)
+PatchNotes.register_handler("iframe", PatchNotes._format_embed)
+PatchNotes.register_handler("img", PatchNotes._format_emoji)
+PatchNotes.register_handler("a", PatchNotes._format_hyperlink)
+PatchNotes.register_handler("br", PatchNotes._format_line_break)
+PatchNotes.register_handler(tuple(DISCORD_MARKDOWN_HTML), PatchNotes._apply_markdown)
@@ -0,0 +1,77 @@
+# Selection of the HTML parser backend used for building the soups.
+
+
+from functools import lru_cache
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+from config import config
+
+
+AUTO_PARSER = "auto"
+FALLBACK_PARSER = "html.parser"
+
+LISTING_ITEM_CLASSES = {
+    "li": "cCmsRecord_row",     # Game updates listing
+    "div": "ipsDataItem_main",  # Forum topics listing
+}
+
+
+def _is_installed(parser: str) -> bool:
+    try:
+        BeautifulSoup("", features=parser)
+    except Exception: # bs4.FeatureNotFound
+        return False
+
+    return True
+
+
+@lru_cache(maxsize=None)
+def _select_parser(parser: str) -> str:
+    if parser == AUTO_PARSER:
+        return "lxml" if _is_installed("lxml") else FALLBACK_PARSER
+
+    if not _is_installed(parser):
+        print(f"[Warn] HTML parser \"{parser}\" is not installed! Falling back to \"{FALLBACK_PARSER}\"...")
+        return FALLBACK_PARSER
+
+    return parser
+
+
+def _is_listing_item(name: str, attrs: dict) -> bool:
+    class_name = LISTING_ITEM_CLASSES.get(name)
+    if class_name is None:
+        return False
+
+    classes = (attrs or {}).get("class") or ""
+    if isinstance(classes, str):
+        classes = classes.split()
+
+    return class_name in classes
+
+
+def get_parser() -> str:
+    """
+    Return the parser configured by "html_parser" in config.json.
+
+    By default lxml is used when it is installed since it is much faster
+    than the pure Python html.parser. Read on each use, so a config reload takes effect.
+    """
+
+    return _select_parser(config.get("html_parser", AUTO_PARSER))
+
+
+# Only the listing rows are turned into a tree, the rest of the forum page is skipped.
+LISTING_STRAINER = SoupStrainer(_is_listing_item)
+
+
+def make_soup(markup: str, parse_only: SoupStrainer=None) -> BeautifulSoup:
+    """
+    Build a BeautifulSoup object using the selected parser.
+
+    :param markup: The HTML to parse.
+    :param parse_only: Optional SoupStrainer restricting which parts of the document are parsed.
+    :return: BeautifulSoup object.
+    """
+
+    return BeautifulSoup(markup, features=get_parser(), parse_only=parse_only)
@@ -1,10 +1,49 @@
+import json
 import requests
 
-from post import Post, PostTag
+import http_client
+import metrics
+
+from hashlib import sha1
+
+from rate_limiter import discord_limiter
+
+from post import Post, PostTag, compile_tag_rule, get_render_profile, LINK_MODE_BUTTONS, LINK_MODE_HEADER
 from config import config
+from journal import journal, get_webhook_key, WATERMARK_CONFIG_KEY
 import web_scraper
 
 
+THREAD_FIELDS = ("thread_name", "applied_tags") # Only used when the thread is created, a message edit does not take them
+DEFAULT_SOURCE_URL = web_scraper.KLEI_DST_SOURCE_URL # Followed by the webhooks without any last_announced_version
+
+
+def get_section_digests(message: dict) -> dict[str, str]:
+    """
+    Return the digest of each section of the message, so the sections which changed can be told apart:
+    the embed (title, color, footer, ...), its description and each of its fields, the content and the buttons.
+    """
+
+    sections = {"content": message.get("content"), "buttons": message.get("components")}
+    for index, embed in enumerate(message.get("embeds", [])):
+        name = "embed" if index == 0 else f"embed {index + 1}"
+        sections[name] = {key: value for key, value in embed.items() if key not in ("description", "fields")}
+        sections[name + " description"] = embed.get("description")
+        for field_index, embed_field in enumerate(embed.get("fields", [])):
+            sections[f"{name} field {field_index + 1}"] = embed_field
+
+    return {
+        section: sha1(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
+        for section, value in sections.items() if value is not None
+    }
+
+
+def get_announced_versions(patchooks: list["Patchook"], source_url: str) -> dict[str, int]:
+    """Return the last announced version of the source for each of the webhooks, see web_scraper.get_known_releases."""
+
+    return {get_webhook_key(patchook.url): patchook.last_announced_version.get(source_url) for patchook in patchooks}
+
+
 class Patchook:
     """Class representing the webhook object for posting update post to Discord."""
 
@@ -15,7 +54,10 @@ class Patchook:
 
         self.config = webhook_config
 
+        # The tag rules are compiled just once, since they are checked for every post.
         self.ignore_tag_rule = self.config.get("ignore_tag_rule", None)
+        if self.ignore_tag_rule:
+            self.ignore_tag_rule = compile_tag_rule(self.ignore_tag_rule)
 
         self.available_tags = self.config.get("available_tags", None)
         self.url = self.config.get("url", None)
@@ -23,6 +65,8 @@ class Patchook:
             raise ValueError("Discord webhook URL is required. Please configure it for each webhook in config.json!")
 
         self.custom_fields = self.config.get("custom_fields", None)
+        if self.custom_fields:
+            self.custom_fields = [(compile_tag_rule(tag_rule), fields) for tag_rule, fields in self.custom_fields.items()]
         self.video_only = self.config.get("video_only", False)
         self.forum = self.config.get("forum", False)
         self.enabled = self.config.get("enabled", True)
@@ -48,6 +92,9 @@ class Patchook:
         if self.application_owned is None and self.info: # This is a constant and never changes without the token.
             self.application_owned = self.info.get("application_id", None) is not None
 
+        # Only owned applications can display message components.
+        self.render_profile = get_render_profile(self.config, LINK_MODE_BUTTONS if self.application_owned else LINK_MODE_HEADER)
+
         last_announce_version = self.config.get("last_announced_version", {})
         for key in list(last_announce_version):
             if not isinstance(last_announce_version[key], int):
@@ -57,15 +104,23 @@ class Patchook:
                 else:
                     del last_announce_version[key]
 
+        # The deliveries made since config.json was last saved are only in the journal,
+        # so a crashed run continues right after the last post it has sent.
+        last_announce_version.update(journal.get_last_versions(self.url, after_id=config.get(WATERMARK_CONFIG_KEY, 0)))
+
         if last_announce_version:
             self.last_announced_version = last_announce_version
+            self.config["last_announced_version"] = last_announce_version
         else: # Handling the case where no valid "last_announced_version" is saved.
-            last_online_version = web_scraper.get_newest_version(Post.DEFAULT_SOURCE_URL)
-            last_announce_version[Post.DEFAULT_SOURCE_URL] = last_online_version
+            self.last_announced_version = {} # Nothing to announce this run, but keep it per webhook.
+            last_online_version = web_scraper.get_newest_version(DEFAULT_SOURCE_URL)
+            last_announce_version[DEFAULT_SOURCE_URL] = last_online_version
             if last_online_version:
                 # We have successfully fetched the newest version so we start from here.
                 # No updates this run, therefore keep the last_announced_version dictionary empty.
                 self.config["last_announced_version"] = last_announce_version
+                if not config.get("debug_mode", False):
+                    journal.record(self.url, DEFAULT_SOURCE_URL, last_online_version)
             else:
                 print("Failed to fetch the newest version for Patchook", self.url, "\nPlease update \"last_announced_version\" field in the config JSON file manually.")
 
@@ -111,7 +166,31 @@ class Patchook:
         #     patch_dict["thread_id"] = thread_id
 
         response = self._make_request(post_dict, message_id=message_id)
-        self._handle_request_response_for_patch(response, post)
+        self._handle_request_response_for_patch(response, post, post_dict)
+
+        return response
+
+    def get_message(self, post: Post) -> dict:
+        """Return the message of the post as it is sent when editing it, without the fields of the thread."""
+
+        post_dict = self._build_patch_dict(post)
+        return {key: value for key, value in post_dict.items() if key not in THREAD_FIELDS}
+
+    def edit(self, post: Post, message_id: str, thread_id: str=None) -> requests.Response:
+        """
+        Replace the message the post was delivered as with the current rendering of the post.
+
+        :param message_id: The ID of the message, see journal.get_recent_messages.
+        :param thread_id: The thread of the message for the forum webhooks.
+        :return: requests.Response object.
+        """
+
+        response = self._make_request(self.get_message(post), message_id=message_id, thread_id=thread_id)
+        if response.ok:
+            print(f"[{response.status_code}] Successfully edited the message {message_id}!")
+            metrics.increment("messages_edited")
+        else:
+            print(f"[{response.status_code}]", response.reason, response.text or "")
 
         return response
 
@@ -143,7 +222,10 @@ class Patchook:
         Returns:
             Dictionary representing the post to be posted.
         """
-        patch_dict = post.to_dict(config=self.config)
+        # The embed is rendered once per render profile and shared between the webhooks,
+        # only the cheap per-webhook changes are applied on top of it here.
+        rendered = post.render(self.render_profile)
+        patch_dict = {"embeds": [dict(rendered["embed"])]}
         if self.forum:
             patch_dict["thread_name"] = patch_dict["embeds"][0]["title"]
 
@@ -151,17 +233,15 @@ class Patchook:
             sorted_tags = sorted(post.get_tags())
             patch_dict["applied_tags"] = [int(self.available_tags[tag.id]) for tag in sorted_tags if tag.id in self.available_tags]
 
-        if not (self.config.get("no_links") is True):
-            # Only owned applications can display message components.
-            if self.application_owned:
-                # An Action Row can contain up to 5 buttons.
-                # You can have up to 5 Action Rows per message
-                self.add_buttons(patch_dict, post.get_link_buttons())
-            else:
-                patch_dict["content"] = post.get_links_header()
+        if "buttons" in rendered:
+            # An Action Row can contain up to 5 buttons.
+            # You can have up to 5 Action Rows per message
+            self.add_buttons(patch_dict, rendered["buttons"])
+        elif "content" in rendered:
+            patch_dict["content"] = rendered["content"]
 
         if config.get("debug_mode", False) is True and self.forum is False:
-            patch_dict["content"] = "**TAGS:** " + " ".join("`" + tag.id.upper() + "`" for tag in post.tags) + ("\n" + patch_dict["content"] if "content" in patch_dict else "")
+            patch_dict["content"] = "**TAGS:** " + " ".join("`" + tag.id.upper() + "`" for tag in post.get_ordered_tags()) + ("\n" + patch_dict["content"] if "content" in patch_dict else "")
 
         _dict = self._add_custom_fields(post, patch_dict)
         return _dict
@@ -178,7 +258,7 @@ class Patchook:
         if not self.custom_fields:
             return post_dict # No changes
 
-        for tag_rule, fields in self.custom_fields.items():
+        for tag_rule, fields in self.custom_fields:
             if post.meets_tag_rule(tag_rule):
                 if "buttons" in fields and fields["buttons"] and "components" in post_dict:
                     self.add_buttons(post_dict, post.get_link_buttons(fields["buttons"]))
@@ -189,34 +269,67 @@ class Patchook:
 
         return post_dict
 
-    def _make_request(self, post_dict: dict, message_id: int=None) -> requests.Response:
+    def _make_request(self, post_dict: dict, message_id: int=None, thread_id: str=None) -> requests.Response:
         """Make request to Discord webhook with post dictionary.
 
         Args:
             patch_dict: Dictionary representing the post to be posted.
             message_id: Integer representing the message ID to edit. A new message will be created.
+            thread_id: The thread of the message to edit, required for the messages in threads.
 
         Returns:
             requests.Response object representing the request response.
         """
         # print(patch_dict)
-        if message_id is not None:
-            return requests.patch(url=self.url + f"/messages/{message_id}", json=post_dict, params={"wait": True})
+        # Waits until the webhook's bucket and the global limit allow sending the request.
+        # The edits have their own bucket on Discord's side, so they are tracked as a separate route.
+        route = self.url + "/messages" if message_id is not None else self.url
+        metrics.observe("rate_limit_wait", discord_limiter.acquire(route))
+        response = None
+        try:
+            with metrics.timed("discord_send"):
+                if message_id is not None:
+                    params = {"thread_id": thread_id} if thread_id else {}
+                    response = http_client.patch(self.url + f"/messages/{message_id}", json=post_dict, params={"wait": True, **params})
+                else:
+                    response = http_client.post(self.url, json=post_dict, params={"wait": True})
+        finally:
+            discord_limiter.update(route, response)
+
+        metrics.increment("discord_responses", status=response.status_code)
+        return response
 
-        return requests.post(url=self.url, json=post_dict, params={"wait": True})
+    def _get_response_message(self, response: requests.Response) -> dict:
+        try:
+            return response.json() or {}
+        except ValueError: # The response has no body without "wait".
+            return {}
 
-    def _handle_request_response_for_patch(self, response: requests.Response, post: Post) -> None:
+    def _handle_request_response_for_patch(self, response: requests.Response, post: Post, post_dict: dict) -> None:
         """Handle response from Discord webhook request.
 
         Args:
             response (requests.Response): Response from Discord webhook request.
             post (Post): Represents the post object receiving this response after being posted.
+            post_dict (dict): The message which was sent.
         """
         if response.ok:
             print(f"[{response.status_code}] Successfully posted the patchnotes!")
+            metrics.increment("posts_delivered")
 
             if (post.source_url and (post.version or post.release_id)):
-                self.last_announced_version[post.source_url] = post.release_id or post.version
-                self.config["last_announced_version"][post.source_url] = post.release_id or post.version
+                version = post.release_id or post.version
+                self.last_announced_version[post.source_url] = version
+                self.config["last_announced_version"][post.source_url] = version
+                if not config.get("debug_mode", False):
+                    # Saved right away, config.json is updated only once the journal is compacted.
+                    message = self._get_response_message(response)
+                    journal.record(self.url, post.source_url, version, message.get("id"))
+                    if message.get("id"):
+                        # Remembered so the message can be edited when the notes are revised, see revisions.py.
+                        # The message of a forum webhook is in the thread it created.
+                        journal.record_message(self.url, post.source_url, version, web_scraper.get_post_candidate(post),
+                            message["id"], message.get("channel_id") if self.forum else None, post.get_digest(),
+                            get_section_digests({key: value for key, value in post_dict.items() if key not in THREAD_FIELDS}))
         else:
             print(f"[{response.status_code}]", response.reason, response.text or "")
@@ -0,0 +1,129 @@
+# Small JSON-backed key/value cache with expiration, kept between the runs in APP_DATA_DIR.
+
+
+import json
+import os
+
+from os import environ
+from pathlib import Path
+from threading import Lock
+from time import time
+
+
+CACHE_DIR = Path(environ["APP_DATA_DIR"]).joinpath("cache")
+
+
+def _resolve(setting):
+    return setting() if callable(setting) else setting
+
+
+class PersistentCache:
+    """
+    Cache of JSON serializable values stored in APP_DATA_DIR/cache/<name>.json.
+
+    Entries expire after the given TTL. Values of None are negative entries
+    (for example failed lookups) and can have their own, usually shorter, TTL.
+    When max_entries is set, the least recently used entries are dropped.
+    The TTLs and max_entries can be functions returning the value, so the ones taken
+    from the config are read when they are used and follow the config reloads.
+    """
+
+    def __init__(self, name: str, ttl, negative_ttl=None, max_entries=None):
+        self.path = CACHE_DIR.joinpath(name + ".json")
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.max_entries = max_entries
+
+        self._lock = Lock()
+        self._dirty = False
+        self._changed: set[str] = set() # Keys set since the last pop_changes()
+        self._entries: dict[str, list] = {} # Key -> [expires_at, value], ordered from the least recently used
+        try:
+            with open(self.path, 'r', encoding="utf-8") as cache_file:
+                self._entries = json.load(cache_file)
+        except (OSError, json.JSONDecodeError):
+            pass
+
+    def lookup(self, key: str) -> tuple[bool, object]:
+        """
+        Return whether there is a fresh entry for the key and its value.
+
+        :param key: The key of the entry.
+        :return: A tuple (hit, value), the value can be None for negative entries.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+
+            expires_at, value = entry
+            if expires_at < time():
+                del self._entries[key]
+                self._dirty = True
+                return False, None
+
+            # Move it to the end, so it is the most recently used.
+            self._entries[key] = self._entries.pop(key)
+            return True, value
+
+    def get(self, key: str, default=None):
+        hit, value = self.lookup(key)
+        return value if hit else default
+
+    def set(self, key: str, value) -> None:
+        """Store the value, None is stored as a negative entry."""
+
+        ttl = _resolve(self.negative_ttl if value is None else self.ttl)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = [time() + ttl, value]
+            self._dirty = True
+            self._changed.add(key)
+
+            self._trim()
+
+    def pop_changes(self) -> dict:
+        """Return the entries set since the last call, so another process can add them with update()."""
+
+        with self._lock:
+            changes = {key: self._entries[key] for key in self._changed if key in self._entries}
+            self._changed.clear()
+            return changes
+
+    def update(self, changes: dict) -> None:
+        """Add the entries returned by pop_changes() of the same cache in another process."""
+
+        for key, (expires_at, value) in changes.items():
+            with self._lock:
+                self._entries.pop(key, None)
+                self._entries[key] = [expires_at, value]
+                self._dirty = True
+
+        with self._lock:
+            self._trim()
+
+    def _trim(self) -> None:
+        """Drop the least recently used entries over max_entries, the lock must be held."""
+
+        max_entries = _resolve(self.max_entries)
+        if max_entries is not None:
+            while len(self._entries) > max_entries:
+                del self._entries[next(iter(self._entries))]
+
+    def save(self) -> None:
+        """Write the cache to the disk if anything has changed."""
+
+        with self._lock:
+            if not self._dirty:
+                return
+
+            now = time()
+            entries = {key: entry for key, entry in self._entries.items() if entry[0] >= now}
+
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            temp_path = self.path.with_suffix(".tmp")
+            with open(temp_path, 'w', encoding="utf-8") as cache_file:
+                json.dump(entries, cache_file)
+            os.replace(temp_path, self.path)
+            self._dirty = False
@@ -1,20 +1,34 @@
-from json import loads as json_loads
-from bs4 import BeautifulSoup
+import requests
+
+from json import dumps as json_dumps, loads as json_loads
+from functools import lru_cache
+from hashlib import sha1
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field, fields
+from threading import Lock
+from bs4 import BeautifulSoup, NavigableString
 from models import PatchNotes
 from re import search, findall, compile, sub
-from requests import get
 from urllib.parse import urlparse
 
 from dateutil import parser
 
 from icons import Icons
 
+import http_client
+import metrics
+
+from config import config
+from persistent_cache import PersistentCache
+
 SECTION_CLASS_NAME = "ipsType_richText ipsType_normal"
 SPOILER_CLASS_NAME = "ipsSpoiler"
 TITLE_CLASS_NAME = "ipsType_pageTitle"
 EMBED_CLASS_NAME = "ipsEmbed_finishedLoading"
 BADGE_CLASS_NAME = "ipsBadge ipsBadge_icon ipsBadge_small ipsBadge_positive"
 VERSION_CLASS_NAME = "ipsType_sectionHead ipsType_break"
+PAGE_TITLE_CLASS_NAME = "ipsType_pageTitle ipsType_largeTitle ipsType_break"
+THUMBNAIL_CLASS_NAME = "ipsImage ipsImage_thumbnailed"
 
 YT_URL_PATTERN = r"(?:(?:https?:\/\/)?(?:youtu\.be\/|(?:www\.|m)\.?youtube(?:-nocookie)?\.com\/(?:watch|v|embed)(?:\.php)?(?:\?.*v=|\/)))([a-zA-Z0-9\_-]+)(?:\?.*)?"
 #YT_URL_PATTERN = "src"
@@ -58,14 +72,110 @@ DISCORD_MAX_FIELDS = 25
 DISCORD_MAX_TOTAL_CHARACTERS = 6000
 MAX_CONTENT_LEN = DISCORD_MAX_TOTAL_CHARACTERS - 250 # Reserve for title, author and footer
 
+# How the links of the post are rendered, see get_render_profile.
+LINK_MODE_NONE = "none"
+LINK_MODE_HEADER = "header"     # Hyperlinks in the message content
+LINK_MODE_BUTTONS = "buttons"   # Link buttons (for application owned webhooks only)
+
 REWARD_LINK_PATTERN = r'(http[s]?:\/\/accounts.klei.com\/link\/[^" \:\?\@\&\#\[\>\)\(\]\<\n\t\/]+)\"'
 
 GAME_NAME_NORMALIZED = "don't starve"
 
+# Increase with any change to the extraction or to the patch notes formatting,
+# so the records cached by web_scraper.post_cache are built again.
+RENDERER_VERSION = 2
+
+VIDEO_INFO_TTL = 30 * 24 * 3600     # The author and the title of a video never change
+VIDEO_INFO_NEGATIVE_TTL = 3600      # Failed lookups are retried after an hour
+VIDEO_INFO_KEYS = ("author_url", "title")
+DEFAULT_VIDEO_INFO_CACHE_SIZE = 1000
+VIDEO_INFO_WORKERS = 4
+
+# Video ID -> the noembed info of the video (or None if the lookup failed), kept between the runs.
+video_info_cache = PersistentCache("video_info", ttl=VIDEO_INFO_TTL, negative_ttl=VIDEO_INFO_NEGATIVE_TTL,
+    max_entries=lambda: config.get("video_info_cache_size", DEFAULT_VIDEO_INFO_CACHE_SIZE))
+_video_info_lookups: dict[str, Future] = {} # Lookups in progress, so each video is looked up only once
+_video_info_lock = Lock()
+_video_info_executor = ThreadPoolExecutor(max_workers=VIDEO_INFO_WORKERS, thread_name_prefix="noembed")
+
 # Helper functions
 
 def get_video_info(url) -> dict:
-    return get(YT_API_TEMPLATE.format(url)).json()
+    """
+    Fetch the info of the video from noembed.
+
+    :param url: The URL of the video.
+    :return: The info dictionary or None if the lookup failed.
+    """
+
+    try:
+        response = http_client.get(YT_API_TEMPLATE.format(url))
+        response.raise_for_status()
+        video_info = response.json()
+    except (requests.RequestException, ValueError) as err:
+        print(f"[Warn] Failed to fetch the video info for '{url}'!", err)
+        return None
+
+    if not isinstance(video_info, dict) or "error" in video_info: # noembed reports the errors with 200 OK
+        return None
+    return video_info
+
+
+def _lookup_video_info(video_id: str) -> dict:
+    video_info = get_video_info(YT_VIDEO_TEMPLATE.format(video_id))
+    if video_info is not None:
+        video_info = {key: video_info.get(key) for key in VIDEO_INFO_KEYS}
+
+    video_info_cache.set(video_id, video_info)
+    with _video_info_lock:
+        _video_info_lookups.pop(video_id, None)
+    return video_info
+
+
+def prefetch_video_info(video_id: str) -> Future:
+    """
+    Start looking up the video info in the background, unless it is cached or already being looked up.
+
+    :param video_id: The YouTube video ID.
+    :return: Future with the info dictionary, or None if the lookup failed.
+    """
+
+    hit, video_info = video_info_cache.lookup(video_id)
+    if hit:
+        future = Future()
+        future.set_result(video_info)
+        return future
+
+    with _video_info_lock:
+        future = _video_info_lookups.get(video_id)
+        if future is None:
+            future = _video_info_lookups[video_id] = _video_info_executor.submit(_lookup_video_info, video_id)
+        return future
+
+
+def get_video_id(html: str) -> str:
+    if "youtu" not in html:
+        return None # The pattern is slow to search, most of the pages have no video.
+    video_match = search(YT_URL_PATTERN, html)
+    return video_match and video_match[1] or None
+
+
+def get_render_profile(config: dict, link_mode: str=LINK_MODE_HEADER) -> tuple:
+    """
+    Return the normalized render profile for the given webhook configuration.
+
+    Only these settings affect how a post is rendered, so webhooks with the
+    same profile can share one rendering of the post.
+    """
+
+    if config.get("no_links") is True:
+        link_mode = LINK_MODE_NONE
+
+    return (
+        config.get("footer") is True,
+        min(config.get("max_patch_length", MAX_CONTENT_LEN), MAX_CONTENT_LEN),
+        link_mode,
+    )
 
 
 def get_embed_total_length(embed):
@@ -90,6 +200,7 @@ def get_embed_total_length(embed):
 class _PTag:
     id: str
     priority: int = DEFAULT_TAG_PRIORITY
+    bit: int = 0 # Assigned once all the tags are known, see PostTag.ALL
     data: dict
 
     def __init__(self, id, priority=DEFAULT_TAG_PRIORITY, **kwargs):
@@ -111,6 +222,10 @@ class _PTag:
     def get(self, name: str, default=None):
         return self.data.get(name, default)
 
+    def __reduce__(self):
+        # Unpickled as the same tag of PostTag, so the posts can be built in other processes.
+        return (get_tag, (self.id,))
+
 class PostTag: # The default category is "announcement"
     UPDATE      = _PTag("update", color=COLOR_ORANGE) # {"id": "update", "color": COLOR_ORANGE}
     HOTFIX      = _PTag("hotfix", color=COLOR_BROWN, priority=2,
@@ -140,182 +255,83 @@ class PostTag: # The default category is "announcement"
 PostTag.ALL = [f for f in PostTag.__dict__.values() if isinstance(f, _PTag)]
 PostTag.ALL_IDS = [tag.id for tag in PostTag.ALL]
 PostTag.TAG_BY_ID = {tag.id: tag for tag in PostTag.ALL}
+for index, tag in enumerate(PostTag.ALL):
+    tag.bit = 1 << index
 
-##################
+def get_tag(tag_id: str) -> _PTag:
+    return PostTag.TAG_BY_ID[tag_id]
 
-"""
-    Represents a post
-"""
-class Post:
+def get_tag_mask(tags) -> int:
+    mask = 0
+    for tag in tags:
+        mask |= tag.bit
+    return mask
 
-    url: str
-    video_url: str = ""
-    soup: BeautifulSoup
-    title: str
-    json: dict
-    tags: set[_PTag]
-    version: int = float("inf")
-    author: dict[str, str] = None
-    publish_date: str = ""
-    discussion_url: str = None
-    full_update_url: str = None
-    release_id: int = None # Speacial field for updates (eqaul to the rowId in the url)
-    notes: PatchNotes
+class TagRule:
+    """
+    Tag rule like "hotfix release? beta !major" compiled into bitmasks.
 
-    thumbnail_url: str = None
+    Tags without a suffix are required, tags with "!" are prohibited
+    and tags with "?" are optional (they do not affect the result).
+    """
 
-    publish_timestamp: int = None
+    __slots__ = ("rule", "required", "prohibited")
 
-    DEFAULT_AUTHOR_NAME = "Klei Entertainment"
-    DEFAULT_AUTHOR_ICON_URL = "https://cdn.discordapp.com/attachments/1066442901380403333/1334850877831516211/images.png"
-    DEFAULT_AUTHOR_URL = "https://forums.kleientertainment.com/"
-
-    def __init__(self, *tags, url: str, soup: BeautifulSoup, source_url: str=None, version: int=None) -> None:
-        self.tags = set([tag for tag in tags if isinstance(tag, _PTag)]) # This has to be defined here so it is unique for each post.
-
-        self.url = url
-        self.source_url = source_url
-        self.soup = soup
-
-        # <meta property="og:title" content="DST Update - Depths of Duplicity Now Live!">
-        title_element = self.soup.find("h1", {"class": "ipsType_pageTitle ipsType_largeTitle ipsType_break"})
-        self.title = title_element and title_element.text or None
-        if self.title is None:
-            self.title = self.soup.find("meta", property="og:title").get("content") if self.soup else ""
-
-        obj = self.soup.find('section', {'class': SECTION_CLASS_NAME}) if self.soup else None
-        # TODO: This could be potentially expanded here if we want more text.
-        #obj = self.soup.find('article') if self.soup else None
-        if not obj:
-            obj = self.soup.find("div", {"data-role": "commentContent"}) if self.soup else None
-
-        self.notes = PatchNotes(obj.__copy__()) if obj else None # using a copy so it doesn't overwrite the original soup
-        if self.soup:
-            self.json = json_loads("".join(self.soup.find("script", {"type":"application/ld+json"}).contents))
-
-            author_data = self.json.get("author", None)
-            author_name = author_data.get("name", "") if author_data else None # This is a required field by the discord API
-            self.author = {
-                "name":     author_name if author_name else Post.DEFAULT_AUTHOR_NAME,
-                "icon_url": urlparse(author_data['image'], scheme='https').geturl() if author_name else Post.DEFAULT_AUTHOR_ICON_URL,
-                "url":      urlparse(author_data['url'], scheme='https').geturl() if author_name else Post.DEFAULT_AUTHOR_URL,
-            }
-
-            self.publish_date = self.json.get("datePublished", "")
-
-        try:
-            self.publish_timestamp = int(parser.parse(self.publish_date).timestamp())
-        except (ValueError, TypeError) as e:
-            print(f"[Error] Failed to parse 'datePublished' for post {self.version}")
-            print(f"[Error] {e}")
-            self.publish_timestamp = None
-
-        self.version = version or self.publish_timestamp or self.version
-        self.rewardlinks = set(findall(REWARD_LINK_PATTERN, str(self.soup))) if self.soup else []
-        if self.rewardlinks:
-            self.add_tag(PostTag.REWARDLINKS)
-
-        article = None if not self.soup else (
-            self.soup.find("div", {"data-role": "commentContent"}) or self.soup.find('article') # Get the first article
-        )
+    def __init__(self, rule: str):
+        self.rule = rule
+        self.required = 0
+        self.prohibited = 0
 
-        # This is a bit more specific since the URL could match anything.
-        self.discussion_url = None
-        matches = article.find_all('a', href=FORUM_DISCUSSION_URL_PATTERN) if article else None
-        #print("\n".join(filter(None, [x.get("href") for x in article.find_all("a", recursive=False) if x.text == "Discussion Topic"])) if article else "")
-        if matches:
-            self.discussion_url = matches[-1].get("href")
-        if not self.has_tag(PostTag.UPDATE):
-            self.discussion_url = self.url
+        for tagid in (rule.split() if rule else []):
+            tagid = tagid.strip()
+            tag_name = tagid.strip("!").strip("?")
+            if not tag_name in PostTag.TAG_BY_ID:
+                print("[Warn] Post tag", tag_name, "is not valid!")
+                continue
 
-        self.full_update_url = None
-        match = search(compile(FULL_UPDATE_URL_PATTERN.format(self.version)), str(self.soup)) if self.soup else None
-        if match:
-            self.full_update_url = match.group()
+            bit = PostTag.TAG_BY_ID[tag_name].bit
+            if tagid.startswith("!") or tagid.endswith("!"):
+                self.prohibited |= bit
+            elif not (tagid.startswith("?") or tagid.endswith("?")):
+                self.required |= bit
 
-        self.video_url, self.thumbnail_url = self._get_trailer()
-        if self.thumbnail_url is None and article:
-            # We were not able to fetch the thumbnail from the video, so try to find
-            # the first image in the post and use that instead.
-            self.thumbnail_url = self._get_thumbnail(article)
+    def __repr__(self): return f"<TagRule \"{self.rule}\">"
 
-        twitch_drop_anim_html_url = search(TWITCH_DROP_ANIM_URL, str(self.soup)) if self.soup else None
-        if twitch_drop_anim_html_url is not None:
-            self.add_tag(PostTag.TWITCH_DROP)
+    def matches(self, tag_mask: int) -> bool:
+        # What is not prohibited is allowed, right?
+        return (tag_mask & self.required) == self.required and not (tag_mask & self.prohibited)
 
-            if twitch_drop_anim_html_url:
-                page = get(twitch_drop_anim_html_url.group())
-                if page.text is not None:
-                    img_match = search(TWITCH_DROP_IMAGE_URL_PATTERN, page.text)
-                    if img_match:
-                        self.thumbnail_url = img_match.group()
+@lru_cache(maxsize=None)
+def compile_tag_rule(tag_rule: str) -> TagRule:
+    return TagRule(tag_rule)
 
-        if not self.has_tag(PostTag.UPDATE):
-            self.add_tag(PostTag.ANNOUNCEMENT)
+##################
 
-        if self.has_tag(PostTag.UPDATE) and not self.has_tag(PostTag.HOTFIX) and not self.has_tag(PostTag.BETA):
-            self.add_tag(PostTag.RELEASE)
+class PostRenderMixin:
+    """
+    Rendering of the posts, shared by Post and PostRecord.
 
-        if "intermission" in str(self.title).lower():
-            self.add_tag(PostTag.INTERMISSION)
+    It uses only the extracted fields (url, title, author, publish_date, tags, tag_mask, discussion_url,
+    full_update_url, video_url, thumbnail_url, rewardlinks and the lines from get_note_lines),
+    the rendered embeds are memoized in _embed_cache and _render_cache.
+    """
 
-        if self.has_tag(PostTag.ANNOUNCEMENT) and KLEI_TWITCH_CHANNEL in str(article): self.add_tag(PostTag.DEV_STREAM)
-        if self.has_tag(PostTag.ANNOUNCEMENT) and "roadmap" in self.title.lower(): self.add_tag(PostTag.ROADMAP)
-
-        if self.has_tag(PostTag.ANNOUNCEMENT) and ("coming soon" in self.title.lower() or "coming next week" in self.title.lower()):
-            self.add_tag(PostTag.TEASER)
-
-        if isinstance(self.video_url, str) and len(self.video_url) > 0:
-            self.add_tag(PostTag.TRAILER)
+    __slots__ = ()
 
     def __str__(self) -> str:
         return f"<Post url={self.url} version={self.version}>"
 
-    #################################
-
-    def _get_trailer(self) -> str:
-        video_match = search(YT_URL_PATTERN, str(self.soup or ""))
-        video_id    = video_match and video_match[1] or None
-        video_url   = YT_VIDEO_TEMPLATE.format(video_id) if video_id else ""
-        thumbnail_url = None
-
-        if len(video_url) > 0:
-            video_info = get_video_info(video_url)
-            thumbnail_url = YT_VIDEO_THUMBNAIL_TEMPLATE.format(video_id = video_id)
-
-            # Make sure the video is from Klei
-            if video_info.get("author_url") != KLEI_YT_CHANNEL_URL:
-                return "", thumbnail_url
-
-            # Check if the video is about don't starve
-            if not GAME_NAME_NORMALIZED in video_info['title'].lower():
-                return "", thumbnail_url
-
-        return video_url, thumbnail_url
-
-    def _get_thumbnail(self, article) -> str:
-        thumbnail = article.find('img', {'class': 'ipsImage ipsImage_thumbnailed'})
-        thumbnail_url = thumbnail and thumbnail.get("src") or None
-        if not thumbnail_url:
-            image = article.find('img')
-            thumbnail_url = image.get("src") if image else None
-        # Get only first OR last image?
-        # if thumbnail is not None and thumbnail.parent:
-        #     for sibling in thumbnail.parent.previous_siblings:
-        #         if sibling.name == 'p' and sibling.text:
-        #             break
-        #     else:
-        #         thumbnail = None
+    def get_note_lines(self) -> tuple[str]:
+        return self.notes
 
-        if not thumbnail_url or not thumbnail_url.lower().endswith(('.png', '.gif', '.jpg', '.jpeg', '.webp')):
-            return
-
-        return urlparse(thumbnail_url, scheme='https').geturl()
+    def get_ordered_tags(self) -> list[_PTag]:
+        # The tags in the order of PostTag.ALL, the iteration order of a set differs between the processes.
+        return sorted(self.tags, key=lambda tag: tag.bit)
 
     def _get_tag_field(self, tag_field: str, default=None):
         highest_priority_yet = DEFAULT_TAG_PRIORITY
         value_yet = None
-        for tag in self.tags:
+        for tag in self.get_ordered_tags():
             if tag_field in tag and (
                 value_yet is None or tag.priority > highest_priority_yet
             ):
@@ -339,7 +355,7 @@ class Post:
         for rewardlink in self.rewardlinks:
             hyperlinks.append({"url": rewardlink, "text": "Klei Points/Spools", "icon": Icons.POINTS})
 
-        for tag in self.tags:
+        for tag in self.get_ordered_tags():
             hyperlinks.extend(tag.get("buttons", []))
 
         return [hyperlink for hyperlink in hyperlinks if hyperlink is not None]
@@ -350,40 +366,15 @@ class Post:
         return set(self.tags) # Returns a copy so this is read-only
 
     def has_tag(self, tag: _PTag) -> None:
-        return tag in self.tags if isinstance(tag, _PTag) else any(t.id == tag for t in self.tags)
-
-    def add_tag(self, tag: _PTag) -> None:
-        self.tags.add(tag)
+        if not isinstance(tag, _PTag):
+            tag = PostTag.TAG_BY_ID.get(tag)
+        return tag is not None and bool(self.tag_mask & tag.bit)
 
-    def add_tags(self, *tags: _PTag) -> "Post":
-        self.tags.update(tags)
-        return self
+    def meets_tag_rule(self, tag_rule: "str | TagRule") -> bool:
+        if not isinstance(tag_rule, TagRule):
+            tag_rule = compile_tag_rule(tag_rule)
 
-    def meets_tag_rule(self, tag_rule: str) -> bool:
-        rules = tag_rule.split() if tag_rule else []
-        if not rules:
-            return True # What is not prohibited is allowed, right?
-
-        tags_required, tags_prohibited, tags_optional = [], [], []
-        for tagid in rules:
-            tagid = tagid.strip()
-            tag_name = tagid.strip("!").strip("?")
-            if not tag_name in PostTag.ALL_IDS:
-                print("[Warn] Post tag", tag_name, "is not valid!")
-                continue
-
-            if tagid.startswith("!") or tagid.endswith("!"):
-                tags_prohibited.append(tag_name)
-            elif tagid.startswith("?") or tagid.endswith("?"):
-                tags_optional.append(tag_name)
-            else:
-                tags_required.append(tag_name)
-
-        return (
-            all(self.has_tag(tagid) for tagid in tags_required) and # All required tags!
-            not (any(self.has_tag(tagid) for tagid in tags_prohibited) and tags_prohibited)# and # No prohibited tags!
-            #all((tag.id in tags_required or tag.id in tags_optional) for tag in self.tags) # No redundant tags!
-        )
+        return tag_rule.matches(self.tag_mask)
 
     #################################
 
@@ -427,11 +418,46 @@ class Post:
 
         return buttons
 
+    def render(self, profile: tuple) -> dict:
+        """
+        Return the embed and links rendered for the given render profile.
+
+        The result is memoized, so webhooks sharing a profile share one rendering.
+        It must not be modified, copy it before applying any per-webhook changes.
+
+        :param profile: The profile returned by get_render_profile.
+        :return: A dictionary with the "embed" and either "content" or "buttons" with the links.
+        """
+
+        rendered = self._render_cache.get(profile)
+        if rendered is None:
+            has_footer, max_length, link_mode = profile
+            rendered = {"embed": self._render_embed(has_footer, max_length)}
+            if link_mode == LINK_MODE_BUTTONS:
+                rendered["buttons"] = self.get_link_buttons()
+            elif link_mode == LINK_MODE_HEADER:
+                rendered["content"] = self.get_links_header()
+
+            self._render_cache[profile] = rendered
+
+        return rendered
+
     def to_embed(self, config={}) -> dict:
+        has_footer, max_length, _ = get_render_profile(config)
+        return dict(self._render_embed(has_footer, max_length))
+
+    def _render_embed(self, has_footer: bool, max_length: int) -> dict:
+        embed = self._embed_cache.get((has_footer, max_length))
+        if embed is None:
+            with metrics.timed("embed_render"):
+                embed = self._embed_cache[(has_footer, max_length)] = self._build_embed(has_footer, max_length)
+
+        return embed
+
+    def _build_embed(self, has_footer: bool, max_length: int) -> dict:
         description: str = ""
         fields = []
         field_index = -1
-        has_footer = config.get("footer") is True
         # Keep one field for the footer!
         max_fields = DISCORD_MAX_FIELDS - 1 if has_footer else DISCORD_MAX_FIELDS
 
@@ -445,8 +471,8 @@ class Post:
 
         desc_footer = self.get_desc_footer()
         total_len = get_embed_total_length(embed) + len(desc_footer)
-        for note in (self.notes.notes if self.notes else []):
-            if (total_len + len(note)) >= min(config.get("max_patch_length", MAX_CONTENT_LEN), MAX_CONTENT_LEN):
+        for note in self.get_note_lines():
+            if (total_len + len(note)) >= max_length:
                 if fields:
                     fields[field_index]["value"] += "..."
                 else:
@@ -500,3 +526,381 @@ class Post:
 
     def to_dict(self, config={}) -> dict:
         return {"embeds": [self.to_embed(config)]}
+
+##################
+
+"""
+    Represents a post
+"""
+class Post(PostRenderMixin):
+
+    url: str
+    video_url: str = ""
+    soup: BeautifulSoup
+    title: str
+    json: dict
+    tag_mask: int = 0
+    version: int = float("inf")
+    author: dict[str, str] = None
+    publish_date: str = ""
+    discussion_url: str = None
+    full_update_url: str = None
+    release_id: int = None # Speacial field for updates (eqaul to the rowId in the url)
+    notes: PatchNotes
+
+    thumbnail_url: str = None
+
+    publish_timestamp: int = None
+
+    DEFAULT_AUTHOR_NAME = "Klei Entertainment"
+    DEFAULT_AUTHOR_ICON_URL = "https://cdn.discordapp.com/attachments/1066442901380403333/1334850877831516211/images.png"
+    DEFAULT_AUTHOR_URL = "https://forums.kleientertainment.com/"
+
+    def __init__(self, *tags, url: str, soup: BeautifulSoup, source_url: str=None, version: int=None) -> None:
+        self._embed_cache = {}  # Rendered embeds by (footer, max length)
+        self._render_cache = {} # Rendered embeds and links by render profile
+        self.tags = [tag for tag in tags if isinstance(tag, _PTag)] # This has to be defined here so it is unique for each post.
+
+        self.url = url
+        self.source_url = source_url
+        self.soup = soup
+
+        # Collect everything we need from the soup in one pass, so the page
+        # is serialized only once instead of for each pattern.
+        extracted = self._extract(self.soup)
+        html = extracted["html"]
+
+        # Start the noembed lookup right away, so it runs while the patch notes are built.
+        video_id = get_video_id(html)
+        if video_id:
+            prefetch_video_info(video_id)
+
+        # <meta property="og:title" content="DST Update - Depths of Duplicity Now Live!">
+        title_element = extracted["title"]
+        self.title = title_element and title_element.text or None
+        if self.title is None:
+            self.title = extracted["og_title"].get("content") if self.soup else ""
+
+        obj = extracted["section"]
+        # TODO: This could be potentially expanded here if we want more text.
+        #obj = self.soup.find('article') if self.soup else None
+        if not obj:
+            obj = extracted["comment_content"]
+
+        self.notes = PatchNotes(obj.__copy__()) if obj else None # using a copy so it doesn't overwrite the original soup
+        if self.soup:
+            self.json = json_loads("".join(extracted["ld_json"].contents))
+
+            author_data = self.json.get("author", None)
+            author_name = author_data.get("name", "") if author_data else None # This is a required field by the discord API
+            self.author = {
+                "name":     author_name if author_name else Post.DEFAULT_AUTHOR_NAME,
+                "icon_url": urlparse(author_data['image'], scheme='https').geturl() if author_name else Post.DEFAULT_AUTHOR_ICON_URL,
+                "url":      urlparse(author_data['url'], scheme='https').geturl() if author_name else Post.DEFAULT_AUTHOR_URL,
+            }
+
+            self.publish_date = self.json.get("datePublished", "")
+
+        try:
+            self.publish_timestamp = int(parser.parse(self.publish_date).timestamp())
+        except (ValueError, TypeError) as e:
+            print(f"[Error] Failed to parse 'datePublished' for post {self.version}")
+            print(f"[Error] {e}")
+            self.publish_timestamp = None
+
+        self.version = version or self.publish_timestamp or self.version
+        self.rewardlinks = set(findall(REWARD_LINK_PATTERN, html)) if self.soup else []
+        if self.rewardlinks:
+            self.add_tag(PostTag.REWARDLINKS)
+
+        article = extracted["comment_content"] or extracted["article"] # Get the first article
+        article_links = self._extract_article(article)
+
+        # This is a bit more specific since the URL could match anything.
+        self.discussion_url = None
+        matches = article_links["discussion_urls"]
+        #print("\n".join(filter(None, [x.get("href") for x in article.find_all("a", recursive=False) if x.text == "Discussion Topic"])) if article else "")
+        if matches:
+            self.discussion_url = matches[-1]
+        if not self.has_tag(PostTag.UPDATE):
+            self.discussion_url = self.url
+
+        self.full_update_url = None
+        match = search(compile(FULL_UPDATE_URL_PATTERN.format(self.version)), html) if self.soup else None
+        if match:
+            self.full_update_url = match.group()
+
+        self.video_url, self.thumbnail_url = self._get_trailer(video_id)
+        if self.thumbnail_url is None and article:
+            # We were not able to fetch the thumbnail from the video, so try to find
+            # the first image in the post and use that instead.
+            self.thumbnail_url = self._get_thumbnail(article_links)
+
+        twitch_drop_anim_html_url = search(TWITCH_DROP_ANIM_URL, html) if self.soup else None
+        if twitch_drop_anim_html_url is not None:
+            self.add_tag(PostTag.TWITCH_DROP)
+
+            if twitch_drop_anim_html_url:
+                page = http_client.get(twitch_drop_anim_html_url.group())
+                if page.text is not None:
+                    img_match = search(TWITCH_DROP_IMAGE_URL_PATTERN, page.text)
+                    if img_match:
+                        self.thumbnail_url = img_match.group()
+
+        if not self.has_tag(PostTag.UPDATE):
+            self.add_tag(PostTag.ANNOUNCEMENT)
+
+        if self.has_tag(PostTag.UPDATE) and not self.has_tag(PostTag.HOTFIX) and not self.has_tag(PostTag.BETA):
+            self.add_tag(PostTag.RELEASE)
+
+        if "intermission" in str(self.title).lower():
+            self.add_tag(PostTag.INTERMISSION)
+
+        if self.has_tag(PostTag.ANNOUNCEMENT) and article_links["mentions_twitch_channel"]: self.add_tag(PostTag.DEV_STREAM)
+        if self.has_tag(PostTag.ANNOUNCEMENT) and "roadmap" in self.title.lower(): self.add_tag(PostTag.ROADMAP)
+
+        if self.has_tag(PostTag.ANNOUNCEMENT) and ("coming soon" in self.title.lower() or "coming next week" in self.title.lower()):
+            self.add_tag(PostTag.TEASER)
+
+        if isinstance(self.video_url, str) and len(self.video_url) > 0:
+            self.add_tag(PostTag.TRAILER)
+
+        # Everything needed was extracted, do not keep the whole page around.
+        self.soup = None
+
+    #################################
+
+    def _extract(self, soup: BeautifulSoup) -> dict:
+        """Find all the elements Post needs in a single walk over the soup."""
+
+        extracted = {
+            "html": str(soup) if soup else "",
+            "title": None,
+            "og_title": None,
+            "section": None,
+            "comment_content": None,
+            "article": None,
+            "ld_json": None,
+        }
+        if not soup:
+            return extracted
+
+        for tag in soup.find_all(True):
+            name = tag.name
+            if name == "h1":
+                if extracted["title"] is None and " ".join(tag.get("class", [])) == PAGE_TITLE_CLASS_NAME:
+                    extracted["title"] = tag
+            elif name == "meta":
+                if extracted["og_title"] is None and tag.get("property") == "og:title":
+                    extracted["og_title"] = tag
+            elif name == "section":
+                if extracted["section"] is None and " ".join(tag.get("class", [])) == SECTION_CLASS_NAME:
+                    extracted["section"] = tag
+            elif name == "div":
+                if extracted["comment_content"] is None and tag.get("data-role") == "commentContent":
+                    extracted["comment_content"] = tag
+            elif name == "article":
+                if extracted["article"] is None:
+                    extracted["article"] = tag
+            elif name == "script":
+                if extracted["ld_json"] is None and tag.get("type") == "application/ld+json":
+                    extracted["ld_json"] = tag
+
+        return extracted
+
+    def _extract_article(self, article) -> dict:
+        """Collect the links, images and mentions from the article in a single walk."""
+
+        article_links = {
+            "discussion_urls": [],
+            "thumbnail_url": None,
+            "first_image_url": None,
+            "mentions_twitch_channel": False,
+        }
+        if not article:
+            return article_links
+
+        for element in article.descendants:
+            if isinstance(element, NavigableString):
+                if not article_links["mentions_twitch_channel"] and KLEI_TWITCH_CHANNEL in element:
+                    article_links["mentions_twitch_channel"] = True
+                continue
+
+            if not article_links["mentions_twitch_channel"] and any(
+                KLEI_TWITCH_CHANNEL in value for value in element.attrs.values() if isinstance(value, str)
+            ):
+                article_links["mentions_twitch_channel"] = True
+
+            if element.name == "a":
+                href = element.get("href")
+                if href and FORUM_DISCUSSION_URL_PATTERN.search(href):
+                    article_links["discussion_urls"].append(href)
+            elif element.name == "img":
+                if article_links["first_image_url"] is None:
+                    article_links["first_image_url"] = element.get("src") or ""
+                if article_links["thumbnail_url"] is None and " ".join(element.get("class", [])) == THUMBNAIL_CLASS_NAME:
+                    article_links["thumbnail_url"] = element.get("src") or ""
+
+        return article_links
+
+    def _get_trailer(self, video_id: str) -> str:
+        video_url   = YT_VIDEO_TEMPLATE.format(video_id) if video_id else ""
+        thumbnail_url = None
+
+        if len(video_url) > 0:
+            video_info = prefetch_video_info(video_id).result() # Usually done while the patch notes were built.
+            thumbnail_url = YT_VIDEO_THUMBNAIL_TEMPLATE.format(video_id = video_id)
+
+            # Make sure the video is from Klei
+            if not video_info or video_info.get("author_url") != KLEI_YT_CHANNEL_URL:
+                return "", thumbnail_url
+
+            # Check if the video is about don't starve
+            if not GAME_NAME_NORMALIZED in (video_info.get("title") or "").lower():
+                return "", thumbnail_url
+
+        return video_url, thumbnail_url
+
+    def _get_thumbnail(self, article_links: dict) -> str:
+        thumbnail_url = article_links["thumbnail_url"] or None
+        if not thumbnail_url:
+            thumbnail_url = article_links["first_image_url"] or None
+        # Get only first OR last image?
+        # if thumbnail is not None and thumbnail.parent:
+        #     for sibling in thumbnail.parent.previous_siblings:
+        #         if sibling.name == 'p' and sibling.text:
+        #             break
+        #     else:
+        #         thumbnail = None
+
+        if not thumbnail_url or not thumbnail_url.lower().endswith(('.png', '.gif', '.jpg', '.jpeg', '.webp')):
+            return
+
+        return urlparse(thumbnail_url, scheme='https').geturl()
+
+    @property
+    def tags(self) -> set[_PTag]:
+        return self._tags
+
+    @tags.setter
+    def tags(self, tags) -> None:
+        self._tags = set(tags)
+        self.tag_mask = get_tag_mask(self._tags)
+        self._clear_render_cache()
+
+    def add_tag(self, tag: _PTag) -> None:
+        self._tags.add(tag)
+        self.tag_mask |= tag.bit
+        self._clear_render_cache()
+
+    def add_tags(self, *tags: _PTag) -> "Post":
+        self._tags.update(tags)
+        self.tag_mask |= get_tag_mask(tags)
+        self._clear_render_cache()
+        return self
+
+    def get_note_lines(self) -> tuple[str]:
+        return tuple(self.notes.notes) if self.notes else ()
+
+    def freeze(self) -> "PostRecord":
+        """Return the immutable record of the post, with only what is needed to render and deliver it."""
+
+        return PostRecord(
+            url=self.url,
+            source_url=self.source_url,
+            title=self.title,
+            version=self.version,
+            release_id=self.release_id,
+            publish_date=self.publish_date,
+            publish_timestamp=self.publish_timestamp,
+            author=self.author,
+            tags=frozenset(self.tags),
+            tag_mask=self.tag_mask,
+            notes=self.get_note_lines(),
+            discussion_url=self.discussion_url,
+            full_update_url=self.full_update_url,
+            video_url=self.video_url,
+            thumbnail_url=self.thumbnail_url,
+            rewardlinks=tuple(sorted(self.rewardlinks)),
+        )
+
+    def get_digest(self) -> str:
+        """Return the digest of the post's record, see PostRecord.get_digest."""
+
+        return self.freeze().get_digest() # Not memoized, the tags of a post can still change.
+
+    def _clear_render_cache(self) -> None:
+        # The tags affect the color, title and links, so anything rendered before is outdated.
+        self._embed_cache.clear()
+        self._render_cache.clear()
+
+
+@dataclass(frozen=True, slots=True, eq=False)
+class PostRecord(PostRenderMixin):
+    """
+    What is left of a Post after the extraction, see Post.freeze().
+
+    Holds no soup, just a few KB per post, so the records can be kept for the whole run,
+    cached and sent between processes. Being immutable, the rendered embeds never get outdated.
+    """
+
+    url: str
+    source_url: str
+    title: str
+    version: int
+    release_id: int
+    publish_date: str
+    publish_timestamp: int
+    author: dict[str, str]
+    tags: frozenset[_PTag]
+    tag_mask: int
+    notes: tuple[str] = field(repr=False)
+    discussion_url: str
+    full_update_url: str
+    video_url: str
+    thumbnail_url: str
+    rewardlinks: tuple[str]
+
+    _embed_cache: dict = field(default_factory=dict, init=False, repr=False)  # Rendered embeds by (footer, max length)
+    _render_cache: dict = field(default_factory=dict, init=False, repr=False) # Rendered embeds and links by render profile
+    _digest: str = field(default=None, init=False, repr=False) # See get_digest()
+
+    def __reduce__(self):
+        # Pickled without the rendered embeds.
+        return (PostRecord, tuple(getattr(self, record_field.name) for record_field in fields(self) if record_field.init))
+
+    def get_digest(self) -> str:
+        """
+        Return the digest of the record and RENDERER_VERSION.
+        Anything rendered from the record can change only when the digest does.
+        """
+
+        if self._digest is None:
+            data = json_dumps([RENDERER_VERSION, self.serialize()], sort_keys=True)
+            object.__setattr__(self, "_digest", sha1(data.encode("utf-8")).hexdigest()) # Frozen, computed just once
+        return self._digest
+
+    def serialize(self) -> dict:
+        """Return the record as a JSON serializable dictionary, see deserialize()."""
+
+        data = {record_field.name: getattr(self, record_field.name) for record_field in fields(self) if record_field.init}
+        data["tags"] = sorted(tag.id for tag in self.tags)
+        data["notes"] = list(self.notes)
+        data["rewardlinks"] = list(self.rewardlinks)
+        return data
+
+    @classmethod
+    def deserialize(cls, data: dict) -> "PostRecord":
+        """
+        Return the record from the dictionary returned by serialize().
+        Raises KeyError if it is not complete or refers to an unknown tag.
+        """
+
+        data = dict(data)
+        data["tags"] = frozenset(get_tag(tag_id) for tag_id in data["tags"])
+        data["notes"] = tuple(data["notes"])
+        data["rewardlinks"] = tuple(data["rewardlinks"])
+        try:
+            return cls(**data)
+        except TypeError as err: # Missing or unexpected fields
+            raise KeyError(str(err))
@@ -0,0 +1,147 @@
+# Scheduler for the Discord API rate limits, based on the rate limit headers of the responses.
+# https://discord.com/developers/docs/topics/rate-limits
+
+
+from collections import deque
+from threading import Lock
+from time import monotonic, sleep
+
+import requests
+
+from config import config
+
+
+DEFAULT_GLOBAL_PER_SECOND = 50
+DEFAULT_RETRY_AFTER = 1 # When Discord does not tell us how long to wait
+RESET_RESERVE = 0.25 # Seconds added to every reset, the limits are reset on Discord's side not ours
+IN_FLIGHT_POLL = 0.05 # Seconds between the checks while waiting for the requests in flight
+
+
+def _get_global_per_second() -> int:
+    # Read on each request, so a config reload takes effect right away.
+    return (config.get("rate_limit", {}) or {}).get("global_per_second", DEFAULT_GLOBAL_PER_SECOND)
+
+
+class _Bucket:
+    remaining: int = 1
+    reset_at: float = 0 # monotonic() time
+
+    def __init__(self, remaining: int=1, reset_at: float=0):
+        self.remaining = remaining
+        self.reset_at = reset_at
+
+
+class RateLimiter:
+    """
+    Tracks the per-route buckets and the global limit of the Discord API.
+
+    Before each request call acquire() which waits only as long as needed,
+    and after each response call update() so the buckets follow the state
+    reported by Discord in the X-RateLimit-* headers.
+
+    A request counts towards the global limit from acquire() until a second after
+    its response, we do not know when exactly it reached Discord in between.
+    """
+
+    def __init__(self, global_per_second: int=None):
+        self.global_per_second = global_per_second # None follows the config, see _get_global_per_second
+        self._lock = Lock()
+        self._route_buckets: dict[str, str] = {} # Route -> bucket hash reported by Discord
+        self._buckets: dict[str, _Bucket] = {}
+        self._global_reset_at: float = 0
+        self._global_window: deque = deque() # Response times within the last second
+        self._global_in_flight = 0 # Requests acquired without a response yet
+
+    def _get_bucket(self, route: str) -> _Bucket:
+        bucket_id = self._route_buckets.get(route, route) # Each route is its own bucket until we know better.
+        bucket = self._buckets.get(bucket_id)
+        if bucket is None:
+            bucket = self._buckets[bucket_id] = _Bucket()
+        return bucket
+
+    def _get_wait(self, route: str, now: float) -> float:
+        while self._global_window and now - self._global_window[0] >= 1:
+            self._global_window.popleft()
+
+        wait = self._global_reset_at - now
+        global_per_second = self.global_per_second if self.global_per_second is not None else _get_global_per_second()
+        if len(self._global_window) + self._global_in_flight >= global_per_second:
+            if not self._global_window:
+                return max(wait, IN_FLIGHT_POLL) # All of the limit is used by the requests in flight
+            wait = max(wait, self._global_window[0] + 1 - now)
+
+        bucket = self._get_bucket(route)
+        if bucket.reset_at <= now:
+            bucket.remaining = max(bucket.remaining, 1) # The bucket was reset.
+        elif bucket.remaining <= 0:
+            wait = max(wait, bucket.reset_at - now)
+
+        return wait
+
+    def acquire(self, route: str) -> float:
+        """
+        Wait until a request can be sent to the given route and reserve it.
+
+        :param route: The route of the request, for example the webhook URL.
+        :return: The number of seconds spent waiting.
+        """
+
+        waited = 0
+        while True:
+            with self._lock:
+                now = monotonic()
+                wait = self._get_wait(route, now)
+                if wait <= 0:
+                    self._get_bucket(route).remaining -= 1
+                    self._global_in_flight += 1
+                    return waited
+
+            sleep(wait)
+            waited += wait
+
+    def update(self, route: str, response: requests.Response) -> None:
+        """
+        Update the buckets from the rate limit headers of the response.
+
+        :param route: The route the request was sent to.
+        :param response: The response of the request, None if the request failed.
+        """
+
+        with self._lock:
+            now = monotonic()
+            self._global_in_flight -= 1
+            self._global_window.append(now)
+            if response is None:
+                return
+
+            headers = response.headers
+
+            bucket_id = headers.get("X-RateLimit-Bucket")
+            if bucket_id:
+                self._route_buckets[route] = bucket_id
+
+            bucket = self._get_bucket(route)
+            if headers.get("X-RateLimit-Remaining") is not None:
+                bucket.remaining = int(headers["X-RateLimit-Remaining"])
+            if headers.get("X-RateLimit-Reset-After") is not None:
+                bucket.reset_at = now + float(headers["X-RateLimit-Reset-After"]) + RESET_RESERVE
+
+            if response.status_code != 429:
+                return
+
+            retry_after = headers.get("Retry-After")
+            try:
+                retry_after = float(retry_after if retry_after is not None else response.json().get("retry_after", DEFAULT_RETRY_AFTER))
+            except (ValueError, AttributeError):
+                retry_after = DEFAULT_RETRY_AFTER
+
+            reset_at = now + retry_after + RESET_RESERVE
+            if headers.get("X-RateLimit-Global", "").lower() == "true" or headers.get("X-RateLimit-Scope") == "global":
+                self._global_reset_at = max(self._global_reset_at, reset_at)
+            else:
+                bucket.remaining = 0
+                bucket.reset_at = max(bucket.reset_at, reset_at)
+
+
+# Shared by all the webhooks, since the global limit applies to all of them.
+discord_limiter = RateLimiter()
@@ -0,0 +1,98 @@
+# Editing the messages of the recently delivered posts in place when their notes are revised.
+#
+# Klei often corrects the notes after publishing. The pages of the posts delivered within the last recheck_hours
+# are fetched again on each run, which is cheap: the requests are conditional GETs (see http_cache) and a page
+# with the same notes is taken from the post cache without building the post again (see web_scraper.get_cached_post).
+# A post is rendered only when its record changed, and a message is edited only when some of its sections changed.
+
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import web_scraper
+
+from config import config
+from journal import journal, get_webhook_key
+from models.patch_notes import embed_link_cache
+from patchook import Patchook, get_section_digests
+from post import PostRecord, video_info_cache
+
+
+DEFAULT_RECHECK_HOURS = 48
+
+
+def _revisions_config() -> dict:
+    return config.get("revisions", {}) or {}
+
+
+def _get_current_post(candidate_data: dict) -> PostRecord | None:
+    candidate = web_scraper.load_candidate(candidate_data)
+    html = web_scraper.get_post_html(candidate["url"])
+    return web_scraper.build_post_from_html(candidate, html) if html is not None else None
+
+
+def _get_changed_sections(section_digests: dict, old_section_digests: dict) -> list[str]:
+    sections = set(section_digests) | set(old_section_digests)
+    return sorted(section for section in sections if section_digests.get(section) != old_section_digests.get(section))
+
+
+def recheck_recent_posts(patchooks: list[Patchook], edit, sources: set[str]=None) -> int:
+    """
+    Fetch the recently delivered posts again and edit the messages which would look different now.
+
+    :param patchooks: The webhooks, the messages delivered to the other webhooks are left alone.
+    :param edit: Function editing the message of one post on one webhook, raising an exception if it fails, see main.edit_post.
+    :param sources: Only recheck the posts from these source URLs, all the sources if not set.
+    :return: The number of edited messages.
+    """
+
+    revisions_config = _revisions_config()
+    since = time() - revisions_config.get("recheck_hours", DEFAULT_RECHECK_HOURS) * 3600
+    journal.forget_messages(before=since) # Too old to be edited, so the journal stays small.
+    if not revisions_config.get("enabled", True) or config.get("debug_mode", False):
+        return 0
+
+    patchooks_by_key = {get_webhook_key(patchook.url): patchook for patchook in patchooks}
+    messages_by_url = {} # Post URL -> its messages on all the webhooks
+    for message in journal.get_recent_messages(since, sources):
+        if message["webhook_key"] in patchooks_by_key:
+            messages_by_url.setdefault(message["candidate"]["url"], []).append(message)
+
+    if not messages_by_url:
+        return 0
+
+    print(f"[Info] Checking {len(messages_by_url)} recent post(s) for revisions...")
+    workers = max(1, min(config.get("fetch_workers", web_scraper.DEFAULT_FETCH_WORKERS), len(messages_by_url)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        posts = list(executor.map(_get_current_post, [messages[0]["candidate"] for messages in messages_by_url.values()]))
+
+    video_info_cache.save()
+    embed_link_cache.save()
+    web_scraper.post_cache.save()
+
+    edited = 0
+    for post, messages in zip(posts, messages_by_url.values()):
+        if post is None:
+            continue
+
+        record_digest = post.get_digest()
+        for message in messages:
+            if message["record_digest"] == record_digest:
+                continue # Nothing rendered from the post could have changed.
+
+            patchook = patchooks_by_key[message["webhook_key"]]
+            section_digests = get_section_digests(patchook.get_message(post))
+            changed_sections = _get_changed_sections(section_digests, message["section_digests"])
+            if changed_sections:
+                print(f"[Info] The post {post.url} was revised ({', '.join(changed_sections)}), "
+                    f"editing its message on webhook \"{patchook.name or patchook.url}\"...")
+                try:
+                    edit(patchook, post, message)
+                except Exception as err:
+                    print(f"[Error] Failed to edit the message {message['message_id']}!", err)
+                    continue # Tried again on the next run.
+
+                edited += 1
+
+            journal.update_message(message, record_digest, section_digests)
+
+    return edited
@@ -0,0 +1,80 @@
+# Adaptive polling schedule for the daemon mode, each source URL is polled on its own interval.
+
+
+from time import monotonic
+
+from config import config
+
+
+DEFAULT_MIN_INTERVAL = 60       # Right after a release, when the hotfixes usually follow
+DEFAULT_MAX_INTERVAL = 15 * 60  # When nothing has happened for a while
+DEFAULT_BACKOFF = 1.5           # How fast the interval grows while it's quiet
+
+
+def _daemon_config() -> dict:
+    return config.get("daemon", {}) or {}
+
+
+class SourceSchedule:
+    """Polling interval of one source URL."""
+
+    source_url: str
+    interval: float
+    next_poll_at: float = 0 # monotonic() time
+
+    def __init__(self, source_url: str):
+        self.source_url = source_url
+        self.interval = _daemon_config().get("min_interval", DEFAULT_MIN_INTERVAL)
+
+    def on_polled(self, found_new: bool, now: float) -> None:
+        daemon_config = _daemon_config()
+        min_interval = daemon_config.get("min_interval", DEFAULT_MIN_INTERVAL)
+        max_interval = daemon_config.get("max_interval", DEFAULT_MAX_INTERVAL)
+
+        if found_new:
+            self.interval = min_interval
+        else:
+            self.interval = min(self.interval * daemon_config.get("backoff", DEFAULT_BACKOFF), max_interval)
+
+        self.interval = max(self.interval, min_interval)
+        self.next_poll_at = now + self.interval
+
+
+class Scheduler:
+    """
+    Decides which sources should be polled and when.
+
+    A source is polled often right after a new post was found on it,
+    and its interval grows while it stays quiet.
+    """
+
+    def __init__(self):
+        self.schedules: dict[str, SourceSchedule] = {}
+
+    def _get_schedule(self, source_url: str) -> SourceSchedule:
+        schedule = self.schedules.get(source_url)
+        if schedule is None:
+            schedule = self.schedules[source_url] = SourceSchedule(source_url)
+        return schedule
+
+    def get_due(self, source_urls) -> set[str]:
+        """Return the source URLs that should be polled now."""
+
+        now = monotonic()
+        return {source_url for source_url in source_urls if self._get_schedule(source_url).next_poll_at <= now}
+
+    def on_polled(self, polled: set[str], with_new_posts: set[str]) -> None:
+        """Update the intervals of the polled sources."""
+
+        now = monotonic()
+        for source_url in polled:
+            self._get_schedule(source_url).on_polled(source_url in with_new_posts, now)
+
+    def get_sleep_time(self, source_urls) -> float:
+        """Return the number of seconds until the next source should be polled."""
+
+        if not source_urls:
+            return _daemon_config().get("max_interval", DEFAULT_MAX_INTERVAL)
+
+        next_poll_at = min(self._get_schedule(source_url).next_poll_at for source_url in source_urls)
+        return max(0, next_poll_at - monotonic())
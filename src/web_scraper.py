@@ -2,28 +2,60 @@ import requests
 import json
 import re
 
+import http_cache
+import metrics
+import http_client
+
 from dateutil import parser
 
+from hashlib import sha1
+from threading import Lock
 from time import sleep
-from bs4 import BeautifulSoup
-from post import Post, PostTag
+from xml.etree import ElementTree
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import get_context
+from os import cpu_count
+from bs4 import BeautifulSoup, Tag
+from post import Post, PostRecord, PostTag, RENDERER_VERSION, video_info_cache, get_video_id, \
+    REWARD_LINK_PATTERN, FULL_UPDATE_URL_PATTERN, TWITCH_DROP_ANIM_URL
+from models.patch_notes import embed_link_cache
+from parsing import make_soup, LISTING_STRAINER
 
 from config import config
+from persistent_cache import PersistentCache
 
 
 # URLs
 KLEI_DST_UPDATES = 'http://forums.kleientertainment.com/game-updates/dst/page/{}'
 DISCORD_API_BASE = "https://discord.com/api/v10"
+KLEI_DST_SOURCE_URL = "https://forums.kleientertainment.com/game-updates/dst"
+KLEI_DST_RSS_FEED_URL = "https://forums.kleientertainment.com/rss/6-dont-starve-together-updates.xml/?member_id=1196151&key=bfcc886612d9c6a9b1e4eac9a5162e11"
+DEFAULT_RSS_FEEDS = {KLEI_DST_SOURCE_URL: KLEI_DST_RSS_FEED_URL}
 # This doesn't contain beta versions!
 #DST_BUILDS = 's3.amazonaws.com/dstbuilds/builds.json'
 
 VERSION_CLASS_NAME = "ipsType_sectionHead ipsType_break"
+RSS_VERSION_PATTERN = re.compile(r'\/game-updates\/[^\/]+\/(\d+)-r\d+')
 MAX_ATTEMPTS = 3
 RETRY_AFTER = 60 # 1 minute
 
-MAX_FORUM_SEARCH_DEPTH = 1
+DEFAULT_METADATA_TTL_HOURS = 24
+WEBHOOK_METADATA_KEYS = ("guild_id", "name", "application_id", "channel_id")
 
-PARSER = "html.parser" # TODO: Update to lxml?
+MAX_FORUM_SEARCH_DEPTH = 1
+DEFAULT_FETCH_WORKERS = 4 # Post pages fetched and parsed at once
+KNOWN_RELEASES_TTL = 90 * 24 * 3600
+KNOWN_RELEASES_PER_SOURCE = 500
+PINNED_TITLE = "pinned"
+PINNED_ICON_CLASS_NAME = "fa-thumb-tack"
+DEFAULT_PARSE_PROCESSES = 0 # Build the posts in this process
+POST_CACHE_TTL = 30 * 24 * 3600
+DEFAULT_POST_CACHE_SIZE = 200
+ARTICLE_PATTERN = re.compile(r'<article\b.*?</article>', re.S)
+PAGE_TITLE_PATTERN = re.compile(r'<h1\b[^>]*>.*?</h1>', re.S)
+OG_TITLE_PATTERN = re.compile(r'<meta\b[^>]*og:title[^>]*>')
+LD_JSON_PATTERN = re.compile(r'<script\b[^>]*application/ld\+json[^>]*>.*?</script>', re.S)
+ANY_FULL_UPDATE_URL_PATTERN = re.compile(FULL_UPDATE_URL_PATTERN.format(r"\d+"))
 
 
 def get_source_url_page(url: str, page_number: int=1) -> BeautifulSoup:
@@ -35,12 +67,17 @@ def get_source_url_page(url: str, page_number: int=1) -> BeautifulSoup:
     :return: requests.Response object.
     """
 
-    response = _make_request(url + "/page/" + str(page_number))
+    with metrics.timed("listing_fetch"):
+        response = _make_request(url + "/page/" + str(page_number))
     if response is None:
-        return BeautifulSoup("", features=PARSER)
-    return BeautifulSoup(response.text, features=PARSER)
+        return make_soup("")
+    with metrics.timed("listing_parse"):
+        return make_soup(response.text, parse_only=LISTING_STRAINER)
 
 
+# Webhook and channel metadata kept between the runs, see get_webhook_info and get_channel_info.
+metadata_cache = PersistentCache("discord_metadata", ttl=lambda: config.get("metadata_ttl_hours", DEFAULT_METADATA_TTL_HOURS) * 3600)
+
 webhook_info_cache = {}
 def get_webhook_info(webhook_url: str, cache: bool=True) -> dict:
     """
@@ -61,7 +98,14 @@ def get_webhook_info(webhook_url: str, cache: bool=True) -> dict:
     if webhook_url in webhook_info_cache and cache is True:
         return webhook_info_cache[webhook_url]
 
-    response = _make_request(webhook_url)
+    # The URL contains the webhook token, so it is not used as the key on the disk.
+    metadata_key = "webhook:" + sha1(webhook_url.encode("utf-8")).hexdigest()
+    webhook_info = metadata_cache.get(metadata_key) if cache is True else None
+    if webhook_info:
+        webhook_info_cache[webhook_url] = webhook_info
+        return webhook_info
+
+    response = _make_request(webhook_url, cache=False) # Contains the webhook token.
     if response:
         try:
             webhook_info = json.loads(response.text)
@@ -70,6 +114,7 @@ def get_webhook_info(webhook_url: str, cache: bool=True) -> dict:
             return {}
         else:
             webhook_info_cache[webhook_url] = webhook_info
+            metadata_cache.set(metadata_key, {key: webhook_info.get(key) for key in WEBHOOK_METADATA_KEYS})
             return webhook_info
 
 
@@ -97,7 +142,12 @@ def get_channel_info(channel_id: int) -> dict:
     if channel_url in channel_info_cache:
         return channel_info_cache[channel_url]
 
-    response = requests.get(channel_url, headers={
+    channel_info = metadata_cache.get(f"channel:{channel_id}")
+    if channel_info:
+        channel_info_cache[channel_url] = channel_info
+        return channel_info
+
+    response = http_client.get(channel_url, headers={
         "Authorization": f"Bot {bot_token}"
     })
 
@@ -109,9 +159,29 @@ def get_channel_info(channel_id: int) -> dict:
             return {}
         else:
             channel_info_cache[channel_url] = channel_info
+            metadata_cache.set(f"channel:{channel_id}", {"type": channel_info.get("type")})
             return channel_info
 
 
+def get_post_html(patch_url: str) -> str:
+    """
+    Return the HTML of the post page.
+    :param patch_url: A string with the URL.
+    :return: The HTML or None if the page could not be fetched.
+    """
+
+    with metrics.timed("post_fetch"):
+        response = _make_request(patch_url)
+    return response.text if response is not None else None
+
+
+def parse_post_html(html: str) -> BeautifulSoup:
+    if html is None:
+        return None
+    with metrics.timed("post_parse"):
+        return make_soup(html)
+
+
 def get_post_soup(patch_url: str) -> BeautifulSoup:
     """
     Return the BeautifulSoup object for the given URL.
@@ -119,19 +189,22 @@ def get_post_soup(patch_url: str) -> BeautifulSoup:
     :return: BeautifulSoup object.
     """
 
-    response = _make_request(patch_url)
-    if response is None:
-        return None
-    return BeautifulSoup(response.text, features=PARSER)
+    return parse_post_html(get_post_html(patch_url))
 
 
 cached_newest_version = {}
+newest_version_lock = Lock() # The webhooks are initialized in parallel, fetch the page only once.
 def get_newest_version(url: str) -> int:
     """
     Return the highest version number from the game updates page.
     :return: An integer with the newest version.
     """
 
+    with newest_version_lock:
+        return _get_newest_version(url)
+
+
+def _get_newest_version(url: str) -> int:
     global cached_newest_version
 
     if url in cached_newest_version:
@@ -154,144 +227,574 @@ def get_newest_version(url: str) -> int:
         return None
 
 
-# def get_new_posts_from_rss(url: str, min_version: int, max_version: int=None) -> list[Post]:
-#     response = _make_request(url)
-#     if response.status_code != 200:
-#         print(f"Failed to fetch the RSS feed from {url}. Status code: {response.status_code}")
-#         return []
+def get_rss_feed_url(source_url: str) -> str:
+    """
+    Return the RSS feed URL configured for the given source URL.
+    :param source_url: The source URL of the game updates listing.
+    :return: The feed URL or None if the source has no feed.
+    """
 
-#     version_regex = re.compile(r'<title>(\d+)</title>\s*<link>\s*https://forums.kleientertainment.com/game-updates/dst/(\d+-r\d+)/\s*</link>')
-#     matches = version_regex.search(response.text)
-#     version = matches.group(1) if matches else None
-#     url_id = matches.group(2) if matches else None
+    rss_feeds = config.get("rss_feeds", DEFAULT_RSS_FEEDS)
+    return rss_feeds.get(source_url) or rss_feeds.get(source_url.rstrip("/"))
 
 
+def get_new_versions_from_rss(feed_url: str, min_version: int) -> list[tuple[int, str]] | None:
+    """
+    Return the versions newer than min_version listed in the RSS feed.
+
+    The feed is streamed and parsed incrementally, newest item first,
+    and the download stops at the first item at or below min_version.
+    The feed does not contain the patch tags (beta, hotfix, ...), so it
+    is only used to detect whether the listing needs to be fetched at all.
+
+    :param feed_url: The URL of the RSS feed.
+    :param min_version: The last version that was already announced.
+    :return: A list of (version, post URL) tuples or None if the feed could not be read.
+    """
+
+    try:
+        response = http_client.get(feed_url, stream=True)
+        print(f"[{response.status_code}]: {response.reason} <- GET {feed_url}")
+        response.raise_for_status()
+    except (requests.ConnectionError, requests.Timeout, requests.exceptions.HTTPError):
+        print(f"[Error] Failed to fetch the RSS feed from {feed_url}!")
+        return None
+
+    new_versions = []
+    response.raw.decode_content = True # Let urllib3 handle the gzip encoding.
+    try:
+        for _, element in ElementTree.iterparse(response.raw, events=("end",)):
+            if element.tag != "item":
+                continue
+
+            link = (element.findtext("link") or "").strip()
+            match = RSS_VERSION_PATTERN.search(link)
+            title = (element.findtext("title") or "").strip()
+            version = int(match.group(1)) if match else (int(title) if title.isdigit() else None)
+            element.clear() # Keep the memory usage flat.
+            if version is None:
+                continue
+
+            if version <= min_version:
+                break # The feed is sorted from the newest, so everything below is already announced.
+
+            new_versions.append((version, link))
+    except ElementTree.ParseError as err:
+        print(f"[Error] Failed to parse the RSS feed from {feed_url}!", err)
+        return None
+    finally:
+        response.close()
+
+    return new_versions
+
+
+def is_source_up_to_date(source_url: str, min_version: int) -> bool:
+    """
+    Return True if the RSS feed of the source shows there is nothing newer than min_version,
+    so the listing does not have to be fetched at all.
+    """
+
+    feed_url = get_rss_feed_url(source_url)
+    if not feed_url or not config.get("rss_fast_path", True):
+        return False
+
+    new_versions = get_new_versions_from_rss(feed_url, min_version)
+    return new_versions is not None and not new_versions
 
 
 # This allows for fetching a range of versions.
-def get_new_posts(url: str, min_version: int, max_version: int=None) -> list[Post]:
+# Source URL -> {"webhooks": fingerprint, "versions": announced versions, "ids": release IDs}, see get_known_releases.
+known_releases_cache = PersistentCache("known_releases", ttl=KNOWN_RELEASES_TTL)
+
+def get_known_releases(source_url: str, fingerprint: str, versions: dict[str, int]) -> set[int]:
+    """
+    Return the release IDs of the source that none of the webhooks needs anymore.
+
+    The IDs are only valid for the same set of webhooks (and their tag rules),
+    so a different fingerprint means nothing is known. The announced versions only grow,
+    unless the last_announced_version of a webhook was lowered to announce the posts again,
+    which makes the IDs invalid as well.
+
+    :param source_url: The source URL of the listing.
+    :param fingerprint: Fingerprint of the webhooks, see main.get_webhooks_fingerprint.
+    :param versions: Webhook key -> its last announced version of the source, see patchook.get_announced_versions.
+    """
+
+    known = known_releases_cache.get(source_url)
+    if not known or known.get("webhooks") != fingerprint:
+        return set()
+
+    for webhook_key, known_version in known.get("versions", {}).items():
+        version = versions.get(webhook_key)
+        if known_version is not None and (version is None or version < known_version):
+            return set()
+
+    return set(known.get("ids", []))
+
+
+def add_known_releases(source_url: str, fingerprint: str, versions: dict[str, int], release_ids) -> None:
+    """Remember the release IDs which were announced to or ignored by all the webhooks, see get_known_releases."""
+
+    known_ids = get_known_releases(source_url, fingerprint, versions)
+    if known_ids.issuperset(release_ids):
+        return
+
+    known_ids.update(release_ids)
+    ids = sorted(known_ids)[-KNOWN_RELEASES_PER_SOURCE:] # The old ones are below min_version anyway.
+    known_releases_cache.set(source_url, {"webhooks": fingerprint, "versions": versions, "ids": ids})
+    known_releases_cache.save()
+
+
+def get_new_posts(url: str, min_version: int, max_version: int=None, known_ids: set[int]=None) -> list[PostRecord]:
     """
     Return a list of new patches with versions higher than the target version.
+
+    The listing pages are scanned first to collect the candidate posts,
+    then the post pages are fetched and parsed by a bounded worker pool.
+
     :param target_version: An integer with the target version.
-    :return: A list of Post objects.
+    :param known_ids: Release IDs which are not needed, these are skipped without being fetched.
+    :return: A list of PostRecord objects.
+    """
+
+    max_posts = config.get("max_announcements_per_webhook", 50)
+    candidates = get_new_candidates(url, min_version, max_version, known_ids)
+
+    workers = max(1, min(config.get("fetch_workers", DEFAULT_FETCH_WORKERS), len(candidates) or 1))
+    parse_pool = get_parse_pool()
+    if parse_pool is not None and candidates:
+        print(f"[Info] Fetching {len(candidates)} post(s) using {workers} workers, building them in {_parse_pool_size} processes...")
+        posts = _build_posts_in_processes(parse_pool, candidates, workers)
+    elif workers > 1:
+        print(f"[Info] Fetching {len(candidates)} post(s) using {workers} workers...")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            posts = list(executor.map(_build_post, candidates)) # Keeps the listing order
+    else:
+        posts = [_build_post(candidate) for candidate in candidates]
+
+    video_info_cache.save()
+    embed_link_cache.save()
+    post_cache.save()
+
+    new_posts = [post for post in posts if post is not None]
+    if len(new_posts) >= max_posts:
+        print("[Warn] They may be even more new versions but we have already reached the limit!")
+        new_posts = new_posts[:max_posts]
+
+    # NOTE: This is in case we would also use the RSS feed as a backup.
+    # Remove duplicate posts since we use multiple systems for fetching.
+    # seen_versions = set()
+    # for post in new_posts[:]:
+    #     if post.version in seen_versions:
+    #         new_posts.remove(post)
+    #     else:
+    #         seen_versions.add(post.version)
+
+    return new_posts
+
+
+def get_new_candidates(url: str, min_version: int, max_version: int=None, known_ids: set[int]=None) -> list[dict]:
+    """
+    Return the candidates of the new posts from the listing, without fetching the posts.
+    The posts are built from them with build_post, see get_new_posts.
+    """
+
+    max_posts = config.get("max_announcements_per_webhook", 50)
+    if config.get("debug_mode", False):
+        known_ids = None # The posts are announced again in debug mode, even the ones all the webhooks have.
+    return _scan_listing(url, min_version, max_version, max_posts, known_ids or set())
+
+
+def get_specific_patch(target_version):
+    return get_new_posts(target_version - 1, target_version + 1)
+
+#### Private Helper Functions ####
+
+def _is_pinned(row: Tag) -> bool:
+    # <span class="ipsBadge ..." title="Pinned"><i class="fa fa-thumb-tack"></i></span>
+    for span in row.find_all("span", title=True):
+        if span.get("title").strip().lower() == PINNED_TITLE:
+            return True
+    return row.find("i", class_=PINNED_ICON_CLASS_NAME) is not None
+
+
+def _scan_listing(url: str, min_version: int, max_version: int, max_posts: int, known_ids: set[int]=frozenset()) -> list[dict]:
     """
+    Walk the listing pages and collect the posts that should be fetched, without fetching them.
+
+    The pinned rows are out of order, so they never decide when to stop. The paging stops
+    at the first page reaching min_version, or whose rows, apart from the pinned ones, are all known.
 
-    new_posts = []
+    :param url: The source URL of the listing.
+    :param min_version: Only collect posts newer than this version.
+    :param max_version: Only collect posts older than this version, if set.
+    :param max_posts: Stop collecting updates once this many were found.
+    :param known_ids: Release IDs to skip, see get_known_releases.
+    :return: A list of candidate dictionaries in listing order.
+    """
+
+    candidates = []
 
     last_version_fetched = None
     page_number = 1
     while True:
         soup = get_source_url_page(url, page_number=page_number)
         records = soup.find_all('li', {'class': 'cCmsRecord_row'})
+        reached_min_version = False
+        all_known = None # Stays None on a page of just the pinned rows, which says nothing about the older pages.
         for data in records:
             a = data.find("a")
             release_id = int(a.get("data-releaseid"))
             #release_id = int(data.find('h3', {'class': VERSION_CLASS_NAME}).contents[0].strip())
-            last_version_fetched = release_id
-            if release_id > min_version and (max_version is None or release_id < max_version):
-                post_url = a.get("href")
-                # post_soup = get_post_soup(post_url)
+            if not _is_pinned(data):
+                reached_min_version = reached_min_version or release_id <= min_version
+                all_known = all_known is not False and release_id in known_ids
 
-                # full_title = post_soup.find("h1", {"class": "ipsType_pageTitle ipsType_largeTitle ipsType_break"})
-                # full_title_text = full_title and full_title.text and full_title.text.strip() or None
-                # print(full_title_text)
-                # exit()
+            if release_id in known_ids:
+                continue # Announced to all the webhooks already, no need to fetch it again.
 
+            if release_id > min_version and (max_version is None or release_id < max_version):
                 # Add the apropriate tags
-                version = int(data.find('h3', {'class': VERSION_CLASS_NAME}).contents[0].strip())
                 tag = data.find('span', {'class': 'ipsBadge ipsBadge_negative'})
-                post = Post(
-                    PostTag.UPDATE,
-                    PostTag.HOTFIX if (s := data.find('span')) and s.get('title') and "hotfix" in s.get('title').lower() else None,
-                    PostTag.BETA if tag and tag.text and "test" in tag.text.lower() or False else None,
-
-                    url=post_url,
-                    soup=get_post_soup(post_url),
-                    source_url=url,
-                    version=version
-                )
-                post.release_id = release_id
-                new_posts.append(post)
-
-                if len(new_posts) >= config.get("max_announcements_per_webhook", 50):
-                    print("[Warn] They may be even more new versions but we have already reached the limit!")
-                    return new_posts
-
-        if not records:
-            for post in soup.find_all("div" , {"class": "ipsDataItem_main"}):
-                post_author = post.find("div", {"class": "ipsDataItem_meta"}).find("a")
-
-                dev = False
-                for span in post_author.find_all("span"):
-                    span_style = span.get("style")
-                    # "color:goldenrod" (for mods)
-                    # "color:red" (for devs and admins)
-                    if span_style and "color:red" in span_style.lower().replace(" ", ""):
-                        dev = True
-                        break
-                if not dev:
-                    continue
-
-                timestamp = int(parser.parse(post.find("time").get("datetime")).timestamp())
-                last_version_fetched = timestamp
-                if timestamp > min_version and (max_version is None or timestamp < max_version):
-                    post_url = post.find("span", {"class": "ipsType_break ipsContained"}).find("a").get("href")
-                    soup = get_post_soup(post_url)
-                    article = soup.find("article")
-                    if article and [link.get("href") for link in article.find_all("a") if str(link.text).lower() == "view full update"]:
-                        continue # Skip updates since they are already announced separately.
-
-                    post = Post(url=post_url, soup=soup, source_url=url)
-                    post.add_tag(PostTag.FORUM_POST)
-                    new_posts.append(post)
-
-                    if len(new_posts) >= config.get("max_announcements_per_webhook", 50):
-                        print("[Warn] They may be even more new versions but we have already reached the limit!")
-                        return new_posts
-
-            if page_number == MAX_FORUM_SEARCH_DEPTH: # If we reach the maximal depth
+                hotfix = any("hotfix" in span.get("title").lower() for span in data.find_all("span", title=True))
+                candidates.append({
+                    "url": a.get("href"),
+                    "source_url": url,
+                    "release_id": release_id,
+                    "version": int(data.find('h3', {'class': VERSION_CLASS_NAME}).contents[0].strip()),
+                    "tags": [
+                        PostTag.UPDATE,
+                        PostTag.HOTFIX if hotfix else None,
+                        PostTag.BETA if tag and tag.text and "test" in tag.text.lower() or False else None,
+                    ],
+                })
+
+                if len(candidates) >= max_posts:
+                    return candidates
+
+        if records:
+            # The rows are ordered from the newest, so the next pages are all older.
+            if reached_min_version or all_known:
                 break
 
+            page_number += 1
+            continue
+
+        # Not a game updates listing, so look for the posts of the developers on the forum page.
+        for post in soup.find_all("div" , {"class": "ipsDataItem_main"}):
+            post_author = post.find("div", {"class": "ipsDataItem_meta"}).find("a")
+
+            dev = False
+            for span in post_author.find_all("span"):
+                span_style = span.get("style")
+                # "color:goldenrod" (for mods)
+                # "color:red" (for devs and admins)
+                if span_style and "color:red" in span_style.lower().replace(" ", ""):
+                    dev = True
+                    break
+            if not dev:
+                continue
+
+            timestamp = int(parser.parse(post.find("time").get("datetime")).timestamp())
+            last_version_fetched = timestamp
+            if timestamp > min_version and (max_version is None or timestamp < max_version):
+                # Forum posts may turn out to be duplicates of updates, so these are
+                # not counted towards the limit until they are fetched.
+                candidates.append({
+                    "url": post.find("span", {"class": "ipsType_break ipsContained"}).find("a").get("href"),
+                    "source_url": url,
+                    "timestamp": timestamp,
+                    "forum_post": True,
+                })
+
+        if page_number == MAX_FORUM_SEARCH_DEPTH: # If we reach the maximal depth
+            break
+
         # Last version on this post is older than the target version.
-        # We assume that the page is not full of pinned patches (usually only one is pinned).
         if not last_version_fetched or last_version_fetched < min_version:
             break
 
         page_number += 1
 
-    # NOTE: This is in case we would also use the RSS feed as a backup.
-    # Remove duplicate posts since we use multiple systems for fetching.
-    # seen_versions = set()
-    # for post in new_posts[:]:
-    #     if post.version in seen_versions:
-    #         new_posts.remove(post)
-    #     else:
-    #         seen_versions.add(post.version)
+    return candidates
 
-    return new_posts
 
+def _build_post(candidate: dict) -> PostRecord | None:
+    """
+    Fetch the post page of a candidate collected by _scan_listing and build the post.
 
-def get_specific_patch(target_version):
-    return get_new_posts(target_version - 1, target_version + 1)
+    :param candidate: The candidate dictionary.
+    :return: PostRecord object or None if the candidate should be skipped.
+    """
 
-#### Private Helper Functions ####
+    return build_post_from_html(candidate, get_post_html(candidate["url"]))
+
+
+# Candidate key -> {"renderer": RENDERER_VERSION, "digest": post digest, "record": serialized PostRecord}
+post_cache = PersistentCache("posts", ttl=POST_CACHE_TTL, max_entries=lambda: config.get("post_cache_size", DEFAULT_POST_CACHE_SIZE))
+
+def _get_post_cache_key(candidate: dict) -> str:
+    if candidate.get("release_id") is not None:
+        return f"{candidate['source_url']}#{candidate['release_id']}"
+    return candidate["url"]
+
+
+def get_post_digest(candidate: dict, html: str) -> str:
+    """
+    Return the digest of what the post is built from: the candidate from the listing (version and tags),
+    the titles, the ld+json block (the author and the date) and the first article of the page, which holds the notes.
+    Post looks for the video, the reward links, the full update link and the Twitch drop in the whole page,
+    so their matches are included as well. The rest of the page (the navigation, the sidebars, the tokens)
+    may differ on each request, so it is left out.
+    """
+
+    article = ARTICLE_PATTERN.search(html)
+    digest = sha1(json.dumps([
+        candidate.get("version"),
+        [str(tag) for tag in candidate.get("tags", []) if tag],
+        get_video_id(html),
+        sorted(set(re.findall(REWARD_LINK_PATTERN, html))),
+        ANY_FULL_UPDATE_URL_PATTERN.findall(html),
+        re.findall(TWITCH_DROP_ANIM_URL, html),
+    ]).encode("utf-8"))
+    for pattern in (PAGE_TITLE_PATTERN, OG_TITLE_PATTERN, LD_JSON_PATTERN):
+        match = pattern.search(html)
+        digest.update((match.group() if match else "").encode("utf-8"))
+    digest.update((article.group() if article else html).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _has_failed_video_lookup(html: str) -> bool:
+    # The lookup of the video is done by now, a failed one is retried by building the post again.
+    video_id = get_video_id(html)
+    return video_id is not None and video_info_cache.get(video_id) is None
+
+
+def get_cached_post(candidate: dict, html: str) -> tuple[bool, PostRecord | None]:
+    """
+    Return the post built from the same page before, if its record is still cached.
 
-# The response is optional, not using the optional annotation in order to support older versions.
-def _make_request(url: str) -> requests.Response:
+    :return: A tuple (hit, post), the post is None for the candidates which were skipped.
+    """
+
+    entry = post_cache.get(_get_post_cache_key(candidate))
+    if not entry or entry.get("renderer") != RENDERER_VERSION or entry.get("digest") != get_post_digest(candidate, html):
+        metrics.increment("post_cache", result="miss")
+        return False, None
+
+    try:
+        post = PostRecord.deserialize(entry["record"]) if entry["record"] is not None else None
+    except KeyError:
+        metrics.increment("post_cache", result="miss")
+        return False, None
+
+    metrics.increment("post_cache", result="hit")
+    return True, post
+
+
+def build_post_from_html(candidate: dict, html: str) -> PostRecord:
+    """
+    Return the post of a candidate from the HTML of its page, from the cache if the page did not change.
+
+    :param candidate: The candidate dictionary.
+    :param html: The HTML of the post page, None if it could not be fetched.
+    :return: PostRecord object or None if the candidate should be skipped.
+    """
+
+    if html is not None:
+        hit, post = get_cached_post(candidate, html)
+        if hit:
+            return post
+    return _build_and_cache_post(candidate, html)
+
+
+def _build_and_cache_post(candidate: dict, html: str) -> PostRecord:
+    post = build_post(candidate, parse_post_html(html))
+    if html is None or _has_failed_video_lookup(html):
+        return post
+
+    post_cache.set(_get_post_cache_key(candidate), {
+        "renderer": RENDERER_VERSION,
+        "digest": get_post_digest(candidate, html),
+        "record": post.serialize() if post is not None else None,
+    })
+    return post
+
+
+def build_post(candidate: dict, soup: BeautifulSoup) -> PostRecord:
+    """
+    Build the post of a candidate collected by _scan_listing from its parsed page.
+
+    :param candidate: The candidate dictionary.
+    :param soup: The parsed post page, None if it could not be fetched.
+    :return: PostRecord object or None if the candidate should be skipped.
+    """
+
+    if candidate.get("forum_post"):
+        if soup is None:
+            return None
+
+        article = soup.find("article")
+        if article and [link.get("href") for link in article.find_all("a") if str(link.text).lower() == "view full update"]:
+            return None # Skip updates since they are already announced separately.
+
+        post = Post(url=candidate["url"], soup=soup, source_url=candidate["source_url"])
+        post.add_tag(PostTag.FORUM_POST)
+        return post.freeze()
+
+    post = Post(
+        *candidate["tags"],
+        url=candidate["url"],
+        soup=soup,
+        source_url=candidate["source_url"],
+        version=candidate["version"]
+    )
+    post.release_id = candidate["release_id"]
+    return post.freeze()
+
+
+def get_post_candidate(post: PostRecord) -> dict:
+    """
+    Return the candidate the post was built from, as a JSON serializable dictionary
+    with the IDs of the tags, see load_candidate. Used to build the post again later without the listing.
+    """
+
+    if post.release_id is None:
+        return {"url": post.url, "source_url": post.source_url, "timestamp": post.version, "forum_post": True}
+
+    return {
+        "url": post.url,
+        "source_url": post.source_url,
+        "release_id": post.release_id,
+        "version": post.version,
+        # The same tags as _scan_listing gives, the post does not add any of them itself.
+        "tags": [tag.id if post.has_tag(tag) else None for tag in (PostTag.UPDATE, PostTag.HOTFIX, PostTag.BETA)],
+    }
+
+
+def load_candidate(data: dict) -> dict:
+    """Return the candidate from the dictionary returned by get_post_candidate."""
+
+    candidate = dict(data)
+    if "tags" in candidate:
+        candidate["tags"] = [PostTag.TAG_BY_ID.get(tag_id) if tag_id else None for tag_id in candidate["tags"]]
+    return candidate
+
+_parse_pool = None
+_parse_pool_size = 0
+_parse_pool_lock = Lock()
+
+def get_parse_processes() -> int:
+    """Return the number of processes building the posts, 0 if they are built in this process."""
+
+    processes = config.get("parse_processes", DEFAULT_PARSE_PROCESSES) or 0
+    if processes == "auto":
+        return cpu_count() or 1
+    return max(0, int(processes))
+
+
+def get_parse_pool() -> ProcessPoolExecutor | None:
+    """
+    Return the process pool building the posts, or None if "parse_processes" is not set.
+
+    Building a post is pure Python work holding the GIL, so more threads do not help
+    while the processes use all the cores. The pool is kept between the daemon polls.
+    """
+
+    global _parse_pool, _parse_pool_size
+
+    processes = get_parse_processes()
+    with _parse_pool_lock:
+        if _parse_pool is not None and _parse_pool_size != processes:
+            _parse_pool.shutdown(wait=False)
+            _parse_pool = None
+
+        if _parse_pool is None and processes > 0:
+            # Started with spawn, forking a process with running threads may copy locks held by them.
+            _parse_pool = ProcessPoolExecutor(max_workers=processes, mp_context=get_context("spawn"))
+            _parse_pool_size = processes
+
+        return _parse_pool
+
+
+def reset_parse_pool() -> None:
+    """Shut the process pool down, the processes keep the config they were started with."""
+
+    global _parse_pool
+
+    with _parse_pool_lock:
+        if _parse_pool is not None:
+            _parse_pool.shutdown(wait=False)
+            _parse_pool = None
+
+
+def build_post_in_process(candidate: dict, html: str) -> tuple:
+    """
+    Build the post from the HTML of its page in a process of the parse pool, for the cache misses.
+
+    The PostRecord is sent back together with the time spent in each stage
+    and the new entries of the lookup caches, which the parent adds with receive_post.
+    """
+
+    metrics.begin_run()
+    post = _build_and_cache_post(candidate, html) # The parent has already looked into the cache.
+    return (post, metrics.get_run_summary()["stages"],
+        video_info_cache.pop_changes(), embed_link_cache.pop_changes(), post_cache.pop_changes())
+
+
+def receive_post(result: tuple) -> PostRecord:
+    """Return the post built by build_post_in_process and merge the rest of the result."""
+
+    post, stages, video_info_changes, embed_link_changes, post_changes = result
+    metrics.merge_stages(stages)
+    video_info_cache.update(video_info_changes)
+    embed_link_cache.update(embed_link_changes)
+    post_cache.update(post_changes)
+    return post
+
+
+def _build_posts_in_processes(parse_pool: ProcessPoolExecutor, candidates: list[dict], workers: int) -> list[PostRecord]:
+    # The pages are fetched by the threads and each one is handed to the processes as soon as it arrives.
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pages = executor.map(get_post_html, [candidate["url"] for candidate in candidates])
+        results = []
+        for candidate, html in zip(candidates, pages):
+            # The cached posts are not worth sending to the processes.
+            hit, post = get_cached_post(candidate, html) if html is not None else (False, None)
+            results.append(post if hit else parse_pool.submit(build_post_in_process, candidate, html))
+
+    return [receive_post(result.result()) if isinstance(result, Future) else result for result in results]
+
+
+def _make_request(url: str, cache: bool=True) -> requests.Response | None:
     """
     Make a request to the given URL and handle possible errors.
+
+    When caching is enabled, the request is sent as a conditional GET and a 304 Not Modified
+    response is served from the disk cache, so unchanged pages cost only a revalidation.
+
     :param url: A string with the URL.
+    :param cache: Whether the on-disk HTTP cache should be used for this URL.
     :return: requests.Response object.
     """
 
+    cache = cache and http_cache.is_enabled()
+    cached_entry = http_cache.lookup(url) if cache else None
+
     reconnect_attempts = 0
     while reconnect_attempts <= MAX_ATTEMPTS:
         try:
-            response = requests.get(url)
+            response = http_client.get(url, headers=http_cache.conditional_headers(cached_entry))
             print(f"[{response.status_code}]: {response.reason} <- GET {url}")
+            if response.status_code == 304 and cached_entry:
+                metrics.increment("http_not_modified")
+                return http_cache.revive(cached_entry, response)
+
             response.raise_for_status()
+            if cache:
+                http_cache.store(url, response)
             return response
-        except (requests.ConnectionError, requests.exceptions.HTTPError):
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.HTTPError):
             print(f"[Error] Wasn't able to fetch the page '{url}'! Retrying after {RETRY_AFTER} seconds...")
             sleep(RETRY_AFTER)
             print(f"[{reconnect_attempts}/{MAX_ATTEMPTS}] Retrying...")